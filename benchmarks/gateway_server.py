@@ -0,0 +1,184 @@
+"""
+Stand-in for the HTTPS API of a remote gateway, to benchmark the Syncer plugin without real gateways. It serves what the
+Syncer uses: login, get_status, get_*_configurations, set_*_configurations, get_*_status, set_output/set_input,
+do_shutter_* and the receive_remote_write and receive_relay calls of a peer Syncer. Every call can be delayed and fail at a given rate, and
+the received calls are recorded with their receive time.
+"""
+
+import os
+import ssl
+import json
+import time
+import random
+import shutil
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+def create_certificate():
+    """ Creates a self-signed certificate with openssl, returns the directory and the cert and key paths """
+    directory = tempfile.mkdtemp(prefix='syncer-benchmark-')
+    cert_file = os.path.join(directory, 'cert.pem')
+    key_file = os.path.join(directory, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                           '-subj', '/CN=127.0.0.1', '-keyout', key_file, '-out', cert_file],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return directory, cert_file, key_file
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, like the gateway
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are written separately, with Nagle every response would wait for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        self.server.gateway.handle(self, url.path.strip('/'), params)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body, content_type='application/json'):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInGateway(object):
+    """
+    Gateway on 127.0.0.1 with the given amount of outputs, inputs, shutters and sensors. The latency (in seconds) is
+    added to every call, with up to the given jitter on top, and a call fails with an HTTP 503 at the failure rate.
+    """
+
+    def __init__(self, name, outputs=0, inputs=0, shutters=0, sensors=0, latency=0.0, jitter=0.0, failure_rate=0.0,
+                 certificate=None):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.outputs = dict((output_id, {'id': output_id, 'name': 'Output {0}'.format(output_id), 'type': 0,
+                                         'status': 0, 'dimmer': 0})
+                            for output_id in range(outputs))
+        self.inputs = dict((input_id, {'id': input_id, 'name': 'Input {0}'.format(input_id), 'status': 0})
+                           for input_id in range(inputs))
+        # two shutters per group
+        self.shutters = dict((shutter_id, {'id': shutter_id, 'name': 'Shutter {0}'.format(shutter_id),
+                                           'group_1': shutter_id // 2, 'group_2': 255, 'state': 'stopped'})
+                             for shutter_id in range(shutters))
+        self.sensors = dict((sensor_id, {'id': sensor_id, 'name': 'Sensor {0}'.format(sensor_id),
+                                         'external_id': '{0}-sensor{1}'.format(name, sensor_id),
+                                         'physical_quantity': 'temperature', 'unit': 'celcius',
+                                         'source': {'type': 'master'}})
+                            for sensor_id in range(sensors))
+        self.calls = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.gateway = self
+        if certificate is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certificate[0], certificate[1])
+            self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+        self.port = self._server.server_address[1]
+        self.address = '127.0.0.1:{0}'.format(self.port)
+
+    def start(self):
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls = []
+
+    def get_calls(self, since=0):
+        """ The (receive time, api call, params, succeeded) of the calls received since the given time """
+        with self._lock:
+            return [call for call in self.calls if call[0] >= since]
+
+    def handle(self, request, api_call, params):
+        received = time.time()
+        failed = random.random() < self.failure_rate
+        with self._lock:
+            self.calls.append((received, api_call, params, not failed))
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if failed:
+            request.send(503, 'Service Unavailable', content_type='text/plain')
+            return
+        try:
+            response = self._execute(api_call, params)
+        except (KeyError, ValueError) as ex:
+            response = {'success': False, 'msg': 'Invalid call {0}: {1}'.format(api_call, ex)}
+        request.send(200, json.dumps(response))
+
+    def _execute(self, api_call, params):
+        if api_call == 'login':
+            return {'success': True, 'token': '{0}-token'.format(self.name)}
+        if api_call == 'get_status':
+            return {'success': True, 'mode': 76, 'version': '0.0.0'}
+        if api_call == 'plugins/Syncer/receive_remote_write':
+            api_call = 'set_{0}'.format(params['obj_type'])
+        if api_call == 'plugins/Syncer/receive_relay':
+            # the updates are applied, the children are returned as unreachable so the sender sends them directly
+            tree = json.loads(params['tree'])
+            for obj_type, obj_id, is_on, dimmer in tree.get('updates', []):
+                self._execute('set_{0}'.format(obj_type), {'id': obj_id, 'is_on': str(is_on), 'dimmer': dimmer})
+            return {'success': True, 'unreachable': tree.get('children', {})}
+        objects = {'output': self.outputs, 'input': self.inputs, 'shutter': self.shutters, 'sensor': self.sensors}
+        with self._lock:
+            if api_call.startswith('get_') and api_call.endswith('_configurations'):
+                return {'success': True, 'config': [dict((key, value) for key, value in obj.items()
+                                                         if key not in ['status', 'dimmer', 'state'])
+                                                    for obj in objects[api_call[4:-15]].values()]}
+            if api_call.startswith('set_') and api_call.endswith('_configurations'):
+                for config in json.loads(params['config']):
+                    objects[api_call[4:-15]][int(config['id'])].update(config)
+                return {'success': True}
+            if api_call == 'get_sensor_status':
+                return {'success': True, 'status': [{'id': sensor_id, 'value': round(random.uniform(15, 25), 1)}
+                                                    for sensor_id in self.sensors]}
+            if api_call in ['get_output_status', 'get_input_status']:
+                return {'success': True, 'status': [dict((key, value) for key, value in obj.items()
+                                                         if key in ['id', 'status', 'dimmer'])
+                                                    for obj in objects[api_call[4:-7]].values()]}
+            if api_call in ['set_output', 'set_input']:
+                obj = objects[api_call[4:]][int(params['id'])]
+                obj['status'] = 1 if params.get('is_on') in ['True', 'true', '1'] else 0
+                if params.get('dimmer') not in ['', None]:
+                    obj['dimmer'] = int(params['dimmer'])
+                return {'success': True}
+            if api_call.startswith('do_shutter_group_'):
+                group = int(params['id'])
+                for shutter in self.shutters.values():
+                    if group in [shutter['group_1'], shutter['group_2']]:
+                        shutter['state'] = api_call[17:]
+                return {'success': True}
+            if api_call.startswith('do_shutter_'):
+                self.shutters[int(params['id'])]['state'] = api_call[11:]
+                return {'success': True}
+        return {'success': False, 'msg': 'Unknown API call {0}'.format(api_call)}
+
+
+def start_gateways(count, certificate=None, **kwargs):
+    return [StandInGateway('gw{0}'.format(index), certificate=certificate, **kwargs).start() for index in range(count)]
+
+
+def remove_certificate(directory):
+    shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,156 @@
+"""
+Shared helpers for the plugin benchmarks: a stand-in for the gateway's plugins.base module, a plugin loader and a
+resource monitor sampling the thread count and memory usage of the benchmark process.
+"""
+
+import os
+import sys
+import time
+import types
+import logging
+import threading
+import importlib.util
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def install_plugin_base():
+    """
+    The plugins import plugins.base, which is part of the gateway. Outside the gateway, the decorators only have to
+    hand back the decorated functions, the background tasks are started by the benchmark when needed.
+    """
+    if 'plugins.base' in sys.modules:
+        return sys.modules['plugins.base']
+
+    def _decorator(*args, **kwargs):
+        # supports both @decorator and @decorator(...)
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda method: method
+
+    class OMPluginBase(object):
+        def __init__(self, webinterface, connector=None):
+            self.webinterface = webinterface
+            self.connector = connector
+            self.logger = logging.getLogger(self.__class__.__name__)
+            self.config = {}
+
+        def read_config(self, default_config=None):
+            return dict(default_config or {}, **self.config)
+
+        def write_config(self, config):
+            self.config = config
+
+    class PluginConfigChecker(object):
+        def __init__(self, description):
+            self.description = description
+
+        def check_config(self, config):
+            pass
+
+    base = types.ModuleType('plugins.base')
+    base.OMPluginBase = OMPluginBase
+    base.PluginConfigChecker = PluginConfigChecker
+    for name in ['om_expose', 'input_status', 'output_status', 'shutter_status', 'receive_events',
+                 'background_task', 'on_remove', 'om_metric_data', 'om_metric_receive']:
+        setattr(base, name, _decorator)
+    package = types.ModuleType('plugins')
+    package.__path__ = []
+    package.base = base
+    sys.modules['plugins'] = package
+    sys.modules['plugins.base'] = base
+    return base
+
+
+def load_plugin(plugin_dir, class_name, config, webinterface, connector=None, overrides=None):
+    """
+    Imports <plugin_dir>/main.py and instantiates the plugin with the given configuration. The overrides replace
+    attributes of the plugin class, e.g. to keep a plugin from writing files next to its main.py.
+    """
+    install_plugin_base()
+    path = os.path.join(ROOT, plugin_dir, 'main.py')
+    spec = importlib.util.spec_from_file_location('{0}_main'.format(plugin_dir.replace('-', '_')), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    plugin_class = getattr(module, class_name)
+
+    class BenchmarkPlugin(plugin_class):
+        def read_config(self, default_config=None):
+            return dict(default_config or {}, **config)
+
+        def write_config(self, new_config):
+            pass
+
+    for name, value in (overrides or {}).items():
+        setattr(BenchmarkPlugin, name, value)
+    return BenchmarkPlugin(webinterface, connector)
+
+
+def get_rss():
+    """ Resident set size of this process in KiB """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class ResourceMonitor(object):
+    """
+    Samples the thread count and RSS while a scenario runs
+    """
+
+    def __init__(self, interval=0.01):
+        self._interval = interval
+        self._running = False
+        self._thread = None
+        self.peak_threads = 0
+        self.peak_rss = 0
+        self.start_rss = 0
+
+    def __enter__(self):
+        self._running = True
+        self.start_rss = get_rss()
+        self.peak_rss = self.start_rss
+        self.peak_threads = threading.active_count()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._running = False
+        self._thread.join()
+
+    def _run(self):
+        while self._running:
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            self.peak_rss = max(self.peak_rss, get_rss())
+            time.sleep(self._interval)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+COLUMNS = [('scenario', '{0}'), ('messages', '{0}'), ('msg/s', '{0:.0f}'), ('p50 ms', '{0:.1f}'),
+           ('p95 ms', '{0:.1f}'), ('p99 ms', '{0:.1f}'), ('max ms', '{0:.1f}'), ('threads', '{0}'),
+           ('rss KiB', '{0}'), ('rss +KiB', '{0}')]
+
+
+def print_results(results, columns=COLUMNS):
+    rows = [[name for name, _ in columns]]
+    for result in results:
+        rows.append(['-' if result.get(name) is None else value_format.format(result[name])
+                     for name, value_format in columns])
+    widths = [max(len(row[index]) for row in rows) for index in range(len(columns))]
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
@@ -0,0 +1,293 @@
+"""
+Minimal MQTT 3.1.1 / 5 broker on the loopback interface, to benchmark the publish path of the MQTT client plugin
+without an external broker. It supports what the plugin uses: QoS 0/1/2 publishes, topic aliases, retained messages,
+(un)subscribe with wildcards and keepalive. Every received publish is handed to a callback with its receive time.
+"""
+
+import socket
+import struct
+import threading
+import time
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+TOPIC_ALIAS = 0x23
+TOPIC_ALIAS_MAXIMUM = 0x22
+# MQTT 5 property identifiers by value type
+_BYTE_PROPERTIES = [0x01, 0x17, 0x19, 0x24, 0x25, 0x28, 0x29, 0x2A]
+_TWO_BYTE_PROPERTIES = [0x13, 0x21, 0x22, 0x23]
+_FOUR_BYTE_PROPERTIES = [0x02, 0x11, 0x18, 0x27]
+_VARINT_PROPERTIES = [0x0B]
+_STRING_PROPERTIES = [0x03, 0x08, 0x09, 0x12, 0x15, 0x16, 0x1A, 0x1C, 0x1F]
+_STRING_PAIR_PROPERTIES = [0x26]
+
+
+def _encode_varint(value):
+    encoded = bytearray()
+    while True:
+        byte = value % 128
+        value //= 128
+        encoded.append(byte | 0x80 if value > 0 else byte)
+        if value == 0:
+            return bytes(encoded)
+
+
+def _decode_varint(data, offset):
+    value = 0
+    multiplier = 1
+    while True:
+        byte = data[offset]
+        offset += 1
+        value += (byte & 0x7F) * multiplier
+        if byte & 0x80 == 0:
+            return value, offset
+        multiplier *= 128
+
+
+def _parse_properties(data, offset):
+    length, offset = _decode_varint(data, offset)
+    end = offset + length
+    properties = {}
+    while offset < end:
+        identifier = data[offset]
+        offset += 1
+        if identifier in _BYTE_PROPERTIES:
+            properties[identifier] = data[offset]
+            offset += 1
+        elif identifier in _TWO_BYTE_PROPERTIES:
+            properties[identifier] = struct.unpack('!H', data[offset:offset + 2])[0]
+            offset += 2
+        elif identifier in _FOUR_BYTE_PROPERTIES:
+            properties[identifier] = struct.unpack('!I', data[offset:offset + 4])[0]
+            offset += 4
+        elif identifier in _VARINT_PROPERTIES:
+            properties[identifier], offset = _decode_varint(data, offset)
+        elif identifier in _STRING_PROPERTIES:
+            offset += 2 + struct.unpack('!H', data[offset:offset + 2])[0]
+        elif identifier in _STRING_PAIR_PROPERTIES:
+            for _ in range(2):
+                offset += 2 + struct.unpack('!H', data[offset:offset + 2])[0]
+        else:
+            raise ValueError('Unknown property {0}'.format(identifier))
+    return properties, end
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for index, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class _Session(object):
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.protocol_level = 4
+        self.topic_aliases = {}
+        self.subscriptions = set()
+        self.send_lock = threading.Lock()
+        self.packet_id = 0
+
+    def send(self, packet_type, flags, body):
+        packet = bytes([(packet_type << 4) | flags]) + _encode_varint(len(body)) + body
+        with self.send_lock:
+            self.sock.sendall(packet)
+
+    def deliver(self, topic, payload, retain):
+        # forwarded with QoS 0
+        encoded_topic = topic.encode('utf-8')
+        body = struct.pack('!H', len(encoded_topic)) + encoded_topic
+        if self.protocol_level == 5:
+            body += b'\x00'
+        self.send(PUBLISH, 1 if retain else 0, body + payload)
+
+    def run(self):
+        reader = self.sock.makefile('rb')
+        try:
+            while True:
+                header = reader.read(1)
+                if not header:
+                    return
+                length = 0
+                multiplier = 1
+                while True:
+                    byte = reader.read(1)[0]
+                    length += (byte & 0x7F) * multiplier
+                    if byte & 0x80 == 0:
+                        break
+                    multiplier *= 128
+                body = reader.read(length) if length > 0 else b''
+                if not self.handle(header[0] >> 4, header[0] & 0x0F, body):
+                    return
+        except (OSError, IndexError):
+            pass
+        finally:
+            self.broker.remove_session(self)
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+    def handle(self, packet_type, flags, body):
+        if packet_type == CONNECT:
+            name_length = struct.unpack('!H', body[0:2])[0]
+            self.protocol_level = body[2 + name_length]
+            if self.protocol_level == 5:
+                properties = _encode_varint(3) + bytes([TOPIC_ALIAS_MAXIMUM]) + struct.pack('!H', self.broker.topic_alias_maximum)
+                self.send(CONNACK, 0, b'\x00\x00' + properties)
+            else:
+                self.send(CONNACK, 0, b'\x00\x00')
+        elif packet_type == PUBLISH:
+            self.handle_publish(flags, body)
+        elif packet_type == PUBREL:
+            self.send(PUBCOMP, 0, body[0:2])
+        elif packet_type == SUBSCRIBE:
+            packet_id = body[0:2]
+            offset = 2
+            if self.protocol_level == 5:
+                _, offset = _parse_properties(body, offset)
+            granted = bytearray()
+            topic_filters = []
+            while offset < len(body):
+                length = struct.unpack('!H', body[offset:offset + 2])[0]
+                topic_filters.append(body[offset + 2:offset + 2 + length].decode('utf-8'))
+                offset += 2 + length
+                granted.append(min(1, body[offset] & 0x03))
+                offset += 1
+            self.subscriptions.update(topic_filters)
+            properties = b'\x00' if self.protocol_level == 5 else b''
+            self.send(SUBACK, 0, packet_id + properties + bytes(granted))
+            for topic_filter in topic_filters:
+                for topic, payload in self.broker.get_retained(topic_filter):
+                    self.deliver(topic, payload, True)
+        elif packet_type == UNSUBSCRIBE:
+            packet_id = body[0:2]
+            offset = 2
+            if self.protocol_level == 5:
+                _, offset = _parse_properties(body, offset)
+            count = 0
+            while offset < len(body):
+                length = struct.unpack('!H', body[offset:offset + 2])[0]
+                self.subscriptions.discard(body[offset + 2:offset + 2 + length].decode('utf-8'))
+                offset += 2 + length
+                count += 1
+            if self.protocol_level == 5:
+                self.send(UNSUBACK, 0, packet_id + b'\x00' + b'\x00' * count)
+            else:
+                self.send(UNSUBACK, 0, packet_id)
+        elif packet_type == PINGREQ:
+            self.send(PINGRESP, 0, b'')
+        elif packet_type == DISCONNECT:
+            return False
+        return True
+
+    def handle_publish(self, flags, body):
+        received = time.time()
+        qos = (flags >> 1) & 0x03
+        retain = bool(flags & 0x01)
+        length = struct.unpack('!H', body[0:2])[0]
+        topic = body[2:2 + length].decode('utf-8')
+        offset = 2 + length
+        packet_id = None
+        if qos > 0:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+        if self.protocol_level == 5:
+            properties, offset = _parse_properties(body, offset)
+            alias = properties.get(TOPIC_ALIAS)
+            if alias is not None:
+                if topic:
+                    self.topic_aliases[alias] = topic
+                else:
+                    topic = self.topic_aliases[alias]
+        payload = body[offset:]
+        if qos == 1:
+            self.send(PUBACK, 0, packet_id)
+        elif qos == 2:
+            self.send(PUBREC, 0, packet_id)
+        self.broker.publish(self, topic, payload, retain, received)
+
+
+class LoopbackBroker(object):
+    """
+    Broker listening on 127.0.0.1, on a free port unless one is given
+    """
+
+    def __init__(self, on_publish=None, port=0, topic_alias_maximum=100):
+        self.on_publish = on_publish
+        self.topic_alias_maximum = topic_alias_maximum
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', port))
+        self._server.listen(16)
+        self.port = self._server.getsockname()[1]
+        self._sessions = []
+        self._retained = {}
+        self._lock = threading.Lock()
+        self._running = False
+
+    def start(self):
+        self._running = True
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._server.close()
+        with self._lock:
+            sessions = list(self._sessions)
+        for session in sessions:
+            try:
+                session.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _accept(self):
+        while self._running:
+            try:
+                sock, _ = self._server.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = _Session(self, sock)
+            with self._lock:
+                self._sessions.append(session)
+            thread = threading.Thread(target=session.run)
+            thread.daemon = True
+            thread.start()
+
+    def remove_session(self, session):
+        with self._lock:
+            if session in self._sessions:
+                self._sessions.remove(session)
+
+    def get_retained(self, topic_filter):
+        with self._lock:
+            return [(topic, payload) for topic, payload in self._retained.items() if topic_matches(topic_filter, topic)]
+
+    def publish(self, sender, topic, payload, retain, received):
+        if self.on_publish is not None:
+            self.on_publish(topic, payload, received)
+        with self._lock:
+            if retain:
+                if payload:
+                    self._retained[topic] = payload
+                else:
+                    self._retained.pop(topic, None)
+            receivers = [session for session in self._sessions
+                         if any(topic_matches(topic_filter, topic) for topic_filter in session.subscriptions)]
+        for session in receivers:
+            try:
+                session.deliver(topic, payload, False)
+            except OSError:
+                pass
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Publish throughput benchmark for the MQTT client plugin.
+
+The plugin runs against a fake webinterface with a configurable amount of inputs, outputs, sensors and power modules,
+and publishes to a loopback broker. Each scenario replays synthetic events and reports the amount of messages the
+broker received, messages per second, end-to-end latency (from the event to the broker, based on the timestamp in
+the payload), the peak thread count and the memory usage.
+
+Usage: python3 benchmarks/mqtt_client.py [--inputs 100] [--outputs 100] [--protocol 5] [--json results.json]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from harness import load_plugin, ResourceMonitor, get_rss, percentile, print_results
+from mqtt_broker import LoopbackBroker
+
+SCENARIOS = ['input_burst', 'output_storm', 'sensor_poll', 'power_poll', 'output_commands']
+
+
+class FakeWebinterface(object):
+    """
+    Gateway API with synthetic inputs, outputs, sensors and power modules
+    """
+
+    def __init__(self, inputs, outputs, sensors, power_modules):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.sensors = sensors
+        self.power_modules = power_modules
+        self.set_output_calls = []
+        self._lock = threading.Lock()
+
+    def get_input_configurations(self):
+        return json.dumps({'success': True,
+                           'config': [{'id': input_id, 'name': 'Input {0}'.format(input_id)}
+                                      for input_id in range(self.inputs)]})
+
+    def get_input_status(self):
+        return json.dumps({'success': True,
+                           'status': [{'id': input_id, 'status': 0} for input_id in range(self.inputs)]})
+
+    def get_output_configurations(self):
+        return json.dumps({'success': True,
+                           'config': [{'id': output_id,
+                                       'name': 'Output {0}'.format(output_id),
+                                       'module_type': 'D' if output_id % 2 else 'O',
+                                       'type': 255}
+                                      for output_id in range(self.outputs)]})
+
+    def get_output_status(self):
+        return json.dumps({'success': True,
+                           'status': [{'id': output_id, 'status': 0, 'dimmer': 0} for output_id in range(self.outputs)]})
+
+    def set_output(self, id, is_on, dimmer=None):
+        with self._lock:
+            self.set_output_calls.append((time.time(), id, is_on, dimmer))
+        return json.dumps({'success': True})
+
+    def get_sensor_configurations(self):
+        return json.dumps({'success': True,
+                           'config': [{'id': sensor_id,
+                                       'name': 'Sensor {0}'.format(sensor_id),
+                                       'external_id': 'sensor{0}'.format(sensor_id),
+                                       'physical_quantity': 'temperature',
+                                       'source': {'type': 'master'},
+                                       'unit': 'celcius'}
+                                      for sensor_id in range(self.sensors)]})
+
+    def get_sensor_status(self):
+        return json.dumps({'success': True,
+                           'status': [round(random.uniform(15, 25), 1) for _ in range(self.sensors)]})
+
+    def get_power_modules(self):
+        modules = []
+        for module_id in range(1, self.power_modules + 1):
+            module = {'id': module_id, 'version': 8}
+            for input_id in range(8):
+                module.update({'input{0}'.format(input_id): 'Power {0}.{1}'.format(module_id, input_id),
+                               'sensor{0}'.format(input_id): 2,
+                               'times{0}'.format(input_id): '',
+                               'inverted{0}'.format(input_id): False})
+            modules.append(module)
+        return json.dumps({'success': True, 'modules': modules})
+
+    def get_realtime_power(self):
+        data = dict((str(module_id), [[230.0, 50.0, round(random.uniform(0, 10), 2), round(random.uniform(0, 2300), 1)]
+                                      for _ in range(8)])
+                    for module_id in range(1, self.power_modules + 1))
+        data['success'] = True
+        return json.dumps(data)
+
+    def get_total_energy(self):
+        data = dict((str(module_id), [[random.randint(0, 10 ** 6), random.randint(0, 10 ** 6)] for _ in range(8)])
+                    for module_id in range(1, self.power_modules + 1))
+        data['success'] = True
+        return json.dumps(data)
+
+
+class Collector(object):
+    """
+    Collects the messages the broker receives for the topics of the running scenario
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._prefixes = ()
+        self.messages = []
+
+    def reset(self, prefixes):
+        with self._condition:
+            self._prefixes = tuple(prefixes)
+            self.messages = []
+
+    def on_publish(self, topic, payload, received):
+        if topic.startswith(self._prefixes):
+            with self._condition:
+                self.messages.append((received, payload))
+                self._condition.notify_all()
+
+    def wait(self, expected, timeout, quiet=1.0):
+        """ Waits for the expected amount of messages, or until no message arrived for a while """
+        deadline = time.time() + timeout
+        with self._condition:
+            while time.time() < deadline:
+                if expected is not None and len(self.messages) >= expected:
+                    return
+                count = len(self.messages)
+                self._condition.wait(quiet)
+                if len(self.messages) == count and (expected is None or count > 0 and time.time() - self.messages[-1][0] >= quiet):
+                    return
+
+    def latencies(self):
+        latencies = []
+        for received, payload in self.messages:
+            try:
+                timestamp = json.loads(payload)['timestamp']
+            except (ValueError, KeyError, TypeError):
+                continue
+            sent = datetime.fromisoformat(timestamp).timestamp()
+            latencies.append((received - sent) * 1000.0)
+        return latencies
+
+
+def summarize(name, start, messages, latencies, monitor):
+    end = max([received for received in messages]) if messages else time.time()
+    duration = max(end - start, 1e-6)
+    return {'scenario': name,
+            'messages': len(messages),
+            'msg/s': len(messages) / duration if messages else 0.0,
+            'p50 ms': percentile(latencies, 0.5),
+            'p95 ms': percentile(latencies, 0.95),
+            'p99 ms': percentile(latencies, 0.99),
+            'max ms': max(latencies) if latencies else None,
+            'threads': monitor.peak_threads,
+            'rss KiB': get_rss(),
+            'rss +KiB': monitor.peak_rss - monitor.start_rss}
+
+
+def run_publish_scenario(name, plugin, collector, prefixes, expected, replay, timeout):
+    collector.reset(prefixes)
+    with ResourceMonitor() as monitor:
+        start = time.time()
+        replay()
+        collector.wait(expected, timeout)
+    return summarize(name, start, [received for received, _ in collector.messages], collector.latencies(), monitor)
+
+
+def input_burst(plugin, web, collector, args):
+    status = {}
+
+    def replay():
+        for event in range(args.events):
+            input_id = event % web.inputs
+            status[input_id] = not status.get(input_id, False)
+            plugin.input_status({'input_id': input_id, 'status': status[input_id]})
+    filtered = args.input_debounce > 0 or args.input_rate_limit > 0
+    return run_publish_scenario('input_burst', plugin, collector, ['openmotics/input/'],
+                                None if filtered else args.events, replay, args.timeout)
+
+
+def output_storm(plugin, web, collector, args):
+    def replay():
+        for storm_round in range(args.rounds):
+            level = storm_round % 99 + 1
+            plugin.output_status([(output_id, level) for output_id in range(web.outputs)])
+    return run_publish_scenario('output_storm', plugin, collector, ['openmotics/output/'],
+                                web.outputs * args.rounds, replay, args.timeout)
+
+
+def sensor_poll(plugin, web, collector, args):
+    def replay():
+        for _ in range(args.polls):
+            plugin._poll_sensor_data('sensor', web.get_sensor_status, plugin._process_sensor_status, plugin._snapshot_sensor_status)
+    expected = args.polls if args.snapshot_format != 'disabled' else web.sensors * args.polls
+    return run_publish_scenario('sensor_poll', plugin, collector, ['openmotics/sensor/'],
+                                expected, replay, args.timeout)
+
+
+def power_poll(plugin, web, collector, args):
+    def replay():
+        for _ in range(args.polls):
+            plugin._poll_sensor_data('power', web.get_realtime_power, plugin._process_realtime_power, plugin._snapshot_realtime_power)
+    expected = args.polls if args.snapshot_format != 'disabled' else web.power_modules * 8 * args.polls
+    return run_publish_scenario('power_poll', plugin, collector, ['openmotics/power/'],
+                                expected, replay, args.timeout)
+
+
+def output_commands(plugin, web, collector, args, broker):
+    """ Inbound path: commands published by another client, until the last command of every output is executed """
+    import paho.mqtt.client as client
+    commander = client.Client(client_id='benchmark-commander')
+    commander.connect('127.0.0.1', broker.port)
+    commander.loop_start()
+    del web.set_output_calls[:]
+    sent = {}
+    last_value = {}
+    with ResourceMonitor() as monitor:
+        start = time.time()
+        for command in range(args.commands):
+            output_id = command % web.outputs
+            # every command for an output has another level, so an executed level maps to one command
+            value = (command // web.outputs) % 100 + 1
+            sent[(output_id, value)] = time.time()
+            last_value[output_id] = value
+            commander.publish('openmotics/output/{0}/set'.format(output_id), str(value), qos=1)
+        deadline = time.time() + args.timeout
+        while time.time() < deadline:
+            executed = {}
+            for _, output_id, is_on, dimmer in list(web.set_output_calls):
+                executed[output_id] = dimmer
+            # relays (even ids) don't get a level, dimmers have to end at the last sent level
+            if all(output_id in executed and (output_id % 2 == 0 or executed[output_id] == value)
+                   for output_id, value in last_value.items()):
+                break
+            time.sleep(0.05)
+    commander.loop_stop()
+    commander.disconnect()
+    latencies = []
+    for executed_at, output_id, is_on, dimmer in web.set_output_calls:
+        if dimmer is not None and (output_id, dimmer) in sent:
+            latencies.append((executed_at - sent[(output_id, dimmer)]) * 1000.0)
+    result = summarize('output_commands', start, [call[0] for call in web.set_output_calls], latencies, monitor)
+    result['commands'] = args.commands
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MQTT client publish benchmark')
+    parser.add_argument('--inputs', type=int, default=100)
+    parser.add_argument('--outputs', type=int, default=100)
+    parser.add_argument('--sensors', type=int, default=32)
+    parser.add_argument('--power-modules', type=int, default=4)
+    parser.add_argument('--events', type=int, default=2000, help='input events in the input burst')
+    parser.add_argument('--rounds', type=int, default=10, help='rounds of changing all outputs in the output storm')
+    parser.add_argument('--polls', type=int, default=20, help='sensor and power polls')
+    parser.add_argument('--commands', type=int, default=1000, help='output commands')
+    parser.add_argument('--protocol', choices=['3.1.1', '5'], default='3.1.1')
+    parser.add_argument('--qos', choices=['0', '1', '2'], default='0')
+    parser.add_argument('--snapshot-format', choices=['disabled', 'json', 'cbor'], default='disabled')
+    parser.add_argument('--input-debounce', type=int, default=0, help='input debounce in ms')
+    parser.add_argument('--input-rate-limit', type=int, default=0, help='input rate limit in ms')
+    parser.add_argument('--logging', action='store_true', help='publish the log messages as well')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    collector = Collector()
+    broker = LoopbackBroker(on_publish=collector.on_publish).start()
+    web = FakeWebinterface(args.inputs, args.outputs, args.sensors, args.power_modules)
+    config = {'hostname': '127.0.0.1',
+              'port': broker.port,
+              'protocol': args.protocol,
+              'input_status_enabled': True,
+              'input_status_qos': args.qos,
+              'input_status_retain': False,
+              'input_status_debounce': args.input_debounce,
+              'input_status_rate_limit': args.input_rate_limit,
+              'output_status_enabled': True,
+              'output_status_qos': args.qos,
+              'output_status_retain': False,
+              'event_status_qos': '0',
+              'event_status_retain': False,
+              'sensor_status_enabled': True,
+              'sensor_status_qos': args.qos,
+              'sensor_status_retain': False,
+              'power_status_enabled': True,
+              'power_status_qos': args.qos,
+              'power_status_retain': False,
+              'energy_status_qos': args.qos,
+              'energy_status_retain': False,
+              'snapshot_format': args.snapshot_format,
+              'logging_topic': 'openmotics/logging' if args.logging else '',
+              'stats_topic': '',
+              'republish_rate': 0,
+              'configuration_refresh_interval': 0}
+    start_rss = get_rss()
+    plugin = load_plugin('mqtt-client', 'MQTTClient', config, web)
+    # only the command worker is needed, the polling is replayed by the scenarios
+    command_worker = threading.Thread(target=plugin.background_task_output_commands)
+    command_worker.daemon = True
+    command_worker.start()
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        status = json.loads(plugin.get_status())
+        if status['connected'] and status['ready']:
+            break
+        time.sleep(0.05)
+    else:
+        print('Plugin did not get ready: {0}'.format(plugin.get_status()))
+        sys.exit(1)
+
+    print('MQTT client {0}: {1} inputs, {2} outputs, {3} sensors, {4} power modules, protocol {5}, QoS {6}, RSS {7} KiB after start ({8:+d} KiB)'.format(
+        plugin.version, args.inputs, args.outputs, args.sensors, args.power_modules, args.protocol, args.qos,
+        get_rss(), get_rss() - start_rss))
+    scenarios = {'input_burst': lambda: input_burst(plugin, web, collector, args),
+                 'output_storm': lambda: output_storm(plugin, web, collector, args),
+                 'sensor_poll': lambda: sensor_poll(plugin, web, collector, args),
+                 'power_poll': lambda: power_poll(plugin, web, collector, args),
+                 'output_commands': lambda: output_commands(plugin, web, collector, args, broker)}
+    results = []
+    for name in args.scenarios.split(','):
+        results.append(scenarios[name.strip()]())
+        # let the publish threads of the previous scenario finish
+        time.sleep(0.5)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({'arguments': vars(args), 'version': plugin.version, 'results': results}, output, indent=4)
+    for connection in plugin._connections.values():
+        connection.disconnect()
+    broker.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the Syncer plugin against stand-in remote gateways: N HTTPS servers on the loopback interface, with a
+configurable latency and failure rate. It measures how long the startup takes (login, loading the remote configurations,
+renaming the remote objects and pushing the initial states), and replays output, input and shutter changes to measure
+the latency until the change arrives on every remote gateway and the amount of calls per change. After every scenario,
+the remote objects have to end in the local state, otherwise the benchmark fails.
+
+Usage: python3 benchmarks/syncer.py [--gateways 4] [--outputs 20] [--inputs 20] [--shutters 4] [--sensors 4]
+                                    [--latency 5] [--jitter 0] [--failure-rate 0] [--peer-syncer] [--json results.json]
+"""
+
+import os
+import sys
+import json
+import time
+import bisect
+import argparse
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from harness import load_plugin, get_rss, ResourceMonitor, percentile, print_results
+from gateway_server import create_certificate, remove_certificate, start_gateways
+
+SCENARIOS = ['output_events', 'input_events', 'shutter_events']
+COLUMNS = [('scenario', '{0}'), ('events', '{0}'), ('calls', '{0}'), ('calls/event', '{0:.2f}'),
+           ('failed', '{0}'), ('p50 ms', '{0:.1f}'), ('p95 ms', '{0:.1f}'), ('p99 ms', '{0:.1f}'),
+           ('max ms', '{0:.1f}'), ('in sync', '{0}'), ('threads', '{0}'), ('rss +KiB', '{0}')]
+
+
+class FakeWebinterface(object):
+    """
+    The local gateway: the first outputs are the outputs of the shutters, the odd outputs and inputs are on
+    """
+
+    def __init__(self, outputs, inputs, shutters):
+        self.shutters = shutters
+        self.output_offset = shutters * 2
+        self.outputs = self.output_offset + outputs
+        self.inputs = inputs
+
+    def get_output_configurations(self):
+        return json.dumps({'success': True,
+                           'config': [{'id': output_id, 'name': 'Local output {0}'.format(output_id),
+                                       'type': 127 if output_id < self.output_offset else 0}
+                                      for output_id in range(self.outputs)]})
+
+    def get_output_status(self):
+        return json.dumps({'success': True,
+                           'status': [{'id': output_id, 'status': output_id % 2, 'dimmer': 0}
+                                      for output_id in range(self.outputs)]})
+
+    def get_input_configurations(self):
+        return json.dumps({'success': True,
+                           'config': [{'id': input_id, 'name': 'Local input {0}'.format(input_id)}
+                                      for input_id in range(self.inputs)]})
+
+    def get_input_status(self):
+        return json.dumps({'success': True,
+                           'status': [{'id': input_id, 'status': input_id % 2} for input_id in range(self.inputs)]})
+
+    def get_shutter_configurations(self):
+        return json.dumps({'success': True,
+                           'config': [{'id': shutter_id, 'name': 'Local shutter {0}'.format(shutter_id)}
+                                      for shutter_id in range(self.shutters)]})
+
+    def get_shutter_status(self):
+        return json.dumps({'success': True, 'status': ['stopped'] * self.shutters})
+
+
+class FakeConnector(object):
+    """ The connectors the Syncer uses: status event subscriptions, and registering and reporting sensors """
+
+    class _Connector(object):
+        def __init__(self):
+            self.handlers = []
+            self.registered = []
+            self.reported = []
+
+        def subscribe_status_event(self, handler, version=None):
+            self.handlers.append(handler)
+
+        def register(self, **kwargs):
+            self.registered.append(kwargs)
+            return kwargs
+
+        def report_status(self, **kwargs):
+            self.reported.append(kwargs)
+
+    def __init__(self):
+        self.input = FakeConnector._Connector()
+        self.output = FakeConnector._Connector()
+        self.shutter = FakeConnector._Connector()
+        self.sensor = FakeConnector._Connector()
+
+
+class SentEvents(object):
+    """
+    The send times of the events per (object, value). A remote call is matched with the last event of its object with
+    the same value that was sent before the call arrived, as the Syncer coalesces quick changes of the same object.
+    """
+
+    def __init__(self):
+        self._times = {}
+
+    def add(self, key, value, sent):
+        self._times.setdefault((key, value), []).append(sent)
+
+    def get_latency(self, key, value, received):
+        times = self._times.get((key, value), [])
+        index = bisect.bisect_right(times, received)
+        if index == 0:
+            return None
+        return (received - times[index - 1]) * 1000.0
+
+
+def get_config(args, gateways):
+    local_output_offset = args.shutters * 2
+    gateway_configs = []
+    for index, gateway in enumerate(gateways):
+        mappings = []
+        for output_id in range(args.outputs):
+            mappings.append({'type': ['output', {'local_output_id': local_output_offset + output_id,
+                                                 'remote_output_id': output_id}]})
+        for input_id in range(args.inputs):
+            mappings.append({'type': ['input', {'local_input_id': input_id, 'remote_input_id': input_id}]})
+        for shutter_id in range(args.shutters):
+            mappings.append({'type': ['shutter', {'local_shutter_id': shutter_id, 'remote_shutter_id': shutter_id,
+                                                  'is_shutter_group': False, 'reversed': False}]})
+        for sensor_id in range(args.sensors):
+            mappings.append({'type': ['sensor', {'remote_sensor_id': sensor_id}]})
+        gateway_configs.append({'gateway_ip': gateway.address,
+                                'remote_name': gateway.name,
+                                'username': 'benchmark',
+                                'password': 'benchmark',
+                                'push_sensors': False,
+                                'peer_syncer': args.peer_syncer,
+                                'mappings': mappings})
+    return {'local_name': 'benchmark',
+            'polling_interval': 60,
+            'reconcile_interval': 0,
+            'relay_fanout': 0,
+            'gateways': gateway_configs}
+
+
+def count_calls(calls):
+    return len(calls), sum(1 for call in calls if not call[3])
+
+
+def wait_until_idle(plugin, gateways, timeout, quiet=0.3, condition=None):
+    """ Waits until the workers have no pending updates and no GW got a call for a while """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        pending = sum(gateway['worker'].get_pending_count() for gateway in list(plugin._gateways.values()))
+        last_call = max([gateway.calls[-1][0] for gateway in gateways if gateway.calls] or [0])
+        if plugin._enabled and pending == 0 and time.time() - last_call >= quiet and (condition is None or condition()):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def start_syncer(args, gateways, web, connector):
+    """ Starts the Syncer and measures how long it takes until every GW is set up """
+    config = get_config(args, gateways)
+    with ResourceMonitor() as monitor:
+        start = time.time()
+        plugin = load_plugin('syncer', 'Syncer', config, web, connector=connector,
+                             # the tokens of the stand-ins are not stored next to the plugin
+                             overrides={'_load_tokens': lambda self: {},
+                                        '_save_token': lambda self, gateway, token: None})
+        if not wait_until_idle(plugin, gateways, args.timeout):
+            print('Syncer did not start within {0}s'.format(args.timeout))
+            sys.exit(1)
+    calls = [call for gateway in gateways for call in gateway.get_calls(start)]
+    setup_times = [(gateway.get_calls(start)[-1][0] - start) * 1000.0 for gateway in gateways if gateway.calls]
+    total, failed = count_calls(calls)
+    result = {'scenario': 'startup',
+              'events': len(gateways),
+              'calls': total,
+              'calls/event': total / float(len(gateways)),
+              'failed': failed,
+              'p50 ms': percentile(setup_times, 0.5),
+              'p95 ms': percentile(setup_times, 0.95),
+              'p99 ms': percentile(setup_times, 0.99),
+              'max ms': max(setup_times) if setup_times else None,
+              'in sync': '{0}/{1}'.format(sum(1 for gateway in gateways if all(
+                  'controlled by syncer plugin' in obj['name']
+                  for objects in [gateway.outputs, gateway.inputs, gateway.shutters] for obj in objects.values())),
+                  len(gateways)),
+              'threads': monitor.peak_threads,
+              'rss +KiB': monitor.peak_rss - monitor.start_rss}
+    per_call = {}
+    for call in calls:
+        per_call[call[1]] = per_call.get(call[1], 0) + 1
+    return plugin, result, per_call
+
+
+def run_scenario(name, plugin, gateways, args, replay, remote_calls, is_in_sync):
+    """
+    Replays the events, then matches the calls the GWs received with the events. The remote_calls function returns the
+    (local key, value) of a received call, or None if the call doesn't belong to the scenario.
+    """
+    for gateway in gateways:
+        gateway.reset_calls()
+    sent = SentEvents()
+    with ResourceMonitor() as monitor:
+        start = time.time()
+        events = replay(sent)
+        synced = wait_until_idle(plugin, gateways, args.timeout,
+                                 condition=lambda: all(is_in_sync(gateway) for gateway in gateways))
+    calls = [call for gateway in gateways for call in gateway.get_calls(start)]
+    latencies = []
+    for received, api_call, params, succeeded in calls:
+        if not succeeded:
+            continue
+        matched = remote_calls(api_call, params)
+        if matched is None:
+            continue
+        latency = sent.get_latency(matched[0], matched[1], received)
+        if latency is not None:
+            latencies.append(latency)
+    total, failed = count_calls(calls)
+    in_sync = sum(1 for gateway in gateways if is_in_sync(gateway))
+    return {'scenario': name,
+            'events': events,
+            'calls': total,
+            'calls/event': total / float(events) if events else None,
+            'failed': failed,
+            'p50 ms': percentile(latencies, 0.5),
+            'p95 ms': percentile(latencies, 0.95),
+            'p99 ms': percentile(latencies, 0.99),
+            'max ms': max(latencies) if latencies else None,
+            'in sync': '{0}/{1}'.format(in_sync, len(gateways)),
+            'synced': synced,
+            'threads': monitor.peak_threads,
+            'rss +KiB': monitor.peak_rss - monitor.start_rss}
+
+
+def get_write(api_call, params, obj_type):
+    # a peer Syncer gets the writes on its plugin API
+    if api_call == 'plugins/Syncer/receive_remote_write' and params.get('obj_type') == obj_type:
+        return params
+    if api_call == 'set_{0}'.format(obj_type):
+        return params
+    return None
+
+
+def output_events(plugin, web, gateways, args):
+    """ Every event sets a mapped output to another dimmer level """
+    local_states = {}
+
+    def replay(sent):
+        for event in range(args.events):
+            output_id = event % args.outputs
+            level = (event // args.outputs) % 100 + 1
+            local_states[output_id] = level
+            sent.add(output_id, level, time.time())
+            plugin.handle_output_status({'id': web.output_offset + output_id, 'status': {'on': True, 'value': level}})
+            time.sleep(args.interval / 1000.0)
+        return args.events
+
+    def remote_calls(api_call, params):
+        write = get_write(api_call, params, 'output')
+        if write is None or write.get('dimmer') in ['', None]:
+            return None
+        return int(write['id']), int(write['dimmer'])
+
+    def is_in_sync(gateway):
+        return all(gateway.outputs[output_id]['status'] == 1 and gateway.outputs[output_id]['dimmer'] == level
+                   for output_id, level in local_states.items())
+
+    return run_scenario('output_events', plugin, gateways, args, replay, remote_calls, is_in_sync)
+
+
+def input_events(plugin, web, gateways, args):
+    """ Every event toggles a mapped input """
+    local_states = dict((input_id, bool(input_id % 2)) for input_id in range(args.inputs))
+
+    def replay(sent):
+        for event in range(args.events):
+            input_id = event % args.inputs
+            local_states[input_id] = not local_states[input_id]
+            sent.add(input_id, local_states[input_id], time.time())
+            plugin.handle_input_status({'input_id': input_id, 'status': local_states[input_id]})
+            time.sleep(args.interval / 1000.0)
+        return args.events
+
+    def remote_calls(api_call, params):
+        write = get_write(api_call, params, 'input')
+        if write is None:
+            return None
+        return int(write['id']), write.get('is_on') in ['True', 'true', '1']
+
+    def is_in_sync(gateway):
+        return all(gateway.inputs[input_id]['status'] == int(status) for input_id, status in local_states.items())
+
+    return run_scenario('input_events', plugin, gateways, args, replay, remote_calls, is_in_sync)
+
+
+def shutter_events(plugin, web, gateways, args):
+    """ Every event moves a mapped shutter up or down, the shutter event has the states of all shutters """
+    local_states = dict((shutter_id, 'stopped') for shutter_id in range(args.shutters))
+
+    def replay(sent):
+        for event in range(args.events):
+            shutter_id = event % args.shutters
+            local_states[shutter_id] = 'going_up' if local_states[shutter_id] != 'going_up' else 'going_down'
+            sent.add(shutter_id, local_states[shutter_id][6:], time.time())
+            plugin.handle_shutter_status(dict(local_states), None)
+            time.sleep(args.interval / 1000.0)
+        return args.events
+
+    def remote_calls(api_call, params):
+        if api_call not in ['do_shutter_up', 'do_shutter_down']:
+            return None
+        return int(params['id']), api_call[11:]
+
+    def is_in_sync(gateway):
+        return all(gateway.shutters[shutter_id]['state'] == state[6:] for shutter_id, state in local_states.items())
+
+    return run_scenario('shutter_events', plugin, gateways, args, replay, remote_calls, is_in_sync)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Syncer benchmark against stand-in remote gateways')
+    parser.add_argument('--gateways', type=int, default=4, help='remote gateways')
+    parser.add_argument('--outputs', type=int, default=20, help='mapped outputs per gateway')
+    parser.add_argument('--inputs', type=int, default=20, help='mapped inputs per gateway')
+    parser.add_argument('--shutters', type=int, default=4, help='mapped shutters per gateway')
+    parser.add_argument('--sensors', type=int, default=4, help='mapped sensors per gateway')
+    parser.add_argument('--events', type=int, default=500, help='events per scenario')
+    parser.add_argument('--interval', type=float, default=2, help='time between the events in ms')
+    parser.add_argument('--latency', type=float, default=5, help='latency of every remote call in ms')
+    parser.add_argument('--jitter', type=float, default=0, help='random extra latency of up to this many ms')
+    parser.add_argument('--failure-rate', type=float, default=0, help='fraction of the remote calls that fail')
+    parser.add_argument('--peer-syncer', action='store_true', help='the remote gateways run a Syncer as well')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    # the Syncer doesn't verify the certificates of the GWs
+    warnings.filterwarnings('ignore', message='Unverified HTTPS request')
+    certificate_dir, cert_file, key_file = create_certificate()
+    gateways = start_gateways(args.gateways, certificate=(cert_file, key_file), outputs=args.outputs,
+                              inputs=args.inputs, shutters=args.shutters, sensors=args.sensors,
+                              latency=args.latency / 1000.0, jitter=args.jitter / 1000.0,
+                              failure_rate=args.failure_rate)
+    web = FakeWebinterface(args.outputs, args.inputs, args.shutters)
+    connector = FakeConnector()
+    start_rss = get_rss()
+    plugin, startup, startup_calls = start_syncer(args, gateways, web, connector)
+
+    print('Syncer {0}: {1} gateways with {2} outputs, {3} inputs, {4} shutters and {5} sensors, {6} ms latency, '
+          '{7:.0%} failures, RSS {8} KiB after start ({9:+d} KiB)'.format(
+              plugin.version, args.gateways, args.outputs, args.inputs, args.shutters, args.sensors, args.latency,
+              args.failure_rate, get_rss(), get_rss() - start_rss))
+    print('Startup calls: {0}'.format(', '.join('{0} {1}'.format(api_call, count)
+                                                for api_call, count in sorted(startup_calls.items()))))
+    scenarios = {'output_events': lambda: output_events(plugin, web, gateways, args),
+                 'input_events': lambda: input_events(plugin, web, gateways, args),
+                 'shutter_events': lambda: shutter_events(plugin, web, gateways, args)}
+    results = [startup]
+    for name in args.scenarios.split(','):
+        results.append(scenarios[name.strip()]())
+    print_results(results, columns=COLUMNS)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({'arguments': vars(args), 'version': plugin.version, 'startup_calls': startup_calls,
+                       'results': results}, output, indent=4)
+    for gateway in plugin._gateways.values():
+        gateway['worker'].stop()
+    for gateway in gateways:
+        gateway.stop()
+    remove_certificate(certificate_dir)
+    if not all(result.get('synced', True) for result in results):
+        print('Not every remote gateway ended in the local state')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
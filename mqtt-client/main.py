@@ -7,11 +7,17 @@ import six
 import sys
 import os
 import re
+import ssl
+import math
+import socket
 import time
+import struct
+import hashlib
 from datetime import datetime
 import pytz
 import json
-from threading import Thread
+from collections import deque, OrderedDict
+from threading import Thread, Lock, Condition
 from plugins.base import om_expose, input_status, output_status, OMPluginBase, PluginConfigChecker, receive_events, om_metric_receive, background_task
 import logging
 
@@ -22,11 +28,432 @@ try:
         sys.path.insert(0, lib_path)
 
     import paho.mqtt.client as client
+    from paho.mqtt.properties import Properties
+    from paho.mqtt.packettypes import PacketTypes
 except Exception as ex:
     raise ImportError(f"Could not import library: {ex}")
 
 logger = logging.getLogger(__name__)
 
+
+class _TopicFields(dict):
+    """
+    Topic format fields, unknown fields are filled in instead of failing the format
+    """
+
+    def __missing__(self, key):
+        return 'unknown'
+
+
+class PublishStatistics(object):
+    """
+    Keeps track of the publish pipeline: latency histograms, in flight messages, message counts and connection events
+    """
+
+    # upper bounds of the latency histogram buckets, in milliseconds
+    latency_buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+    max_tracked_messages = 1000
+
+    def __init__(self):
+        self._lock = Lock()
+        self._start = time.time()
+        self._in_flight = {}
+        self._early_acknowledgements = {}
+        self._latencies = dict((qos, {'counts': [0] * (len(PublishStatistics.latency_buckets) + 1),
+                                      'total': 0.0,
+                                      'max': 0.0})
+                               for qos in [0, 1, 2])
+        self._messages = {}
+        self._failures = {}
+        self._connects = 0
+        self._disconnects = 0
+
+    def published(self, mid, topic_class, qos):
+        now = time.time()
+        with self._lock:
+            self._messages[topic_class] = self._messages.get(topic_class, 0) + 1
+            # on_publish can be called by the network thread before publish() returned the mid
+            acknowledged = self._early_acknowledgements.pop(mid, None)
+            if acknowledged is not None:
+                self._add_latency(qos, 0.0)
+                return
+            if len(self._in_flight) >= PublishStatistics.max_tracked_messages:
+                self._in_flight.pop(next(iter(self._in_flight)))
+            self._in_flight[mid] = (now, qos)
+
+    def acknowledged(self, mid):
+        now = time.time()
+        with self._lock:
+            entry = self._in_flight.pop(mid, None)
+            if entry is None:
+                if len(self._early_acknowledgements) >= PublishStatistics.max_tracked_messages:
+                    self._early_acknowledgements.pop(next(iter(self._early_acknowledgements)))
+                self._early_acknowledgements[mid] = now
+                return
+            sent, qos = entry
+            self._add_latency(qos, (now - sent) * 1000.0)
+
+    def _add_latency(self, qos, latency):
+        histogram = self._latencies[qos]
+        index = len(PublishStatistics.latency_buckets)
+        for i, bucket in enumerate(PublishStatistics.latency_buckets):
+            if latency <= bucket:
+                index = i
+                break
+        histogram['counts'][index] += 1
+        histogram['total'] += latency
+        histogram['max'] = max(histogram['max'], latency)
+
+    def failed(self, topic_class):
+        with self._lock:
+            self._failures[topic_class] = self._failures.get(topic_class, 0) + 1
+
+    def connected(self):
+        with self._lock:
+            self._connects += 1
+
+    def disconnected(self):
+        with self._lock:
+            self._disconnects += 1
+
+    def get_statistics(self):
+        with self._lock:
+            in_flight = [qos for _, qos in self._in_flight.values()]
+            latencies = {}
+            for qos, histogram in self._latencies.items():
+                count = sum(histogram['counts'])
+                latencies['qos{0}'.format(qos)] = {'buckets': PublishStatistics.latency_buckets + ['inf'],
+                                                   'counts': list(histogram['counts']),
+                                                   'count': count,
+                                                   'mean': round(histogram['total'] / count, 3) if count else None,
+                                                   'max': round(histogram['max'], 3)}
+            return {'uptime': int(time.time() - self._start),
+                    'connects': self._connects,
+                    'reconnects': max(0, self._connects - 1),
+                    'disconnects': self._disconnects,
+                    'in_flight': {'qos1': in_flight.count(1),
+                                  'qos2': in_flight.count(2)},
+                    'messages': dict(self._messages),
+                    'failures': dict(self._failures),
+                    'latency': latencies}
+
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel, scheduling a large amount of short timers (e.g. for debouncing) on a single thread.
+    Scheduling a timer for a key replaces the pending timer of that key.
+    """
+
+    def __init__(self, tick=0.01, slots=512):
+        self._tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._timers = {}
+        self._current_tick = 0
+        self._start = time.time()
+        # the tick the thread sleeps until, None while there are no timers
+        self._wakeup = None
+        self._condition = Condition()
+        self._thread = Thread(target=self._run)
+        self._thread.setName('MQTTClient timer wheel')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def schedule(self, key, delay, callback):
+        with self._condition:
+            if not self._timers:
+                # the wheel was idle, align it with the current time
+                self._start = time.time() - self._current_tick * self._tick
+            deadline = self._current_tick + max(1, int(math.ceil(delay / self._tick)))
+            self._timers[key] = deadline
+            self._slots[deadline % len(self._slots)].append((deadline, key, callback))
+            if self._wakeup is None or deadline < self._wakeup:
+                self._condition.notify()
+
+    def _run(self):
+        while True:
+            callbacks = []
+            with self._condition:
+                while not self._timers:
+                    self._wakeup = None
+                    self._condition.wait()
+                # sleep until the first deadline, a timer that expires earlier wakes the wheel up
+                self._wakeup = min(self._timers.values())
+                timeout = self._start + self._wakeup * self._tick - time.time()
+                if timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
+                elapsed_ticks = int((time.time() - self._start) / self._tick)
+                # a slot holds the deadlines of every round, after a long sleep each slot is checked once
+                first_tick = max(self._current_tick + 1, elapsed_ticks - len(self._slots) + 1)
+                for tick in range(first_tick, elapsed_ticks + 1):
+                    slot = self._slots[tick % len(self._slots)]
+                    if not slot:
+                        continue
+                    pending = []
+                    for deadline, key, callback in slot:
+                        if deadline > elapsed_ticks:
+                            pending.append((deadline, key, callback))
+                        elif self._timers.get(key) == deadline:
+                            del self._timers[key]
+                            callbacks.append(callback)
+                    slot[:] = pending
+                self._current_tick = max(self._current_tick, elapsed_ticks)
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception('Error executing timer')
+
+
+class TokenBucket(object):
+    """
+    Token bucket limiting the rate of messages, with a small burst allowance
+    """
+
+    def __init__(self, rate, burst=None):
+        self._rate = float(rate)
+        self._burst = float(burst if burst is not None else max(1, rate))
+        self._tokens = self._burst
+        self._last = time.time()
+
+    def consume(self):
+        while True:
+            now = time.time()
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            time.sleep((1 - self._tokens) / self._rate)
+
+
+class ResumableSSLContext(ssl.SSLContext):
+    """
+    SSL context that resumes the TLS session of the previous connection, saving a full handshake on a reconnect
+    """
+
+    _session = None
+
+    def remember_session(self, sock):
+        session = getattr(sock, 'session', None)
+        if session is not None:
+            self._session = session
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if self._session is not None:
+            try:
+                return super(ResumableSSLContext, self).wrap_socket(sock, *args, session=self._session, **kwargs)
+            except ValueError:
+                # the session can't be used (anymore), fall back to a full handshake
+                self._session = None
+        return super(ResumableSSLContext, self).wrap_socket(sock, *args, **kwargs)
+
+
+class BrokerConnection(object):
+    """
+    Connection to one MQTT broker. Every message is built once by the plugin and published to each connection,
+    which applies its own topic prefix and QoS. The connection is passed as userdata to the paho callbacks.
+    """
+
+    connection_keys = ['hostname', 'port', 'username', 'password', 'protocol', 'client_id', 'persistent_session',
+                       'keepalive', 'reconnect_max_delay', 'tls_enabled', 'tls_ca_certs', 'tls_insecure']
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.settings = settings
+        self.protocol = settings['protocol']
+        self.client = None
+        self.ssl_context = None
+        self.subscribed_topic = None
+        self.statistics = PublishStatistics()
+        self.topic_aliases = {}
+        self.topic_alias_maximum = 0
+        self.topic_alias_lock = Lock()
+        self.republish_generation = 0
+        self.retained_probe = None
+        self.retained_probe_condition = Condition()
+        # the topic filters subscribed by a retained probe, a persistent session might still have them
+        self.probe_filters = set()
+        self.configure(settings)
+
+    def configure(self, settings):
+        """ Applies the settings that don't need a new connection """
+        self.settings = settings
+        self.primary = settings.get('primary', False)
+        self.topic_prefix = settings.get('topic_prefix') or ''
+        self.qos = settings.get('qos')
+        self.priority = settings.get('priority', 0)
+
+    def has_connection_settings(self, settings):
+        return all(self.settings.get(key) == settings.get(key) for key in BrokerConnection.connection_keys)
+
+    def is_connected(self):
+        mqtt_client = self.client
+        return mqtt_client is not None and mqtt_client.is_connected()
+
+    def connect(self, on_connect, on_disconnect, on_message, on_publish):
+        settings = self.settings
+        if self.protocol == client.MQTTv5:
+            self.client = client.Client(client_id=settings['client_id'], userdata=self, protocol=self.protocol)
+        else:
+            self.client = client.Client(client_id=settings['client_id'],
+                                        clean_session=not settings['persistent_session'],
+                                        userdata=self,
+                                        protocol=self.protocol)
+        if settings['username'] is not None:
+            logger.info("MQTTClient is using username '{0}' and password for {1}".format(settings['username'], self.name))
+            self.client.username_pw_set(settings['username'], settings['password'])
+        if settings['tls_enabled']:
+            self.ssl_context = self._create_ssl_context()
+            self.client.tls_set_context(self.ssl_context)
+            self.client.tls_insecure_set(settings['tls_insecure'])
+        self.client.on_message = on_message
+        self.client.on_connect = on_connect
+        self.client.on_disconnect = on_disconnect
+        self.client.on_publish = on_publish
+        # lossy links: retry quickly, and don't wait too long once the broker is reachable again
+        self.client.reconnect_delay_set(min_delay=1, max_delay=settings['reconnect_max_delay'])
+        # connect in the network thread, so a slow or unreachable broker doesn't block the plugin
+        if self.protocol == client.MQTTv5:
+            properties = None
+            if settings['persistent_session']:
+                properties = Properties(PacketTypes.CONNECT)
+                properties.SessionExpiryInterval = MQTTClient.session_expiry_interval
+            self.client.connect_async(settings['hostname'], settings['port'], settings['keepalive'],
+                                      clean_start=not settings['persistent_session'],
+                                      properties=properties)
+        else:
+            self.client.connect_async(settings['hostname'], settings['port'], settings['keepalive'])
+        self.client.loop_start()
+
+    def disconnect(self):
+        try:
+            self.client.disconnect()
+            self.client.loop_stop()
+        except Exception as ex:
+            logger.exception('Error disconnecting from MQTT broker {0}'.format(self.name))
+        self.client = None
+        self.subscribed_topic = None
+
+    def _create_ssl_context(self):
+        context = ResumableSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        if self.settings['tls_ca_certs']:
+            context.load_verify_locations(cafile=self.settings['tls_ca_certs'])
+        else:
+            context.load_default_certs()
+        if self.settings['tls_insecure']:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return context
+
+    def is_probe_topic(self, topic):
+        return any(client.topic_matches_sub(topic_filter, topic) for topic_filter in self.probe_filters)
+
+    def remove_probe_subscriptions(self):
+        """ Unsubscribes the probe topic filters, in case a probe was interrupted by a disconnect """
+        for topic_filter in self.probe_filters:
+            if topic_filter != self.subscribed_topic:
+                self.client.unsubscribe(topic_filter)
+
+    def update_subscription(self, topic):
+        if not self.is_connected():
+            return
+        if self.subscribed_topic == topic:
+            return
+        try:
+            if self.subscribed_topic:
+                self.client.unsubscribe(self.subscribed_topic)
+                logger.info('Unsubscribed from {0} on {1}'.format(self.subscribed_topic, self.name))
+            self.subscribed_topic = None
+            if topic:
+                # QoS 1, so the broker queues commands for a persistent session while the plugin is disconnected
+                self.client.subscribe(topic, qos=1)
+                self.subscribed_topic = topic
+                logger.info('Subscribed to {0} on {1}'.format(topic, self.name))
+        except Exception as ex:
+            logger.exception('Could not subscribe')
+
+    def publish(self, topic, payload, qos, retain, properties, topic_class):
+        topic = self.topic_prefix + topic
+        if self.qos is not None:
+            qos = self.qos
+        try:
+            if properties is not None and qos == 0 and topic_class in MQTTClient.alias_topic_classes:
+                message_info = self._publish_with_alias(topic, payload, retain, properties)
+            else:
+                message_info = self.client.publish(topic, payload=payload, qos=qos, retain=retain, properties=properties)
+            if message_info.rc == client.MQTT_ERR_SUCCESS:
+                self.statistics.published(message_info.mid, topic_class, qos)
+            else:
+                self.statistics.failed(topic_class)
+        except Exception as ex:
+            self.statistics.failed(topic_class)
+            logger.exception('Error sending data to broker {0}'.format(self.name))
+
+    def _publish_with_alias(self, topic, payload, retain, properties):
+        # Only QoS 0 messages are aliased: aliases are only valid for one connection, while paho resends queued
+        # QoS 1/2 messages after a reconnect. The lock makes sure a topic is sent with its alias before it is
+        # replaced by an empty topic.
+        with self.topic_alias_lock:
+            alias = self.topic_aliases.get(topic)
+            if alias is not None:
+                properties.TopicAlias = alias
+                return self.client.publish('', payload=payload, qos=0, retain=retain, properties=properties)
+            if len(self.topic_aliases) < self.topic_alias_maximum and self.client.is_connected():
+                alias = len(self.topic_aliases) + 1
+                self.topic_aliases[topic] = alias
+                properties.TopicAlias = alias
+            return self.client.publish(topic, payload=payload, qos=0, retain=retain, properties=properties)
+
+
+def _cbor_head(major_type, length):
+    if length < 24:
+        return struct.pack('>B', major_type << 5 | length)
+    if length < 0x100:
+        return struct.pack('>BB', major_type << 5 | 24, length)
+    if length < 0x10000:
+        return struct.pack('>BH', major_type << 5 | 25, length)
+    if length < 0x100000000:
+        return struct.pack('>BI', major_type << 5 | 26, length)
+    return struct.pack('>BQ', major_type << 5 | 27, length)
+
+
+def cbor_dumps(value):
+    """
+    Minimal CBOR (RFC 8949) encoder for the JSON-like structures used in snapshot payloads
+    """
+    if value is None:
+        return b'\xf6'
+    if value is True:
+        return b'\xf5'
+    if value is False:
+        return b'\xf4'
+    if isinstance(value, six.integer_types):
+        if value >= 0:
+            return _cbor_head(0, value)
+        return _cbor_head(1, -1 - value)
+    if isinstance(value, float):
+        # Use single precision when it is lossless, most energy values are 32 bit floats anyway
+        try:
+            packed = struct.pack('>f', value)
+            if struct.unpack('>f', packed)[0] == value:
+                return b'\xfa' + packed
+        except OverflowError:
+            # out of the single precision range
+            pass
+        return b'\xfb' + struct.pack('>d', value)
+    if isinstance(value, six.text_type):
+        data = value.encode('utf-8')
+        return _cbor_head(3, len(data)) + data
+    if isinstance(value, bytes):
+        return _cbor_head(2, len(value)) + value
+    if isinstance(value, (list, tuple)):
+        return _cbor_head(4, len(value)) + b''.join(cbor_dumps(item) for item in value)
+    if isinstance(value, dict):
+        return _cbor_head(5, len(value)) + b''.join(cbor_dumps(key) + cbor_dumps(item) for key, item in value.items())
+    raise TypeError('Cannot CBOR encode {0}'.format(type(value).__name__))
+
+
 class MQTTClient(OMPluginBase):
     """
     An MQTT client plugin for sending/receiving data to/from an MQTT broker.
@@ -34,7 +461,7 @@ class MQTTClient(OMPluginBase):
     """
 
     name = 'MQTTClient'
-    version = '3.0.4'
+    version = '3.0.24'
     interfaces = [('config', '1.0')]
 
     energy_module_config = {
@@ -43,6 +470,16 @@ class MQTTClient(OMPluginBase):
         12: 12
     }
 
+    event_buffer_size = 50
+    session_expiry_interval = 7 * 24 * 3600
+
+    # MQTT 5: static metadata that is sent as user properties instead of in the payload
+    metadata_fields = ['name', 'unit', 'external_id', 'physical_quantity', 'source']
+    metadata_topic_classes = ['input', 'output', 'sensor', 'power', 'energy']
+    # MQTT 5: topic classes that get a topic alias (high frequency) and expire (telemetry)
+    alias_topic_classes = ['output', 'sensor', 'power', 'energy', 'metrics']
+    telemetry_topic_classes = ['sensor', 'power', 'energy', 'metrics']
+
     config_description = [
         {'name': 'hostname',
          'type': 'str',
@@ -56,6 +493,56 @@ class MQTTClient(OMPluginBase):
         {'name': 'password',
          'type': 'password',
          'description': 'MQTT broker password'},
+        {'name': 'client_id',
+         'type': 'str',
+         'description': 'MQTT client id. Default: openmotics-<gateway hostname>'},
+        {'name': 'persistent_session',
+         'type': 'bool',
+         'description': 'Keep the session on the broker, so subscriptions and queued QoS 1 commands survive a reconnect.'},
+        {'name': 'keepalive',
+         'type': 'int',
+         'description': 'Keepalive interval in seconds. Default: 30'},
+        {'name': 'reconnect_max_delay',
+         'type': 'int',
+         'description': 'Maximum delay in seconds between two reconnect attempts. Default: 30'},
+        {'name': 'tls_enabled',
+         'type': 'bool',
+         'description': 'Connect to the broker using TLS.'},
+        {'name': 'tls_ca_certs',
+         'type': 'str',
+         'description': 'Path to the CA certificates file. Leave empty to use the system certificates.'},
+        {'name': 'tls_insecure',
+         'type': 'bool',
+         'description': 'Do not verify the broker certificate and hostname.'},
+        {'name': 'protocol',
+         'type': 'enum',
+         'choices': ['3.1.1', '5'],
+         'description': 'MQTT protocol version. Default: 3.1.1'},
+        {'name': 'message_expiry',
+         'type': 'int',
+         'description': 'MQTT 5 only: expiry interval in seconds of sensor, power, energy and metrics messages. Default: 0 (twice the poll frequency)'},
+        # additional brokers
+        {'name': 'brokers',
+         'type': 'section',
+         'description': 'Additional brokers that get the same messages. Brokers with a priority above 0 form a failover chain, only the connected one with the lowest priority gets the messages.',
+         'repeat': True,
+         'min': 0,
+         'content': [{'name': 'name', 'type': 'str'},
+                     {'name': 'hostname', 'type': 'str'},
+                     {'name': 'port', 'type': 'int'},
+                     {'name': 'username', 'type': 'str'},
+                     {'name': 'password', 'type': 'password'},
+                     {'name': 'tls_enabled', 'type': 'bool'},
+                     {'name': 'topic_prefix', 'type': 'str'},
+                     {'name': 'qos', 'type': 'enum', 'choices': ['default', '0', '1', '2']},
+                     {'name': 'priority', 'type': 'int'}]},
+        # republish
+        {'name': 'republish_rate',
+         'type': 'int',
+         'description': 'Maximum amount of messages per second to republish the complete state after (re)connecting to the broker. Default: 20, 0 to disable'},
+        {'name': 'republish_check_retained',
+         'type': 'bool',
+         'description': 'Skip the republish of retained state messages that are still correct on the broker.'},
         # input status
         {'name': 'input_status_enabled',
          'type': 'bool',
@@ -70,6 +557,23 @@ class MQTTClient(OMPluginBase):
         {'name': 'input_status_retain',
          'type': 'bool',
          'description': 'Input status message retain.'},
+        {'name': 'input_status_debounce',
+         'type': 'int',
+         'description': 'Time in milliseconds an input must be stable before its status is published. Default: 0 (disabled)'},
+        {'name': 'input_status_rate_limit',
+         'type': 'int',
+         'description': 'Minimal time in milliseconds between two status messages of an input. Default: 0 (disabled)'},
+        {'name': 'input_status_aggregate',
+         'type': 'bool',
+         'description': 'Publish a debounced or rate limited burst of input events as one message with the amount of events.'},
+        {'name': 'input_status_filters',
+         'type': 'section',
+         'description': 'Debounce and rate limit (in milliseconds) for specific inputs.',
+         'repeat': True,
+         'min': 0,
+         'content': [{'name': 'input_id', 'type': 'int'},
+                     {'name': 'debounce', 'type': 'int'},
+                     {'name': 'rate_limit', 'type': 'int'}]},
         # output status
         {'name': 'output_status_enabled',
          'type': 'bool',
@@ -149,25 +653,80 @@ class MQTTClient(OMPluginBase):
         {'name': 'energy_status_poll_frequency',
         'type': 'int',
         'description': 'Polling frequency for energy status in seconds. Default: 3600 (1 hour), minimum: 10'},
+        # metrics bridge
+        {'name': 'metrics_bridge_enabled',
+         'type': 'bool',
+         'description': 'Publish the gateway metric stream instead of polling sensor, power and energy data.'},
+        {'name': 'metrics_topic_format',
+         'type': 'str',
+         'description': 'Metrics topic format, all metric tags can be used. Default: openmotics/metrics/{type}/{id}'},
+        {'name': 'metrics_qos',
+         'type': 'enum',
+         'choices': ['0', '1', '2'],
+         'description': 'Metrics quality of service. Default: 0'},
+        {'name': 'metrics_retain',
+         'type': 'bool',
+         'description': 'Metrics retain.'},
+        {'name': 'metrics_min_interval',
+         'type': 'int',
+         'description': 'Minimal interval in seconds between two metrics on the same topic. Default: 5'},
+        {'name': 'metrics_rate_limits',
+         'type': 'section',
+         'description': 'Minimal interval in seconds between two metrics on the same topic, for a specific metric type.',
+         'repeat': True,
+         'min': 0,
+         'content': [{'name': 'metric_type', 'type': 'str'},
+                     {'name': 'min_interval', 'type': 'int'}]},
+        # snapshots
+        {'name': 'snapshot_format',
+         'type': 'enum',
+         'choices': ['disabled', 'json', 'cbor'],
+         'description': 'Publish one snapshot message per poll for sensor, power and energy data instead of one message per sensor. Default: disabled'},
+        {'name': 'snapshot_topic_format',
+         'type': 'str',
+         'description': 'Snapshot topic format, the schema is published retained on <topic>/schema. Default: openmotics/{type}/snapshot'},
         # output command
         {'name': 'output_command_topic',
          'type': 'str',
          'description': 'Topic to subscribe to for output command messages. Leave empty to turn off.'},
+        {'name': 'output_command_max_rate',
+         'type': 'int',
+         'description': 'Maximum amount of commands per second that are executed for one output, intermediate values are skipped. Default: 5'},
         # logging
         {'name': 'logging_topic',
          'type': 'str',
          'description': 'Topic for logging messages. Leave empty to turn off.'},
+        # diagnostics
+        {'name': 'stats_topic',
+         'type': 'str',
+         'description': 'Topic for publish statistics. Leave empty to turn off. Example: openmotics/$SYS/mqttclient'},
+        {'name': 'stats_interval',
+         'type': 'int',
+         'description': 'Interval in seconds to publish statistics. Default: 300, minimum: 60'},
         # timestamp timezone
         {'name': 'timezone',
          'type': 'str',
-         'description': 'Timezone. Default: UTC. Example: Europe/Brussels'}
+         'description': 'Timezone. Default: UTC. Example: Europe/Brussels'},
+        # configuration refresh
+        {'name': 'configuration_refresh_interval',
+         'type': 'int',
+         'description': 'Interval in seconds to check for input, output, sensor and power configuration changes. Default: 300, minimum: 60, 0 to disable'}
     ]
 
     default_config = {
         'port': 1883,
         'username': 'openmotics',
+        'persistent_session': True,
+        'keepalive': 30,
+        'reconnect_max_delay': 30,
+        'protocol': '3.1.1',
+        'message_expiry': 0,
+        'republish_rate': 20,
+        'republish_check_retained': True,
         'input_status_topic_format': 'openmotics/input/{id}/state',
         'input_status_qos': 0,
+        'input_status_debounce': 0,
+        'input_status_rate_limit': 0,
         'output_status_topic_format': 'openmotics/output/{id}/state',
         'output_status_qos': 0,
         'event_status_topic_format': 'openmotics/event/{id}/state',
@@ -181,9 +740,17 @@ class MQTTClient(OMPluginBase):
         'energy_status_topic_format': 'openmotics/energy/{module_id}/{sensor_id}/state',
         'energy_status_qos': 0,
         'energy_status_poll_frequency': 3600,
+        'metrics_topic_format': 'openmotics/metrics/{type}/{id}',
+        'metrics_qos': 0,
+        'metrics_min_interval': 5,
+        'snapshot_format': 'disabled',
+        'snapshot_topic_format': 'openmotics/{type}/snapshot',
         'output_command_topic': 'openmotics/output/+/set',
+        'output_command_max_rate': 5,
         'logging_topic': 'openmotics/logging',
-        'timezone': 'UTC'
+        'stats_interval': 300,
+        'timezone': 'UTC',
+        'configuration_refresh_interval': 300
     }
 
     def __init__(self, webinterface, connector):
@@ -196,17 +763,41 @@ class MQTTClient(OMPluginBase):
         #logger.info("Default configuration '{0}'".format(self._config))
         self._config_checker = PluginConfigChecker(MQTTClient.config_description)
 
-        self.client = None
+        self._connections = {}
+        self._failover_active = None
+        self._failover_lock = Lock()
         self._sensor_config = {}
         self._inputs = {}
         self._outputs = {}
         self._sensors = {}
         self._power_modules = {}
+        self._entity_hashes = {}
+        self._entity_settings = {}
+        # the configuration loader, the refresh and a configuration change all update the entity tables
+        self._configuration_lock = Lock()
+        self._snapshot_schemas = {}
+        # configuration is loaded in the background, each entity type goes live as soon as it is loaded
+        self._ready = {'input': False,
+                       'output': False,
+                       'sensor': False,
+                       'power': False}
+        self._configuration_generation = 0
+        # events for entities that are not yet known are held until their configuration is loaded
+        self._buffered_events = deque(maxlen=MQTTClient.event_buffer_size)
+        self._buffered_events_lock = Lock()
+        self._timer_wheel = TimerWheel()
+        self._input_filter_lock = Lock()
+        self._input_bursts = {}
+        self._input_published = {}
+        self._output_commands = {}
+        self._output_commands_executed = {}
+        self._output_commands_condition = Condition()
+        self._state_cache = {}
 
         self._read_config()
         self._try_connect()
 
-        self._load_configuration()
+        self._start_configuration_loader()
 
         logger.info("Started MQTTClient plugin")
 
@@ -216,11 +807,33 @@ class MQTTClient(OMPluginBase):
         self._port     = self._config.get('port')
         self._username = self._config.get('username')
         self._password = self._config.get('password')
+        self._protocol = client.MQTTv5 if self._config.get('protocol') == '5' else client.MQTTv311
+        self._message_expiry = int(self._config.get('message_expiry', 0))
+        self._client_id = self._config.get('client_id') or 'openmotics-{0}'.format(socket.gethostname())
+        self._persistent_session = self._config.get('persistent_session', True)
+        self._keepalive = int(self._config.get('keepalive', 30))
+        self._reconnect_max_delay = max(1, int(self._config.get('reconnect_max_delay', 30)))
+        self._tls_enabled = self._config.get('tls_enabled', False)
+        self._tls_ca_certs = self._config.get('tls_ca_certs')
+        self._tls_insecure = self._config.get('tls_insecure', False)
+        # republish
+        self._republish_rate = int(self._config.get('republish_rate', 20))
+        self._republish_check_retained = self._config.get('republish_check_retained', True)
         # inputs
         self._input_enabled = self._config.get('input_status_enabled')
         self._input_topic   = self._config.get('input_status_topic_format')
         self._input_qos     = int(self._config.get('input_status_qos'))
         self._input_retain  = self._config.get('input_status_retain')
+        self._input_aggregate = self._config.get('input_status_aggregate', False)
+        self._input_filter_default = (int(self._config.get('input_status_debounce', 0)) / 1000.0,
+                                      int(self._config.get('input_status_rate_limit', 0)) / 1000.0)
+        self._input_filters = {}
+        for entry in self._config.get('input_status_filters', []):
+            try:
+                self._input_filters[int(entry['input_id'])] = (int(entry.get('debounce', 0)) / 1000.0,
+                                                               int(entry.get('rate_limit', 0)) / 1000.0)
+            except (KeyError, TypeError, ValueError):
+                logger.error('Skipping invalid input filter {0}'.format(entry))
         # outputs
         self._output_enabled = self._config.get('output_status_enabled')
         self._output_topic   = self._config.get('output_status_topic_format')
@@ -257,34 +870,211 @@ class MQTTClient(OMPluginBase):
         }
         self._sensor_enabled = self._sensor_config.get('sensor').get('enabled')
         self._power_enabled = (self._sensor_config.get('power').get('enabled') or self._sensor_config.get('energy').get('enabled'))
+        # metrics bridge
+        self._metrics_bridge_enabled = self._config.get('metrics_bridge_enabled', False)
+        self._metrics_topic = self._config.get('metrics_topic_format', 'openmotics/metrics/{type}/{id}')
+        self._metrics_qos = int(self._config.get('metrics_qos', 0))
+        self._metrics_retain = self._config.get('metrics_retain', False)
+        self._metrics_min_interval = int(self._config.get('metrics_min_interval', 5))
+        self._metrics_rate_limits = {}
+        for entry in self._config.get('metrics_rate_limits', []):
+            try:
+                self._metrics_rate_limits[entry['metric_type']] = int(entry['min_interval'])
+            except (KeyError, TypeError, ValueError):
+                logger.error('Skipping invalid metrics rate limit {0}'.format(entry))
+        self._metrics_last_publish = {}
+        # snapshots
+        self._snapshot_format = self._config.get('snapshot_format', 'disabled')
+        self._snapshot_topic = self._config.get('snapshot_topic_format', 'openmotics/{type}/snapshot')
+        self._snapshot_schemas = {}
         # output command
         self._output_command_topic = self._config.get('output_command_topic')
+        self._output_command_max_rate = int(self._config.get('output_command_max_rate', 5))
         # logging topic
         self._logging_topic = self._config.get('logging_topic')
+        # diagnostics
+        self._stats_topic = self._config.get('stats_topic')
+        self._stats_interval = max(60, int(self._config.get('stats_interval', 300)))
         # timezone
         self._timezone = self._config.get('timezone')
-        self._enabled = self._hostname is not None and self._port is not None
+        # configuration refresh
+        self._configuration_refresh_interval = int(self._config.get('configuration_refresh_interval', 300))
+        # the entities of a type of which the topics changed are rebuilt, its events are held until then
+        entity_settings = {'input': (self._input_enabled, self._input_topic),
+                           'output': (self._output_enabled, self._output_topic),
+                           'sensor': (self._sensor_enabled, self._sensor_config['sensor']['topic']),
+                           'power': (self._power_enabled, self._sensor_config['power']['topic'], self._sensor_config['energy']['topic'])}
+        with self._configuration_lock:
+            for entity_type, settings in entity_settings.items():
+                if self._entity_settings.get(entity_type) != settings:
+                    self._ready[entity_type] = False
+                    self._entity_hashes.pop(entity_type, None)
+            self._entity_settings = entity_settings
+        self._state_cache = {}
+        # brokers
+        self._broker_settings = self._get_broker_settings()
+        self._enabled = len(self._broker_settings) > 0
         logger.info('MQTTClient is {0}'.format('enabled' if self._enabled else 'disabled'))
 
-    def _load_configuration(self):
-        inputs_loaded  = False
-        outputs_loaded = False
-        sensors_loaded = False
-        power_loaded   = False
-        should_load = True
-
-        while should_load:
-            if not inputs_loaded:
-                inputs_loaded = self._load_input_configuration()
-            if not outputs_loaded:
-                outputs_loaded = self._load_output_configuration()
-            if not sensors_loaded:
-                sensors_loaded = self._load_sensor_configuration()
-            if not power_loaded:
-                power_loaded = self._load_power_configuration()
-            should_load = not all([inputs_loaded, outputs_loaded, sensors_loaded, power_loaded])
-            if should_load:
-                time.sleep(15)
+    def _get_broker_settings(self):
+        main_settings = {'hostname': self._hostname,
+                         'port': self._port,
+                         'username': self._username,
+                         'password': self._password,
+                         'protocol': self._protocol,
+                         'client_id': self._client_id,
+                         'persistent_session': self._persistent_session,
+                         'keepalive': self._keepalive,
+                         'reconnect_max_delay': self._reconnect_max_delay,
+                         'tls_enabled': self._tls_enabled,
+                         'tls_ca_certs': self._tls_ca_certs,
+                         'tls_insecure': self._tls_insecure}
+        broker_settings = OrderedDict()
+        if self._hostname is not None and self._port is not None:
+            # the main broker always gets all messages, and handles the output commands
+            broker_settings['main'] = dict(main_settings, primary=True)
+        for entry in self._config.get('brokers', []):
+            if not entry.get('hostname'):
+                continue
+            settings = dict(main_settings,
+                            hostname=entry['hostname'],
+                            port=int(entry.get('port') or 1883),
+                            username=entry.get('username') or None,
+                            password=entry.get('password') or None,
+                            tls_enabled=entry.get('tls_enabled', False),
+                            topic_prefix=entry.get('topic_prefix') or '',
+                            qos=None if entry.get('qos', 'default') == 'default' else int(entry['qos']),
+                            priority=max(0, int(entry.get('priority') or 0)))
+            name = entry.get('name') or '{0}:{1}'.format(settings['hostname'], settings['port'])
+            while name in broker_settings:
+                name = '{0}_'.format(name)
+            # a broker disconnects a client when another one connects with the same id, and the persistent sessions
+            # of the connections must not get mixed up, so every connection has its own id
+            settings['client_id'] = '{0}-{1}'.format(self._client_id, name)
+            broker_settings[name] = settings
+        return broker_settings
+
+    def _start_configuration_loader(self):
+        self._configuration_generation += 1
+        thread = Thread(target=self._load_configuration, args=(self._configuration_generation,))
+        thread.setName('MQTTClient configuration loader')
+        thread.daemon = True
+        thread.start()
+
+    def _load_configuration(self, generation):
+        loaders = {'input': self._load_input_configuration,
+                   'output': self._load_output_configuration,
+                   'sensor': self._load_sensor_configuration,
+                   'power': self._load_power_configuration}
+        pending = list(loaders.keys())
+        delay = 1
+        # A newer loader (e.g. after a configuration change) takes over from this one
+        while pending and generation == self._configuration_generation:
+            for entity_type in list(pending):
+                with self._configuration_lock:
+                    loaded = loaders[entity_type]()
+                    if loaded and not self._ready[entity_type]:
+                        self._ready[entity_type] = True
+                        logger.info('Configuration of {0}s loaded'.format(entity_type))
+                if loaded:
+                    pending.remove(entity_type)
+                    self._replay_buffered_events(entity_type)
+            if pending:
+                time.sleep(delay)
+                delay = min(delay * 2, 15)
+
+    def _buffer_event(self, entity_type, handler, *args):
+        with self._buffered_events_lock:
+            if entity_type == 'output':
+                # an output event contains the state of all outputs, so only the last one is relevant
+                events = [event for event in self._buffered_events if event[0] != 'output']
+                self._buffered_events.clear()
+                self._buffered_events.extend(events)
+            self._buffered_events.append((entity_type, handler, args))
+
+    def _replay_buffered_events(self, entity_type):
+        with self._buffered_events_lock:
+            events = [event for event in self._buffered_events if event[0] == entity_type]
+            if not events:
+                return
+            remaining = [event for event in self._buffered_events if event[0] != entity_type]
+            self._buffered_events.clear()
+            self._buffered_events.extend(remaining)
+        logger.info('Replaying {0} buffered {1} event(s)'.format(len(events), entity_type))
+        for _, handler, args in events:
+            handler(*args)
+
+    def _merge_entities(self, entity_type, current, configs, builder):
+        """
+        Rebuilds only the entities of which the configuration changed. A new table is returned, so the
+        caller can swap it in at once and the event handlers never see a half updated table.
+        """
+        hashes = self._entity_hashes.get(entity_type, {})
+        new_hashes = {}
+        entities = {}
+        changed = []
+        for entity_id, config in configs.items():
+            config_hash = hashlib.md5(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+            entity = current.get(entity_id)
+            if entity is None or hashes.get(entity_id) != config_hash:
+                new_entity = builder(entity_id, config)
+                if new_entity is None:
+                    continue
+                if entity is not None:
+                    # keep the runtime state of the entity
+                    for key in ['status', 'dimmer']:
+                        if key in entity:
+                            new_entity.setdefault(key, entity[key])
+                entity = new_entity
+                changed.append(entity_id)
+            new_hashes[entity_id] = config_hash
+            entities[entity_id] = entity
+        removed = [entity_id for entity_id in current if entity_id not in entities]
+        self._entity_hashes[entity_type] = new_hashes
+        if changed or removed:
+            logger.info('Configuring {0} {1}(s): {2} changed, {3} removed'.format(len(entities), entity_type, len(changed), len(removed)))
+        return entities, set(entity_id for entity_id in changed if entity_id not in current)
+
+    def _build_input(self, input_id, config):
+        return {'name': config['name'],
+                'topic': self._input_topic.format(id=input_id)}
+
+    def _build_output(self, output_id, config):
+        return {'name': config['name'],
+                'module_type': {'o': 'output',
+                                'O': 'output',
+                                'd': 'dimmer',
+                                'D': 'dimmer'}[config['module_type']],
+                'type': 'relay' if config['type'] == 0 else 'light',
+                'topic': self._output_topic.format(id=output_id)}
+
+    def _build_sensor(self, sensor_id, config):
+        return {'name': config['name'],
+                'external_id': str(config['external_id']),
+                'physical_quantity': str(config['physical_quantity']),
+                'source': config.get('source'),
+                'unit': config.get('unit'),
+                'topic': self._sensor_config['sensor']['topic'].format(id=sensor_id)}
+
+    def _build_power_module(self, module_id, module):
+        version = int(module['version'])
+        input_count = MQTTClient.energy_module_config.get(version, 0)
+        if input_count == 0:
+            logger.warning('Warning: Skipping energy module {0}, version {1} is currently not supported by this plugin. Only versions: {2}'.format(
+                module_id,
+                version,
+                ', '.join(str(v) for v in MQTTClient.energy_module_config.keys())))
+            return None
+        logger.info('Configuring energy module {0} (version {1}) with {2} inputs'.format(module_id, version, input_count))
+        module_config = {}
+        for input_id in range(0, input_count):
+            module_config[input_id] = {'name':         module['input{0}'.format(input_id)],
+                                       'sensor':       module['sensor{0}'.format(input_id)],
+                                       'times':        module['times{0}'.format(input_id)],
+                                       'inverted':     module['inverted{0}'.format(input_id)],
+                                       'power_topic':  self._sensor_config['power']['topic'].format(module_id=module_id, sensor_id=input_id),
+                                       'energy_topic': self._sensor_config['energy']['topic'].format(module_id=module_id, sensor_id=input_id)}
+        return module_config
 
     def _load_input_configuration(self):
         input_config_loaded = True
@@ -293,34 +1083,32 @@ class MQTTClient(OMPluginBase):
                 result = json.loads(self.webinterface.get_input_configurations())
                 if result['success'] is False:
                     logger.error('Failed to load input configurations')
-                    input_config_loaded = False
-                else:
-                    ids = []
-                    for config in result['config']:
-                        input_id = config['id']
-                        ids.append(input_id)
-                        self._inputs[input_id] = config
-                    for input_id in self._inputs.keys():
-                        if input_id not in ids:
-                            del self._inputs[input_id]
-                    logger.info('Configuring {0} inputs'.format(len(ids)))
+                    return False
+                configs = dict((config['id'], config) for config in result['config'])
+                inputs, added = self._merge_entities('input', self._inputs, configs, self._build_input)
             except Exception as ex:
                 logger.exception('Error while loading input configurations')
-                input_config_loaded = False
-            try:
-                result = json.loads(self.webinterface.get_input_status())
-                if result['success'] is False:
-                    logger.error('Failed to get input status')
+                return False
+            if added:
+                try:
+                    result = json.loads(self.webinterface.get_input_status())
+                    if result['success'] is False:
+                        logger.error('Failed to get input status')
+                        input_config_loaded = False
+                    else:
+                        for input_data in result['status']:
+                            input_id = input_data['id']
+                            if input_id not in added:
+                                continue
+                            inputs[input_id]['status'] = input_data['status']
+                except Exception as ex:
+                    logger.exception('Error getting input status')
                     input_config_loaded = False
-                else:
-                    for input_data in result['status']:
-                        input_id = input_data['id']
-                        if input_id not in self._inputs:
-                            continue
-                        self._inputs[input_id]['status'] = input_data['status']
-            except Exception as ex:
-                logger.exception('Error getting input status')
-                input_config_loaded = False
+            if input_config_loaded:
+                self._inputs = inputs
+            else:
+                # make sure the new inputs are built again on the next attempt
+                self._entity_hashes.pop('input', None)
         return input_config_loaded
 
     def _load_output_configuration(self):
@@ -329,43 +1117,34 @@ class MQTTClient(OMPluginBase):
             try:
                 result = json.loads(self.webinterface.get_output_configurations())
                 if result['success'] is False:
-                    output_config_loaded = False
                     logger.error('Failed to load output configurations')
-                else:
-                    ids = []
-                    for config in result['config']:
-                        if config['module_type'] not in ['o', 'O', 'd', 'D']:
-                            continue
-                        output_id = config['id']
-                        ids.append(output_id)
-                        self._outputs[output_id] = {'name': config['name'],
-                                                    'module_type': {'o': 'output',
-                                                                    'O': 'output',
-                                                                    'd': 'dimmer',
-                                                                    'D': 'dimmer'}[config['module_type']],
-                                                    'type': 'relay' if config['type'] == 0 else 'light'}
-                    for output_id in self._outputs.keys():
-                        if output_id not in ids:
-                            del self._outputs[output_id]
-                    logger.info('Configuring {0} outputs'.format(len(ids)))
+                    return False
+                configs = dict((config['id'], config) for config in result['config']
+                               if config['module_type'] in ['o', 'O', 'd', 'D'])
+                outputs, added = self._merge_entities('output', self._outputs, configs, self._build_output)
             except Exception as ex:
-                output_config_loaded = False
                 logger.exception('Error while loading output configurations')
-            try:
-                result = json.loads(self.webinterface.get_output_status())
-                if result['success'] is False:
+                return False
+            if added:
+                try:
+                    result = json.loads(self.webinterface.get_output_status())
+                    if result['success'] is False:
+                        output_config_loaded = False
+                        logger.error('Failed to get output status')
+                    else:
+                        for output in result['status']:
+                            output_id = output['id']
+                            if output_id not in added:
+                                continue
+                            outputs[output_id]['status'] = output['status']
+                            outputs[output_id]['dimmer'] = output['dimmer']
+                except Exception as ex:
                     output_config_loaded = False
-                    logger.error('Failed to get output status')
-                else:
-                    for output in result['status']:
-                        output_id = output['id']
-                        if output_id not in self._outputs:
-                            continue
-                        self._outputs[output_id]['status'] = output['status']
-                        self._outputs[output_id]['dimmer'] = output['dimmer']
-            except Exception as ex:
-                output_config_loaded = False
-                logger.exception('Error getting output status')
+                    logger.exception('Error getting output status')
+            if output_config_loaded:
+                self._outputs = outputs
+            else:
+                self._entity_hashes.pop('output', None)
         return output_config_loaded
 
     def _load_sensor_configuration(self):
@@ -377,19 +1156,8 @@ class MQTTClient(OMPluginBase):
                     sensor_config_loaded = False
                     logger.error('Failed to load sensor configurations: {0}'.format(result.get('msg')))
                 else:
-                    ids = []
-                    for config in result['config']:
-                        sensor_id = config['id']
-                        ids.append(sensor_id)
-                        self._sensors[sensor_id] = {'name': config['name'],
-                                                    'external_id': str(config['external_id']),
-                                                    'physical_quantity': str(config['physical_quantity']),
-                                                    'source': config.get('source'),
-                                                    'unit': config.get('unit')}
-                    for sensor_id in self._sensors.keys():
-                        if sensor_id not in ids:
-                            del self._sensors[sensor_id]
-                    logger.info('Configuring {0} sensors'.format(len(ids)))
+                    configs = dict((config['id'], config) for config in result['config'])
+                    self._sensors, _ = self._merge_entities('sensor', self._sensors, configs, self._build_sensor)
             except Exception as ex:
                 sensor_config_loaded = False
                 logger.exception('Error while loading sensor configurations')
@@ -404,69 +1172,149 @@ class MQTTClient(OMPluginBase):
                     power_config_loaded = False
                     logger.error('Failed to load power configurations: {0}'.format(result.get('msg')))
                 else:
-                    ids = []
-                    for module in result['modules']:
-                        module_id = int(module['id'])
-                        ids.append(module_id)
-                        version = int(module['version'])
-                        input_count = MQTTClient.energy_module_config.get(version, 0)
-                        module_config = {}
-                        if input_count == 0:
-                            logger.warning('Warning: Skipping energy module {0}, version {1} is currently not supported by this plugin. Only versions: {2}'.format(
-                                module_id,
-                                version,
-                                ', '.join(MQTTClient.energy_module_config.keys())))
-                            continue
-                        else:
-    	                    logger.info('Configuring energy module {0} (version {1}) with {2} inputs'.format(module_id, version, input_count))
-                        for input_id in range(0, input_count):
-                            module_config[input_id] = {'name':     module['input{0}'.format(input_id)],
-                                                       'sensor':   module['sensor{0}'.format(input_id)],
-                                                       'times':    module['times{0}'.format(input_id)],
-                                                       'inverted': module['inverted{0}'.format(input_id)]}
-                        self._power_modules[module_id] = module_config
-                    for module_id in self._power_modules.keys():
-                        if module_id not in ids:
-                            del self._power_modules[module_id]
+                    configs = dict((int(module['id']), module) for module in result['modules'])
+                    self._power_modules, _ = self._merge_entities('power', self._power_modules, configs, self._build_power_module)
             except Exception as ex:
                 power_config_loaded = False
                 logger.exception('Error while loading power configurations')
         return power_config_loaded
 
+    @background_task
+    def background_task_configuration_refresh(self):
+        loaders = {'input': self._load_input_configuration,
+                   'output': self._load_output_configuration,
+                   'sensor': self._load_sensor_configuration,
+                   'power': self._load_power_configuration}
+        while True:
+            interval = self._configuration_refresh_interval
+            if not self._enabled or interval <= 0:
+                time.sleep(60)
+                continue
+            time.sleep(max(60, interval))
+            for entity_type, loader in loaders.items():
+                # types that are not loaded yet are still handled by the configuration loader
+                with self._configuration_lock:
+                    if self._ready[entity_type]:
+                        loader()
+
     def _try_connect(self):
-        if self._enabled is True:
+        broker_settings = self._broker_settings if self._enabled else {}
+        connections = OrderedDict()
+        for name, connection in self._connections.items():
+            settings = broker_settings.get(name)
+            if settings is not None and connection.has_connection_settings(settings):
+                # the connection is not affected by the configuration change, keep the session
+                connection.configure(settings)
+                connections[name] = connection
+            else:
+                connection.disconnect()
+        for name, settings in broker_settings.items():
+            if name in connections:
+                continue
+            connection = BrokerConnection(name, settings)
             try:
-                self.client = client.Client()
-                if self._username is not None:
-                    logger.info("MQTTClient is using username '{0}' and password".format(self._username))
-                    self.client.username_pw_set(self._username, self._password)
-                self.client.on_message = self.on_message
-                self.client.on_connect = self.on_connect
-                self.client.connect(self._hostname, self._port, 5)
-                self.client.loop_start()
+                connection.connect(self.on_connect, self.on_disconnect, self.on_message, self.on_publish)
             except Exception as ex:
-                logger.exception('Error connecting to MQTT broker')
+                logger.exception('Error connecting to MQTT broker {0}'.format(name))
+            connections[name] = connection
+        self._connections = connections
+        for connection in connections.values():
+            self._update_subscription(connection)
+        self._update_failover()
+
+    def _update_subscription(self, connection):
+        # output commands are only accepted from the main broker
+        connection.update_subscription(self._output_command_topic if connection.primary else None)
+
+    def _update_failover(self):
+        """
+        Brokers with a priority form a failover chain, only the connected broker with the lowest priority gets the
+        messages. The broker that takes over gets the complete state.
+        """
+        with self._failover_lock:
+            standby = sorted((connection for connection in self._connections.values() if connection.priority > 0),
+                             key=lambda connection: connection.priority)
+            if not standby:
+                self._failover_active = None
+                return None
+            active = next((connection for connection in standby if connection.is_connected()), standby[0])
+            changed = active.name != self._failover_active
+            self._failover_active = active.name
+        if changed and active.is_connected():
+            logger.info('Publishing to failover broker {0}'.format(active.name))
+            self._start_republish(active)
+        return active
+
+    def _get_target_connections(self):
+        connections = [connection for connection in self._connections.values() if connection.priority == 0]
+        active = self._update_failover()
+        if active is not None:
+            connections.append(active)
+        return connections
 
     def _log(self, info):
+        if not self._logging_topic:
+            return
         # for log messages QoS = 0 and retain = False
-        thread = Thread(target=self._send, args=(self._logging_topic, info, 0, False))
+        thread = Thread(target=self._send, args=(self._logging_topic, info, 0, False, 'logging'))
         thread.start()
 
-    def _send(self, topic, data, qos, retain):
+    def _send(self, topic, data, qos, retain, topic_class='other'):
+        # the payload is serialized once per protocol, and shared by all connections
+        payloads = {}
+        for connection in self._get_target_connections():
+            self._publish(connection, topic, data, qos, retain, topic_class, payloads)
+
+    def _publish(self, connection, topic, data, qos, retain, topic_class, payloads):
+        if connection.client is None:
+            return
         try:
-            self.client.publish(topic, payload=json.dumps(data), qos=qos, retain=retain)
+            properties = None
+            payload = payloads.get(connection.protocol)
+            if connection.protocol == client.MQTTv5:
+                if payload is None:
+                    user_properties = []
+                    if isinstance(data, dict) and topic_class in MQTTClient.metadata_topic_classes:
+                        data = dict(data)
+                        metadata = [(key, data.pop(key)) for key in MQTTClient.metadata_fields if key in data]
+                        user_properties = [(key, str(value)) for key, value in metadata if value is not None]
+                    payload = (data if isinstance(data, bytes) else json.dumps(data), user_properties)
+                    payloads[connection.protocol] = payload
+                payload, user_properties = payload
+                # properties are not shared, the topic alias differs per connection
+                properties = Properties(PacketTypes.PUBLISH)
+                if user_properties:
+                    properties.UserProperty = user_properties
+                expiry = self._get_message_expiry(topic_class)
+                if expiry > 0:
+                    properties.MessageExpiryInterval = expiry
+            elif payload is None:
+                payload = data if isinstance(data, bytes) else json.dumps(data)
+                payloads[connection.protocol] = payload
         except Exception as ex:
+            connection.statistics.failed(topic_class)
             logger.exception('Error sending data to broker')
+            return
+        connection.publish(topic, payload, qos, retain, properties, topic_class)
+
+    def _get_message_expiry(self, topic_class):
+        if topic_class not in MQTTClient.telemetry_topic_classes:
+            return 0
+        if self._message_expiry > 0:
+            return self._message_expiry
+        if topic_class == 'metrics':
+            return max(60, 2 * self._metrics_min_interval)
+        return 2 * self._sensor_config[topic_class]['poll_frequency']
 
     def _timestamp2isoformat(self, timestamp=None):
         # start with UTC
         dt = datetime.utcnow()
         if (timestamp is not None):
-            dt.utcfromtimestamp(float(timestamp))
+            dt = datetime.utcfromtimestamp(float(timestamp))
         # localize the UTC date/time, make it "aware" instead of naive
         dt = pytz.timezone('UTC').localize(dt)
         # convert to timezone from configuration
-        if self._timezone is not None and self._timezone is not 'UTC':
+        if self._timezone is not None and self._timezone != 'UTC':
             dt = dt.astimezone(pytz.timezone(self._timezone))
         return dt.isoformat()
 
@@ -476,27 +1324,102 @@ class MQTTClient(OMPluginBase):
             input_id = data.get('input_id')
             status = 'ON' if data.get('status') else 'OFF'
             try:
-                if input_id in self._inputs:
-                    name = self._inputs[input_id].get('name')
-                    self._log('Input {0} ({1}) switched {2}'.format(input_id, name, status))
-                    logger.info('Input {0} ({1}) switched {2}'.format(input_id, name,  status))
-                    data = {'id': input_id,
-                            'name': name,
-                            'status': status,
-                            'timestamp': self._timestamp2isoformat()}
-                    thread = Thread(
-                        target=self._send,
-                        args=(self._input_topic.format(id=input_id), data, self._input_qos, self._input_retain)
-                    )
-                    thread.start()
+                inputs = self._inputs
+                if input_id in inputs:
+                    debounce, rate_limit = self._input_filters.get(input_id, self._input_filter_default)
+                    if debounce > 0 or rate_limit > 0:
+                        self._filter_input_event(input_id, status, debounce, rate_limit)
+                    else:
+                        self._publish_input(input_id, status)
+                elif not self._ready['input']:
+                    self._buffer_event('input', self.input_status, data)
                 else:
                     logger.error('Got event for unknown input {0}'.format(input_id))
             except Exception as ex:
                 logger.exception('Error processing input {0}'.format(input_id))
 
+    def _publish_input(self, input_id, status, count=None):
+        input_config = self._inputs.get(input_id)
+        if input_config is None:
+            return
+        name = input_config.get('name')
+        if count is None:
+            log_message = 'Input {0} ({1}) switched {2}'.format(input_id, name, status)
+        else:
+            log_message = 'Input {0} ({1}) switched {2} ({3} events)'.format(input_id, name, status, count)
+        self._log(log_message)
+        logger.info(log_message)
+        # the input table holds the published status, which is sent again after a reconnect
+        input_config['status'] = 1 if status == 'ON' else 0
+        data = self._build_input_message(input_id, input_config)
+        if count is not None:
+            data['count'] = count
+        thread = Thread(
+            target=self._send,
+            args=(input_config['topic'], data, self._input_qos, self._input_retain, 'input')
+        )
+        thread.start()
+
+    def _build_input_message(self, input_id, input_config):
+        return {'id': input_id,
+                'name': input_config.get('name'),
+                'status': 'ON' if input_config.get('status') else 'OFF',
+                'timestamp': self._timestamp2isoformat()}
+
+    def _filter_input_event(self, input_id, status, debounce, rate_limit):
+        now = time.time()
+        with self._input_filter_lock:
+            burst = self._input_bursts.get(input_id)
+            if burst is None:
+                last_published, _ = self._input_published.get(input_id, (0, None))
+                if debounce == 0 and now - last_published >= rate_limit:
+                    # not rate limited, no need to wait
+                    self._input_published[input_id] = (now, status)
+                    publish = True
+                else:
+                    self._input_bursts[input_id] = {'status': status, 'count': 1}
+                    delay = debounce if debounce > 0 else rate_limit - (now - last_published)
+                    self._timer_wheel.schedule(input_id, delay, lambda: self._flush_input_burst(input_id))
+                    publish = False
+            else:
+                burst['status'] = status
+                burst['count'] += 1
+                if debounce > 0:
+                    # the input is not stable yet, restart the debounce window
+                    self._timer_wheel.schedule(input_id, debounce, lambda: self._flush_input_burst(input_id))
+                publish = False
+        if publish:
+            self._publish_input(input_id, status, 1 if self._input_aggregate else None)
+
+    def _flush_input_burst(self, input_id):
+        now = time.time()
+        _, rate_limit = self._input_filters.get(input_id, self._input_filter_default)
+        with self._input_filter_lock:
+            burst = self._input_bursts.get(input_id)
+            if burst is None:
+                return
+            last_published, last_status = self._input_published.get(input_id, (0, None))
+            if last_status is None:
+                initial_status = self._inputs.get(input_id, {}).get('status')
+                if initial_status is not None:
+                    last_status = 'ON' if initial_status else 'OFF'
+            if now - last_published < rate_limit:
+                self._timer_wheel.schedule(input_id, rate_limit - (now - last_published), lambda: self._flush_input_burst(input_id))
+                return
+            del self._input_bursts[input_id]
+            status = burst['status']
+            if not self._input_aggregate and status == last_status:
+                # the input bounced back to the last published state
+                return
+            self._input_published[input_id] = (now, status)
+        self._publish_input(input_id, status, burst['count'] if self._input_aggregate else None)
+
     @output_status
     def output_status(self, status):
         if self._enabled and self._output_enabled:
+            if not self._ready['output']:
+                self._buffer_event('output', self.output_status, status)
+                return
             try:
                 new_output_status = {}
                 for entry in status:
@@ -526,24 +1449,27 @@ class MQTTClient(OMPluginBase):
                         self._log('Output {0} ({1}) changed to OFF'.format(output_id, name))
                         logger.info('Output {0} ({1}) changed to OFF'.format(output_id, name))
                     if changed is True:
-                        if current_output_status[output_id]['module_type'] == 'output':
-                            level = 100
-                        else:
-                            level = dimmer
-                        if current_output_status[output_id]['status'] == 0:
-                            level = 0
-                        data = {'id': output_id,
-                                'name': name,
-                                'value': level,
-                                'timestamp': self._timestamp2isoformat()}
+                        data = self._build_output_message(output_id, current_output_status[output_id])
                         thread = Thread(
                             target=self._send,
-                            args=(self._output_topic.format(id=output_id), data, self._output_qos, self._output_retain)
+                            args=(current_output_status[output_id]['topic'], data, self._output_qos, self._output_retain, 'output')
                         )
                         thread.start()
             except Exception as ex:
                 logger.exception('Error processing outputs')
 
+    def _build_output_message(self, output_id, output):
+        if output['status'] == 0:
+            level = 0
+        elif output['module_type'] == 'output':
+            level = 100
+        else:
+            level = output['dimmer']
+        return {'id': output_id,
+                'name': output.get('name'),
+                'value': level,
+                'timestamp': self._timestamp2isoformat()}
+
     @receive_events
     def receive_events(self, event_id):
         if self._enabled and self._event_enabled:
@@ -554,7 +1480,7 @@ class MQTTClient(OMPluginBase):
                         'timestamp': self._timestamp2isoformat()}
                 thread = Thread(
                     target=self._send,
-                    args=(self._event_topic.format(id=event_id), data, self._event_qos, self._event_retain)
+                    args=(self._event_topic.format(id=event_id), data, self._event_qos, self._event_retain, 'event')
                 )
                 thread.start()
             except Exception as ex:
@@ -565,7 +1491,8 @@ class MQTTClient(OMPluginBase):
         self._create_background_task(
             'sensor',
             self.webinterface.get_sensor_status,
-            self._process_sensor_status
+            self._process_sensor_status,
+            self._snapshot_sensor_status
         )()
 
     @background_task
@@ -573,7 +1500,8 @@ class MQTTClient(OMPluginBase):
         self._create_background_task(
             'power',
             self.webinterface.get_realtime_power,
-            self._process_realtime_power
+            self._process_realtime_power,
+            self._snapshot_realtime_power
         )()
 
     @background_task
@@ -581,14 +1509,16 @@ class MQTTClient(OMPluginBase):
         self._create_background_task(
             'energy',
             self.webinterface.get_total_energy,
-            self._process_total_energy
+            self._process_total_energy,
+            self._snapshot_total_energy
         )()
 
     def _process_sensor_status(self, sensor_config, json_data):
         mqtt_messages = []
+        sensors = self._sensors
         data_list = list(filter(None, json_data.get('status', [])))
         for sensor_id, sensor_value in enumerate(data_list):
-            sensor = self._sensors.get(sensor_id)
+            sensor = sensors.get(sensor_id)
             if sensor:
                 sensor_data = {'id': sensor_id,
                                'source': sensor.get('source'),
@@ -598,15 +1528,16 @@ class MQTTClient(OMPluginBase):
                                'name': sensor.get('name'),
                                'value': float(sensor_value),
                                'timestamp': self._timestamp2isoformat()}
-                mqtt_messages.append({'topic': sensor_config.get('topic').format(id=sensor_id),
+                mqtt_messages.append({'topic': sensor['topic'],
                                       'message': sensor_data})
         return mqtt_messages
 
     def _process_realtime_power(self, sensor_config, json_data):
         mqtt_messages = []
+        power_modules = self._power_modules
         json_data.pop('success')
         for module_id, values in json_data.items():
-            module = self._power_modules.get(int(module_id))
+            module = power_modules.get(int(module_id))
             if module:
                 for input_id, sensor_values in enumerate(values):
                     power_input = module.get(int(input_id))
@@ -619,15 +1550,16 @@ class MQTTClient(OMPluginBase):
                                        'current': sensor_values[2],
                                        'power': sensor_values[3],
                                        'timestamp': self._timestamp2isoformat()}
-                        mqtt_messages.append({'topic': sensor_config.get('topic').format(module_id=module_id, sensor_id=input_id),
+                        mqtt_messages.append({'topic': power_input['power_topic'],
                                               'message': sensor_data })
         return mqtt_messages
 
     def _process_total_energy(self, sensor_config, json_data):
         mqtt_messages = []
+        power_modules = self._power_modules
         json_data.pop('success')
         for module_id, values in json_data.items():
-            module = self._power_modules.get(int(module_id))
+            module = power_modules.get(int(module_id))
             if module:
                 for input_id, sensor_values in enumerate(values):
                     power_input = module.get(int(input_id))
@@ -638,11 +1570,141 @@ class MQTTClient(OMPluginBase):
                                        'day': sensor_values[0],
                                        'night': sensor_values[1],
                                        'timestamp': self._timestamp2isoformat()}
-                    mqtt_messages.append({'topic': sensor_config.get('topic').format(module_id=module_id, sensor_id=input_id),
-                                          'message': sensor_data})
+                        mqtt_messages.append({'topic': power_input['energy_topic'],
+                                              'message': sensor_data})
+        return mqtt_messages
+
+    @om_metric_receive()
+    def receive_metric_data(self, metric):
+        """
+        > example_metric = {"source": "OpenMotics",
+        >                   "type": "energy",
+        >                   "timestamp": 1497677091,
+        >                   "tags": {"device": "OpenMotics energy ID1",
+        >                            "id": 0},
+        >                   "values": {"power": 1234,
+        >                              "power_counter": 1234567}}
+        """
+        if not self._enabled or not self._metrics_bridge_enabled:
+            return
+        try:
+            metric_type = metric['type']
+            tags = metric.get('tags', {})
+            fields = _TopicFields((tag, re.sub('[/+#]', '_', str(value))) for tag, value in tags.items())
+            fields.update({'type': metric_type,
+                           'source': metric['source'].lower()})
+            topic = self._metrics_topic.format_map(fields)
+            now = time.time()
+            min_interval = self._metrics_rate_limits.get(metric_type, self._metrics_min_interval)
+            if now - self._metrics_last_publish.get(topic, 0) < min_interval:
+                return
+            self._metrics_last_publish[topic] = now
+            data = {'source': metric['source'],
+                    'type': metric_type,
+                    'tags': tags,
+                    'values': metric['values'],
+                    'timestamp': self._timestamp2isoformat(metric.get('timestamp'))}
+            self._state_cache[topic] = (topic, data, self._metrics_qos, self._metrics_retain, 'metrics')
+            self._send(topic, data, self._metrics_qos, self._metrics_retain, 'metrics')
+        except Exception as ex:
+            logger.exception('Error processing metric')
+
+    def _snapshot_sensor_status(self, json_data):
+        sensors = self._sensors
+        schema = {'type': 'sensor',
+                  'fields': ['value'],
+                  'sensors': [{'id': sensor_id,
+                               'name': sensors[sensor_id].get('name'),
+                               'source': sensors[sensor_id].get('source'),
+                               'external_id': sensors[sensor_id].get('external_id'),
+                               'physical_quantity': sensors[sensor_id].get('physical_quantity'),
+                               'unit': sensors[sensor_id].get('unit')}
+                              for sensor_id in sorted(sensors)]}
+        ids = []
+        values = []
+        for sensor_id, sensor_value in enumerate(json_data.get('status', [])):
+            if sensor_value is None or sensor_id not in sensors:
+                continue
+            ids.append(sensor_id)
+            values.append(float(sensor_value))
+        snapshot = {'timestamp': self._timestamp2isoformat(),
+                    'ids': ids,
+                    'values': values}
+        return schema, snapshot
+
+    def _snapshot_realtime_power(self, json_data):
+        return self._snapshot_power_modules('power', ['voltage', 'frequency', 'current', 'power'], json_data)
+
+    def _snapshot_total_energy(self, json_data):
+        return self._snapshot_power_modules('energy', ['day', 'night'], json_data)
+
+    def _snapshot_power_modules(self, sensor_type, fields, json_data):
+        power_modules = self._power_modules
+        json_data.pop('success', None)
+        schema = {'type': sensor_type,
+                  'fields': fields,
+                  'modules': [{'id': module_id,
+                               'inputs': [power_modules[module_id][input_id].get('name')
+                                          for input_id in sorted(power_modules[module_id])]}
+                              for module_id in sorted(power_modules)]}
+        module_ids = []
+        values = []
+        for module_id, module_values in sorted(json_data.items(), key=lambda item: int(item[0])):
+            module = power_modules.get(int(module_id))
+            if not module:
+                continue
+            module_ids.append(int(module_id))
+            values.append([list(input_values[:len(fields)])
+                           for input_id, input_values in enumerate(module_values)
+                           if input_id in module])
+        snapshot = {'timestamp': self._timestamp2isoformat(),
+                    'modules': module_ids,
+                    'values': values}
+        return schema, snapshot
+
+    def _encode_snapshot(self, data):
+        if self._snapshot_format == 'cbor':
+            return cbor_dumps(data)
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    def _build_snapshot_messages(self, sensor_type, snapshot_builder, json_data):
+        mqtt_messages = []
+        schema, snapshot = snapshot_builder(json_data)
+        topic = self._snapshot_topic.format(type=sensor_type)
+        # The schema only changes with the configuration, so it is sent (retained) once instead of in every snapshot
+        encoded_schema = self._encode_snapshot(schema)
+        schema_hash = hashlib.md5(encoded_schema).hexdigest()
+        if self._snapshot_schemas.get(sensor_type) != schema_hash:
+            self._snapshot_schemas[sensor_type] = schema_hash
+            mqtt_messages.append({'topic': '{0}/schema'.format(topic),
+                                  'message': encoded_schema,
+                                  'retain': True,
+                                  'topic_class': 'schema'})
+        mqtt_messages.append({'topic': topic,
+                              'message': self._encode_snapshot(snapshot)})
         return mqtt_messages
 
-    def _create_background_task(self, sensor_type, data_retriever, data_processor):
+    def _poll_sensor_data(self, sensor_type, data_retriever, data_processor, snapshot_builder):
+        sensor_config = self._sensor_config.get(sensor_type)
+        result = json.loads(data_retriever())
+        if result['success'] is False:
+            logger.error('Failed to load {0} sensor data: {1}'.format(sensor_type, result.get('msg')))
+            return
+        if self._snapshot_format in ['json', 'cbor']:
+            mqtt_messages = self._build_snapshot_messages(sensor_type, snapshot_builder, result)
+        else:
+            mqtt_messages = data_processor(sensor_config, result)
+        for mqtt_message in mqtt_messages:
+            args = (mqtt_message.get('topic'),
+                    mqtt_message.get('message'),
+                    sensor_config.get('qos'),
+                    mqtt_message.get('retain', sensor_config.get('retain')),
+                    mqtt_message.get('topic_class', sensor_type))
+            self._state_cache[args[0]] = args
+            thread = Thread(target=self._send, args=args)
+            thread.start()
+
+    def _create_background_task(self, sensor_type, data_retriever, data_processor, snapshot_builder):
         def background_function():
             while True:
                 if self._enabled:
@@ -653,19 +1715,9 @@ class MQTTClient(OMPluginBase):
                     while frequency >= 10:
                         start = time.time()
                         try:
-                            if sensor_config.get('enabled'):
-                                result = json.loads(data_retriever())
-                                if result['success'] is False:
-                                    logger.error('Failed to load {0} sensor data: {1}'.format(sensor_type, result.get('msg')))
-                                else:
-                                    mqtt_messages = data_processor(sensor_config, result)
-                                    for mqtt_message in mqtt_messages:
-                                        thread = Thread(target=self._send,
-                                                        args=(mqtt_message.get('topic'),
-                                                              mqtt_message.get('message'),
-                                                              sensor_config.get('qos'),
-                                                              sensor_config.get('retain')))
-                                        thread.start()
+                            # the metrics bridge replaces the polling of this data
+                            if sensor_config.get('enabled') and not self._metrics_bridge_enabled and self._ready['sensor' if sensor_type == 'sensor' else 'power']:
+                                self._poll_sensor_data(sensor_type, data_retriever, data_processor, snapshot_builder)
                         except Exception as ex:
                             logger.exception('Error processing {0} sensor status'.format(sensor_type))
                         # This loop will run approx. every 'frequency' seconds
@@ -677,56 +1729,275 @@ class MQTTClient(OMPluginBase):
                     time.sleep(15)
         return background_function
 
-    def on_connect(self, client, userdata, flags, rc):
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        connection = userdata
         if rc != 0:
-            logger.error('Error connecting: rc={0}', rc)
+            logger.error('Error connecting to {0}: rc={1}'.format(connection.name, rc))
             return
 
-        logger.info('Connected to MQTT broker {0}:{1}'.format(self._hostname, self._port))
-        # subscribe to output command topic if provided
-        if self._output_command_topic:
-            try:
-                self.client.subscribe(self._output_command_topic)
-                logger.info('Subscribed to {0}'.format(self._output_command_topic))
-            except Exception as ex:
-                logger.exception('Could not subscribe')
+        # topic aliases only live as long as the connection
+        with connection.topic_alias_lock:
+            connection.topic_aliases = {}
+            connection.topic_alias_maximum = getattr(properties, 'TopicAliasMaximum', 0) if properties is not None else 0
+
+        logger.info('Connected to MQTT broker {0} ({1}:{2})'.format(connection.name, connection.settings['hostname'], connection.settings['port']))
+        connection.statistics.connected()
+        # the broker might have lost the retained snapshot schemas, send them again with the next snapshot
+        self._snapshot_schemas = {}
+        if connection.ssl_context is not None:
+            connection.ssl_context.remember_session(client.socket())
+        # subscribe to output command topic if provided, a persistent session still has the subscription
+        if not (connection.settings['persistent_session'] and flags.get('session present')):
+            connection.subscribed_topic = None
+        else:
+            connection.remove_probe_subscriptions()
+        self._update_subscription(connection)
+
+        # the broker might have been restarted, make sure it has the current state of everything
+        if connection.priority == 0:
+            self._start_republish(connection)
+        else:
+            previous = self._failover_active
+            if self._update_failover() is connection and previous == connection.name:
+                # the active failover broker is back, a newly activated broker already got the state
+                self._start_republish(connection)
+
+    def _start_republish(self, connection):
+        if self._republish_rate <= 0:
+            return
+        connection.republish_generation += 1
+        thread = Thread(target=self._republish_state, args=(connection, connection.republish_generation))
+        thread.setName('MQTTClient republish {0}'.format(connection.name))
+        thread.daemon = True
+        thread.start()
+
+    def _collect_state_messages(self):
+        messages = []
+        if self._input_enabled and self._ready['input']:
+            for input_id, input_config in sorted(self._inputs.items()):
+                if input_config.get('status') is not None:
+                    messages.append((input_config['topic'], self._build_input_message(input_id, input_config),
+                                     self._input_qos, self._input_retain, 'input'))
+        if self._output_enabled and self._ready['output']:
+            for output_id, output in sorted(self._outputs.items()):
+                if output.get('status') is not None and output.get('dimmer') is not None:
+                    messages.append((output['topic'], self._build_output_message(output_id, output),
+                                     self._output_qos, self._output_retain, 'output'))
+        # sensor, power, energy and metrics messages are sent again as they were last published
+        messages.extend(list(self._state_cache.values()))
+        return messages
+
+    def _republish_state(self, connection, generation):
+        try:
+            messages = self._collect_state_messages()
+            if not messages:
+                return
+            retained = {}
+            if self._republish_check_retained:
+                retained = self._probe_retained_messages(connection, generation, [message for message in messages if message[3]])
+            bucket = TokenBucket(self._republish_rate)
+            sent = 0
+            skipped = 0
+            for topic, data, qos, retain, topic_class in messages:
+                if generation != connection.republish_generation or not connection.is_connected():
+                    logger.info('Republish to {0} aborted after {1} messages'.format(connection.name, sent))
+                    return
+                if retain and self._is_retained_state(retained.get(topic), data):
+                    skipped += 1
+                    continue
+                bucket.consume()
+                self._publish(connection, topic, data, qos, retain, topic_class, {})
+                sent += 1
+            logger.info('Republished {0} state messages to {1}, {2} retained messages were still correct'.format(sent, connection.name, skipped))
+        except Exception as ex:
+            logger.exception('Error republishing state')
+
+    def _probe_retained_messages(self, connection, generation, messages):
+        """
+        Subscribes shortly to the state topics, the broker then sends the retained messages it has for them.
+        """
+        if not messages:
+            return {}
+        topics = set(message[0] for message in messages)
+        topic_formats = {'input': self._input_topic,
+                         'output': self._output_topic,
+                         'metrics': self._metrics_topic,
+                         'schema': '{0}/schema'.format(self._snapshot_topic)}
+        for sensor_type, sensor_config in self._sensor_config.items():
+            topic_formats[sensor_type] = self._snapshot_topic if self._snapshot_format in ['json', 'cbor'] else sensor_config['topic']
+        # a topic level with a placeholder becomes a single level wildcard
+        topic_filters = set(connection.topic_prefix + '/'.join('+' if '{' in level else level for level in topic_formats[message[4]].split('/'))
+                            for message in messages)
+        probe = {'topics': set(connection.topic_prefix + topic for topic in topics), 'payloads': {}, 'last_message': time.time()}
+        with connection.retained_probe_condition:
+            connection.retained_probe = probe
+        # replaced instead of updated, on_message reads it on the network thread
+        connection.probe_filters = connection.probe_filters | topic_filters
+        try:
+            for topic_filter in topic_filters:
+                connection.client.subscribe(topic_filter, qos=0)
+            start = time.time()
+            with connection.retained_probe_condition:
+                # retained messages arrive right after subscribing, stop when they dry up
+                while time.time() - start < 5 and generation == connection.republish_generation:
+                    if len(probe['payloads']) == len(topics):
+                        break
+                    if time.time() - start >= 1 and time.time() - probe['last_message'] >= 0.5:
+                        break
+                    connection.retained_probe_condition.wait(0.1)
+        finally:
+            with connection.retained_probe_condition:
+                connection.retained_probe = None
+            for topic_filter in topic_filters:
+                if topic_filter != connection.subscribed_topic:
+                    connection.client.unsubscribe(topic_filter)
+        return dict((topic[len(connection.topic_prefix):], payload) for topic, payload in probe['payloads'].items())
+
+    def _is_retained_state(self, payload, data):
+        if payload is None:
+            return False
+        if isinstance(data, bytes):
+            return payload == data
+        try:
+            retained = json.loads(payload)
+        except ValueError:
+            return False
+        if not isinstance(retained, dict):
+            return False
+        for key, value in data.items():
+            if key == 'timestamp':
+                continue
+            # MQTT 5 sends the metadata as user properties, which are not part of the payload
+            if key in MQTTClient.metadata_fields and key not in retained:
+                continue
+            if retained.get(key) != value:
+                return False
+        return True
+
+    def on_disconnect(self, client, userdata, rc, properties=None):
+        connection = userdata
+        connection.statistics.disconnected()
+        if rc != 0:
+            logger.warning('Unexpected disconnect from MQTT broker {0}: rc={1}'.format(connection.name, rc))
+        if connection.priority > 0:
+            self._update_failover()
+
+    def on_publish(self, client, userdata, mid):
+        userdata.statistics.acknowledged(mid)
+
+    @background_task
+    def background_task_statistics(self):
+        while True:
+            time.sleep(self._stats_interval)
+            if self._enabled and self._stats_topic:
+                # every broker gets its own statistics
+                for connection in self._get_target_connections():
+                    self._publish(connection, self._stats_topic, connection.statistics.get_statistics(), 0, True, 'stats', {})
 
     def on_message(self, client, userdata, msg):
+        connection = userdata
+        probe = connection.retained_probe
+        if probe is not None and msg.retain and msg.topic in probe['topics']:
+            with connection.retained_probe_condition:
+                probe['payloads'][msg.topic] = msg.payload
+                probe['last_message'] = time.time()
+                connection.retained_probe_condition.notify()
+            return
+        if not connection.primary:
+            return
+        # This runs on the network thread, so commands are only queued here and executed by the command worker
         if self._output_command_topic:
-            regexp = self._output_command_topic.replace('+', '(\d+)')
+            regexp = self._output_command_topic.replace('+', '(\\d+)')
             if re.search(regexp, msg.topic) is not None:
                 try:
                     # the output_id is the first match of the regular expression
                     output_id = int(re.findall(regexp, msg.topic)[0])
                     if output_id in self._outputs:
-                        output = self._outputs[output_id]
                         value = int(msg.payload)
-                        if value > 0:
-                            is_on = 'true'
-                        else:
-                            is_on = 'false'
-                        dimmer = None
-                        if output['module_type'] == 'dimmer':
-                            dimmer = None if value == 0 else max(0, min(100, value))
-                            if value > 0:
-                                log_value = 'ON ({0}%)'.format(value)
-                        result = json.loads(self.webinterface.set_output(id=output_id, is_on=is_on, dimmer=dimmer))
-                        if result['success'] is False:
-                            log_message = 'Failed to set output {0} to {1}: {2}'.format(output_id, value, result.get('msg', 'Unknown error'))
-                            self._log(log_message)
-                            logger.error(log_message)
-                        else:
-                            log_message = 'Message for output {0} with payload {1}'.format(output_id, value)
-                            self._log(log_message)
-                            logger.info(log_message)
+                        with self._output_commands_condition:
+                            # latest value wins, a queued command for the same output is replaced
+                            self._output_commands[output_id] = value
+                            self._output_commands_condition.notify()
                     else:
                         self._log('Unknown output: {0}'.format(output_id))
                 except Exception as ex:
                     self._log('Failed to process message')
-            else:
+            elif not connection.is_probe_topic(msg.topic):
+                # a state message of a probe that arrives after it finished is not worth a warning
                 self._log('Message with topic {0} ignored'.format(msg.topic))
                 logger.info('Message with topic {0} ignored'.format(msg.topic))
 
+    def _next_output_command(self):
+        with self._output_commands_condition:
+            while True:
+                now = time.time()
+                min_interval = 1.0 / max(1, self._output_command_max_rate)
+                wait = None
+                for output_id in self._output_commands:
+                    next_execution = self._output_commands_executed.get(output_id, 0) + min_interval
+                    if next_execution <= now:
+                        self._output_commands_executed[output_id] = now
+                        return output_id, self._output_commands.pop(output_id)
+                    wait = next_execution - now if wait is None else min(wait, next_execution - now)
+                self._output_commands_condition.wait(wait)
+
+    @background_task
+    def background_task_output_commands(self):
+        while True:
+            output_id, value = self._next_output_command()
+            try:
+                self._execute_output_command(output_id, value)
+            except Exception as ex:
+                logger.exception('Error executing command for output {0}'.format(output_id))
+
+    def _execute_output_command(self, output_id, value):
+        output = self._outputs.get(output_id)
+        if output is None:
+            self._log('Unknown output: {0}'.format(output_id))
+            return
+        if value > 0:
+            is_on = 'true'
+        else:
+            is_on = 'false'
+        dimmer = None
+        if output['module_type'] == 'dimmer':
+            dimmer = None if value == 0 else max(0, min(100, value))
+        result = json.loads(self.webinterface.set_output(id=output_id, is_on=is_on, dimmer=dimmer))
+        if result['success'] is False:
+            log_message = 'Failed to set output {0} to {1}: {2}'.format(output_id, value, result.get('msg', 'Unknown error'))
+            self._log(log_message)
+            logger.error(log_message)
+        else:
+            log_message = 'Message for output {0} with payload {1}'.format(output_id, value)
+            self._log(log_message)
+            logger.info(log_message)
+
+    @om_expose
+    def get_status(self):
+        connections = self._connections
+        main = connections.get('main')
+        status = {'enabled': self._enabled,
+                  'connected': main is not None and main.is_connected(),
+                  'ready': all(self._ready.values()),
+                  'configuration': self._ready,
+                  'buffered_events': len(self._buffered_events)}
+        if len(connections) > (1 if main is not None else 0):
+            status['brokers'] = dict((name, {'connected': connection.is_connected(),
+                                             'priority': connection.priority,
+                                             'active': connection.priority == 0 or name == self._failover_active})
+                                     for name, connection in connections.items() if name != 'main')
+        return json.dumps(status)
+
+    @om_expose
+    def get_stats(self):
+        connections = self._connections
+        main = connections.get('main')
+        statistics = main.statistics.get_statistics() if main is not None else {}
+        if len(connections) > (1 if main is not None else 0):
+            statistics['brokers'] = dict((name, connection.statistics.get_statistics())
+                                         for name, connection in connections.items() if name != 'main')
+        return json.dumps(statistics)
+
     @om_expose
     def get_config_description(self):
         return json.dumps(MQTTClient.config_description)
@@ -747,8 +2018,7 @@ class MQTTClient(OMPluginBase):
             self._read_config()
             self.write_config(config)
             if self._enabled:
-                thread = Thread(target=self._load_configuration)
-                thread.start()
+                self._start_configuration_loader()
         except Exception as ex:
             logger.exception('Error saving configuration')
 
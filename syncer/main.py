@@ -3,17 +3,254 @@ A plugin to let two Gateways work together
 """
 
 import six
+import os
 import copy
 import time
+import hashlib
+import uuid
 import requests
 import json
 from plugins.base import om_expose, output_status, OMPluginBase, PluginConfigChecker, background_task
-from threading import Thread
+from collections import OrderedDict
+from types import MappingProxyType
+from threading import Thread, Lock, Condition
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+class RemoteUnavailableError(RuntimeError):
+    pass
+
+
+class GatewayHealth(object):
+    """
+    Health of a remote GW: up, degraded (calls only succeeded after retrying) or down (calls failed). While a GW is
+    down, calls are rejected right away and the GW is probed with an exponential backoff.
+    """
+
+    UP = 'up'
+    DEGRADED = 'degraded'
+    DOWN = 'down'
+
+    min_backoff = 5
+    max_backoff = 300
+
+    def __init__(self):
+        self._lock = Lock()
+        self._backoff = GatewayHealth.min_backoff
+        self.state = GatewayHealth.UP
+        self.since = time.time()
+        self.next_probe = 0
+        self.calls = 0
+        self.retries = 0
+        self.errors = 0
+        self.rejected = 0
+        self.latency = None
+        self.last_error = None
+
+    def is_down(self):
+        return self.state == GatewayHealth.DOWN
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            self.since = time.time()
+
+    def record_success(self, latency, attempts):
+        """ Returns True if the GW was down """
+        with self._lock:
+            self.calls += 1
+            self.retries += attempts - 1
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            recovered = self.state == GatewayHealth.DOWN
+            self._set_state(GatewayHealth.DEGRADED if attempts > 1 else GatewayHealth.UP)
+            self._backoff = GatewayHealth.min_backoff
+            return recovered
+
+    def record_failure(self, error, attempts):
+        """ Returns True if the GW went down """
+        with self._lock:
+            self.calls += 1
+            self.retries += attempts - 1
+            self.errors += 1
+            self.last_error = str(error)
+            went_down = self.state != GatewayHealth.DOWN
+            if went_down:
+                self._backoff = GatewayHealth.min_backoff
+            self._set_state(GatewayHealth.DOWN)
+            self.next_probe = time.time() + self._backoff
+            return went_down
+
+    def record_rejected(self):
+        with self._lock:
+            self.rejected += 1
+
+    def start_probe(self):
+        with self._lock:
+            # if this probe fails as well, the next one waits twice as long
+            self._backoff = min(self._backoff * 2, GatewayHealth.max_backoff)
+            self.next_probe = time.time() + self._backoff
+
+    def to_dict(self):
+        with self._lock:
+            return {'state': self.state,
+                    'since': self.since,
+                    'next_probe': self.next_probe if self.state == GatewayHealth.DOWN else None,
+                    'calls': self.calls,
+                    'retries': self.retries,
+                    'errors': self.errors,
+                    'rejected': self.rejected,
+                    'latency_ms': None if self.latency is None else round(self.latency * 1000, 1),
+                    'last_error': self.last_error}
+
+
+class RemoteWorker(object):
+    """
+    Sends the updates for one remote GW on its own thread, so a slow or offline GW doesn't delay the others or the
+    local events. Updates are coalesced per remote object: only the latest state is sent. While the GW is down, the
+    updates are kept and the worker only probes the GW.
+    """
+
+    def __init__(self, name, health, probe):
+        self.name = name
+        self._health = health
+        self._probe = probe
+        self._pending = OrderedDict()
+        self._condition = Condition()
+        self._running = True
+        self._thread = Thread(target=self._run)
+        self._thread.setName(f"Syncer worker {name}")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, key, function, *args, **kwargs):
+        with self._condition:
+            # a queued update for the same remote object is replaced, it keeps its place in the queue
+            self._pending[key] = (function, args, kwargs)
+            self._condition.notify()
+
+    def get_pending_count(self):
+        return len(self._pending)
+
+    def wake(self):
+        with self._condition:
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            item = None
+            with self._condition:
+                while self._running:
+                    if self._health.is_down():
+                        timeout = self._health.next_probe - time.time()
+                        if timeout <= 0:
+                            break
+                        self._condition.wait(timeout)
+                    elif self._pending:
+                        break
+                    else:
+                        self._condition.wait()
+                if not self._running:
+                    return
+                if not self._health.is_down():
+                    key, item = self._pending.popitem(last=False)
+            if item is None:
+                self._health.start_probe()
+                try:
+                    self._probe()
+                except Exception as ex:
+                    logger.debug(f"GW {self.name} is still unavailable: {ex}")
+                continue
+            function, args, kwargs = item
+            try:
+                function(*args, **kwargs)
+            except RemoteUnavailableError as ex:
+                with self._condition:
+                    # keep the update for when the GW is back, unless a newer one was queued meanwhile
+                    if key not in self._pending:
+                        self._pending[key] = item
+                        self._pending.move_to_end(key, last=False)
+                logger.debug(f"GW {self.name} is unavailable, {len(self._pending)} update(s) postponed: {ex}")
+            except Exception as ex:
+                logger.exception(f"Error updating GW {self.name}: {ex}")
+
+
+class EchoCache(object):
+    """
+    Remembers the latest state the Syncer wrote to an object, with the origin of the write and the GWs that got it along,
+    for a short while. An event with that state was caused by the write, so it doesn't have to be sent to those again.
+    """
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        # ordered by expiry, as every entry lives equally long
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def add(self, key, state, origin, covered=()):
+        with self._lock:
+            now = time.time()
+            self._entries.pop(key, None)
+            self._entries[key] = (state, origin, now + self._ttl, tuple(covered))
+            # entries that are never looked up again, like relayed event ids, are purged here
+            while self._entries:
+                oldest_key, oldest = next(iter(self._entries.items()))
+                if oldest[2] >= now:
+                    break
+                del self._entries[oldest_key]
+
+    def get(self, key):
+        """ Returns (state, origin, covered GWs) of a recent write, or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] < time.time():
+                del self._entries[key]
+                return None
+            return entry[0], entry[1], entry[3]
+
+    def pop(self, key):
+        """ Returns (state, origin, covered GWs) of a recent write and forgets it, or None """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[2] < time.time():
+                return None
+            return entry[0], entry[1], entry[3]
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class MappingTables(object):
+    """
+    Lookup tables compiled from the mappings of all GWs when the config is loaded. The tables never change afterwards: a
+    reload compiles new ones and swaps them in with a single assignment, so the event handlers use them without locking
+    and never see a half loaded config. Only the last known local states are updated by the handlers.
+    """
+
+    def __init__(self, remote_mappings=(), local_states=None):
+        remotes = {"output": {}, "input": {}, "shutter": {}}
+        for obj_type, local_id, remote in remote_mappings:
+            remotes[obj_type].setdefault(local_id, []).append(MappingProxyType(remote))
+        # type -> local id -> remotes
+        self.remotes = MappingProxyType(dict((obj_type, MappingProxyType(dict((local_id, tuple(values))
+                                                                              for local_id, values in mapping.items())))
+                                             for obj_type, mapping in remotes.items()))
+        # a shutter event has the states of all shutters, only the mapped ones are checked
+        self.shutters = tuple(self.remotes["shutter"].items())
+        local_states = local_states or {}
+        self.states = dict((obj_type, dict((local_id, local_states[obj_type][local_id]) for local_id in mapping))
+                           for obj_type, mapping in self.remotes.items())
+
+
 class Syncer(OMPluginBase):
     """
     A syncer plugin to let a GW work together with n other GWs. Depending on the config, this GW will follow/set values
@@ -21,9 +258,16 @@ class Syncer(OMPluginBase):
     """
 
     name = 'Syncer'
-    version = '0.0.8'
+    version = '0.0.24'
     interfaces = [('config', '1.0')]
 
+    connect_timeout = 5
+    read_timeout = 30
+    max_attempts = 3
+    token_timeout = 60 * 60 * 24 * 30
+    echo_ttl = 10
+    relay_event_ttl = 60
+
     config_description = [{
         'name': 'local_name',
         'type': 'str',
@@ -34,6 +278,31 @@ class Syncer(OMPluginBase):
             'type': 'int',
             'description': 'Interval (in seconds) to check remote sensor changes. (default 60)'
         },
+        {
+            'name': 'sensor_push_deadband',
+            'type': 'str',
+            'description': 'Minimal change of a local sensor value before it is pushed to other GWs. (default 0.1)'
+        },
+        {
+            'name': 'sensor_push_interval',
+            'type': 'int',
+            'description': 'Interval (in seconds) to push the changed local sensor values in one batch. (default 5)'
+        },
+        {
+            'name': 'sensor_push_fallback_interval',
+            'type': 'int',
+            'description': 'Interval (in seconds) to check the sensors of a GW that pushes its sensor changes. (default 600)'
+        },
+        {
+            'name': 'reconcile_interval',
+            'type': 'int',
+            'description': 'Interval (in seconds) to check whether the remote outputs and inputs still have the local state. A remote object that was changed on its own GW is set back to the local state. 0 to disable. (default 0)'
+        },
+        {
+            'name': 'relay_fanout',
+            'type': 'int',
+            'description': 'Number of GWs with peer_syncer an output or input change is sent to, they forward it to the other GWs with peer_syncer. 0 sends every change directly. (default 0)'
+        },
         {
             'name': 'gateways',
             'type': 'section',
@@ -60,6 +329,16 @@ class Syncer(OMPluginBase):
                     'type': 'str',
                     'description': 'The (local) password for the other Gateway.'
                 },
+                {
+                    'name': 'push_sensors',
+                    'type': 'bool',
+                    'description': 'Push changed local sensor values to the Syncer plugin on the other Gateway. Its remote_name for this Gateway should be the local_name.'
+                },
+                {
+                    'name': 'peer_syncer',
+                    'type': 'bool',
+                    'description': 'The other Gateway runs the Syncer plugin too. Outputs and inputs are set through its Syncer, so it does not send the change back.'
+                },
                 {
                     'name': 'mappings',
                     'type': 'section',
@@ -129,7 +408,12 @@ class Syncer(OMPluginBase):
         }]
 
     default_config = {
-        "polling_interval": 60
+        "polling_interval": 60,
+        "sensor_push_deadband": "0.1",
+        "sensor_push_interval": 5,
+        "sensor_push_fallback_interval": 600,
+        "reconcile_interval": 0,
+        "relay_fanout": 0
     }
 
     def __init__(self, webinterface, connector):
@@ -140,35 +424,53 @@ class Syncer(OMPluginBase):
         self._config_checker = PluginConfigChecker(Syncer.config_description)
 
         self._polling_interval = 60
+        self._sensor_push_deadband = 0.1
+        self._sensor_push_interval = 5
+        self._sensor_push_fallback_interval = 600
+        self._reconcile_interval = 0
+        self._relay_fanout = 0
+        # local sensor values that still have to be pushed, and the values that were pushed, per GW
+        self._sensor_push_lock = Lock()
         self._gateways = {}
         self._name = ''
-        self._mappings = {}
+        self._tables = MappingTables()
         self._local_confs = {}
+        self._local_states = {}
+        # recent writes to remote objects (ip, type, id) and, by other Syncers, to local objects ('local', type, id)
+        self._echo_cache = EchoCache(Syncer.echo_ttl)
+        # ids of the relayed changes that were applied already
+        self._relay_events = EchoCache(Syncer.relay_event_ttl)
         self._enabled = False
-        self._old_conf_deleted = True
+        # config changes are applied one after the other
+        self._config_lock = Lock()
+        # tokens are valid for 30 days, so they are kept over restarts
+        self._token_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'tokens.json')
+        self._tokens_lock = Lock()
+        self._tokens = self._load_tokens()
         thread = Thread(target=self._process_config)
         thread.start()
 
         self.connector.input.subscribe_status_event(handler=self.handle_input_status, version=2)
         self.connector.output.subscribe_status_event(handler=self.handle_output_status, version=2)
         self.connector.shutter.subscribe_status_event(handler=self.handle_shutter_status, version=2)
+        self.connector.sensor.subscribe_status_event(handler=self.handle_sensor_status, version=2)
 
         logger.info("Started Syncer plugin")
 
     def _process_config(self):
-        while True:
-            if not self._old_conf_deleted:
-                time.sleep(5)
-                continue
-            self._enabled = False
+        """
+        Applies the config. GWs with the same connection settings are kept, and only their added and removed mappings
+        are applied on the remote GW, so the other objects stay in sync while the config is applied.
+        """
+        with self._config_lock:
             self._polling_interval = self._config.get('polling_interval', 60)
+            self._sensor_push_deadband = float(self._config.get('sensor_push_deadband') or 0.1)
+            self._sensor_push_interval = max(1, int(self._config.get('sensor_push_interval', 5)))
+            self._sensor_push_fallback_interval = int(self._config.get('sensor_push_fallback_interval', 600))
+            self._reconcile_interval = int(self._config.get('reconcile_interval', 0))
+            self._relay_fanout = max(0, int(self._config.get('relay_fanout', 0)))
+            old_name = self._name
             self._name = self._config.get('local_name', '')
-            self._gateways = {}
-            self._mappings = {
-                "output": {},
-                "input": {},
-                "shutter": {}
-                }
 
             for obj_type in ["input", "output", "shutter"]:
                 method = f"get_{obj_type}_configurations"
@@ -183,25 +485,77 @@ class Syncer(OMPluginBase):
                         short_obj["type"] = obj.get("type")
                     short_local_conf.append(short_obj)
                 self._local_confs[obj_type] = short_local_conf
-
-            for gateway in self._config.get('gateways', ''):
-                self.process_gw_config(gateway)
-                self.process_mapping_config(gateway)
-
+                # fetched once, instead of for every mapping
+                method = f"get_{obj_type}_status"
+                self._local_states[obj_type] = json.loads(getattr(self.webinterface, method)()).get("status")
+
+            # GWs with the same connection settings are kept, only their changed mappings are applied
+            gateway_configs = OrderedDict((gw.get('gateway_ip', ''), gw) for gw in self._config.get('gateways', ''))
+            kept = {}
+            removed = {}
+            for ip, gateway in self._gateways.items():
+                gw = gateway_configs.get(ip)
+                if gw is not None and [gateway.get('username'), gateway.get('password')] == [gw.get('username', ''), gw.get('password', '')]:
+                    kept[ip] = gateway
+                else:
+                    removed[ip] = gateway
+            if removed:
+                self._delete_old_config(removed)
+                for gateway in removed.values():
+                    gateway['worker'].stop()
+                    gateway['session'].close()
+            self._gateways = kept
+
+            # every GW is loaded on its own thread, so a slow or offline GW doesn't delay the others
+            threads = []
+            for ip, gateway in gateway_configs.items():
+                if ip in kept:
+                    thread = Thread(target=self._update_gateway, args=(gateway, old_name != self._name))
+                else:
+                    thread = Thread(target=self._process_gateway, args=(gateway,))
+                thread.setName(f"Syncer config {ip}")
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+
+            self._tables = MappingTables(remote_mappings=[remote_mapping for gateway in self._gateways.values()
+                                                          for remote_mapping in gateway.get('remote_mappings', ())],
+                                         local_states=self._local_states)
             for obj_type in ["input", "output", "shutter"]:
-                logger.info(f"{obj_type.capitalize()}  mapping: {self._mappings.get(obj_type)}")
-
-            _gateways = copy.deepcopy(self._gateways)
-            for gateway in _gateways.values():
-                gateway.pop("headers")
-                gateway.pop("remote_confs")
-                if gateway.get("enabled"):
-                    self._enabled = True
+                mapping = dict((local_id, [dict(remote) for remote in remotes])
+                               for local_id, remotes in self._tables.remotes.get(obj_type).items())
+                logger.info(f"{obj_type.capitalize()}  mapping: {mapping}")
+
+            _gateways = dict((ip, copy.deepcopy(dict((key, value) for key, value in gateway.items()
+                                                     if key not in ['headers', 'session', 'health', 'worker', 'remote_confs',
+                                                                    'remote_groups', 'pushed_sensor_values',
+                                                                    'pending_sensor_values', 'sensor_confs'])))
+                             for ip, gateway in self._gateways.items())
+            self._enabled = any(gateway.get("enabled") for gateway in _gateways.values())
             logger.info(f"Gateways: {_gateways}")
             del _gateways
 
             logger.info('Syncer is {0}'.format('enabled' if self._enabled else 'disabled'))
-            break
+
+
+    def _process_gateway(self, gw):
+        self.process_gw_config(gw)
+        try:
+            self.process_mapping_config(gw)
+        except Exception as ex:
+            logger.error(f"Could not load mappings for GW {gw.get('gateway_ip')}: {ex}")
+
+    def _update_gateway(self, gw, rename_all):
+        gateway = self._gateways[gw.get('gateway_ip', '')]
+        gw_name = gw.get('remote_name')
+        gateway.update({'name': gw_name if gw_name not in ['', None] else gateway.get('ip'),
+                        'push_sensors': bool(gw.get('push_sensors', False)),
+                        'peer_syncer': bool(gw.get('peer_syncer', False))})
+        try:
+            self.update_mapping_config(gw, rename_all)
+        except Exception as ex:
+            logger.error(f"Could not update mappings for GW {gw.get('gateway_ip')}: {ex}")
 
     def process_gw_config(self, gw):
         ip = gw.get('gateway_ip', '')
@@ -216,18 +570,37 @@ class Syncer(OMPluginBase):
         headers = {
             'X-Requested-With': 'OpenMotics plugin: Syncer'
         }
+        token = self._tokens.get(f"{ip}/{username}")
+        if token is not None:
+            headers['Authorization'] = 'Bearer {0}'.format(token)
         endpoint = 'https://{0}'.format(ip)
 
         enabled = '' not in [ip, username, password]
 
+        # keep-alive connection, so only the first call does a TLS handshake
+        session = requests.Session()
+        health = GatewayHealth()
+
         self._gateways[ip] = {
             'ip': ip,
             'name': gw_name,
             'username': username,
             'password': password,
             'headers': headers,
+            'session': session,
+            'health': health,
+            'worker': RemoteWorker(gw_name, health, probe=lambda: self._probe_gateway(ip)),
             'endpoint': endpoint,
-            'enabled': enabled
+            'enabled': enabled,
+            'push_sensors': bool(gw.get('push_sensors', False)),
+            'peer_syncer': bool(gw.get('peer_syncer', False)),
+            'pushed_sensor_values': {},
+            'pending_sensor_values': {},
+            'mapped_types': set(),
+            'sensor_confs': [],
+            'sensor_mapping': {},
+            'remote_mappings': (),
+            'remote_confs': None
         }
 
         try:
@@ -237,10 +610,131 @@ class Syncer(OMPluginBase):
 
     def process_mapping_config(self, gw):
         ip = gw.get('gateway_ip')
+        gateway = self._gateways[ip]
+        # the mappings are loaded even if the GW is down, so its updates are kept until it is back
+        gateway['mapped_types'], gateway['sensor_confs'], gateway['remote_mappings'] = self._load_mappings(gw)
+
+        try:
+            self.setup_remote_objects(ip)
+        except RemoteUnavailableError as ex:
+            logger.warning(f"GW {gateway.get('name')} is unavailable, its names and sensors are set up once it is back: {ex}")
+        self.push_initial_states(ip, [self._get_state_update(ip, obj_type, local_id, remote,
+                                                             self._local_states.get(obj_type)[local_id])
+                                      for obj_type, local_id, remote in gateway['remote_mappings']])
+
+    def update_mapping_config(self, gw, rename_all=False):
+        """
+        Applies the changed mappings of a GW that was loaded before: only the remote objects of added mappings are
+        renamed and get the local state, the ones of removed mappings get their own name back.
+        """
+        ip = gw.get('gateway_ip')
+        gateway = self._gateways[ip]
+        old_types = gateway['mapped_types']
+        old_mappings = gateway['remote_mappings']
+        mapped_types, sensor_confs, remote_mappings = self._load_mappings(gw)
+        old_keys = set(self._get_mapping_key(mapping) for mapping in old_mappings)
+        new_keys = set(self._get_mapping_key(mapping) for mapping in remote_mappings)
+        added = [mapping for mapping in remote_mappings if rename_all or self._get_mapping_key(mapping) not in old_keys]
+        removed = [mapping for mapping in old_mappings if self._get_mapping_key(mapping) not in new_keys]
+        gateway['mapped_types'], gateway['sensor_confs'], gateway['remote_mappings'] = mapped_types, sensor_confs, remote_mappings
+        logger.info(f"GW {gateway.get('name')}: {len(added)} mapping(s) added, {len(removed)} removed")
+        if gateway.get('remote_confs') is None:
+            # everything is set up once the GW is back
+            return
+
+        renames = {}
+        in_use = set(self._get_remote_key(remote) for _, _, remote in remote_mappings)
+        for obj_type, local_id, remote in removed:
+            remote_key = self._get_remote_key(remote)
+            if remote_key in in_use:
+                continue
+            try:
+                self.update_remote_config(obj_type=remote_key[0], ip=ip, remote_id=remote_key[1], restore=True,
+                                          renames=renames)
+            except Exception as ex:
+                logger.error(f"Error while restoring remote {obj_type} config: {ex}")
+        if mapped_types <= old_types:
+            for obj_type, local_id, remote in added:
+                remote_key = self._get_remote_key(remote)
+                try:
+                    self.update_remote_config(obj_type=remote_key[0], ip=ip, remote_id=remote_key[1],
+                                              local_name=remote.get('local_name'), renames=renames)
+                except Exception as ex:
+                    logger.error(f"Error while updating remote {obj_type} config: {ex}")
+            self._update_sensor_mapping(ip)
+        for obj_type, configs in renames.items():
+            try:
+                self.set_remote_configurations(obj_type=obj_type, ip=ip, configs=configs)
+            except Exception as ex:
+                logger.error(f"Error while updating remote {obj_type} config: {ex}")
+        if not mapped_types <= old_types:
+            # the configurations of the newly mapped types are needed
+            self.setup_remote_objects(ip)
+        self.push_initial_states(ip, [self._get_state_update(ip, obj_type, local_id, remote,
+                                                             self._local_states.get(obj_type)[local_id])
+                                      for obj_type, local_id, remote in added])
+
+    def _load_mappings(self, gw):
+        """ Returns the mapped types, the sensor mappings and (type, local id, remote) for the other mappings of a GW """
+        ip = gw.get('gateway_ip')
+        mapped_types = set(entry.get("type")[0] for entry in gw.get("mappings", []) if entry.get("type"))
+        sensor_confs = []
+        remote_mappings = []
+        for entry in gw.get("mappings", []):
+            try:
+                obj_type = entry.get("type")[0]
+                pi_conf = entry.get("type")[1]
+                if obj_type == "sensor":
+                    sensor_confs.append(pi_conf)
+                elif obj_type in [
+                    "output",
+                    "input",
+                    "shutter"
+                                  ]:
+                    method = f"process_{obj_type}_config"
+                    getattr(self, method)(pi_conf, ip, remote_mappings)
+
+            except Exception as ex:
+                logger.info(ex)
+        return mapped_types, sensor_confs, tuple(remote_mappings)
+
+    @staticmethod
+    def _get_mapping_key(mapping):
+        obj_type, local_id, remote = mapping
+        return obj_type, local_id, tuple(sorted(remote.items()))
+
+    @staticmethod
+    def _get_remote_key(remote):
+        """ Returns (type, id) of the remote object(s) of a mapping, shutter groups have their own type """
+        obj_type = remote.get('type')
+        if obj_type == "shutter" and remote.get('is_shutter_group'):
+            obj_type = "shuttergroup"
+        return obj_type, remote.get('remote')
+
+    def _get_state_update(self, ip, obj_type, local_id, remote, state):
+        """ Returns the (key, function, kwargs) for the worker of the GW, to send a local state to a remote object """
+        remote_id = remote.get('remote')
+        if obj_type == "shutter":
+            is_shutter_group = remote.get('is_shutter_group')
+            return ((f"shutter{'group' if is_shutter_group else ''}", remote_id), self.update_remote_shutter_state,
+                    dict(ip=ip, remote_id=remote_id, state=state, reverse=remote.get('reverse'),
+                         is_shutter_group=is_shutter_group))
+        return ((obj_type, remote_id), self.update_remote_io_state,
+                dict(obj_type=obj_type, ip=ip, remote_id=remote_id, state=state))
+
+    def setup_remote_objects(self, ip):
+        """
+        Loads the remote configurations, registers the mapped sensors and renames the mapped remote objects. The remote
+        names are set with one call per type.
+        """
+        gateway = self._gateways[ip]
         remote_confs = {}
         for obj_type in ["shutter", "sensor", "output", "input"]:
-            remote_conf = self._call_remote(f'get_{obj_type}_configurations', self._gateways[ip]).get('config')
-            short_remote_conf = []
+            if obj_type not in gateway['mapped_types']:
+                remote_confs[obj_type] = MappingProxyType({})
+                continue
+            remote_conf = self._call_remote(f'get_{obj_type}_configurations', gateway).get('config')
+            short_remote_conf = {}
             for obj in remote_conf:
                 short_obj = {"id": obj.get("id"),
                              "initial_name": obj.get("name")}
@@ -254,29 +748,43 @@ class Syncer(OMPluginBase):
                                       "group_2": obj.get("group_2")})
                 elif obj_type == "output":
                     short_obj["type"] = obj.get("type")
-                short_remote_conf.append(short_obj)
-            remote_confs[obj_type] = short_remote_conf
-        self._gateways[ip]["remote_confs"] = remote_confs
-
-        sensor_mapping = {}
-        for entry in gw.get("mappings", []):
+                short_remote_conf[short_obj["id"]] = MappingProxyType(short_obj)
+            remote_confs[obj_type] = MappingProxyType(short_remote_conf)
+        # remote shutter group -> ids of its shutters
+        remote_groups = {}
+        for shutter in remote_confs["shutter"].values():
+            for group in [shutter.get("group_1"), shutter.get("group_2")]:
+                remote_groups.setdefault(group, []).append(shutter.get("id"))
+        gateway["remote_groups"] = MappingProxyType(dict((group, tuple(ids)) for group, ids in remote_groups.items()))
+        gateway["remote_confs"] = MappingProxyType(remote_confs)
+
+        self._update_sensor_mapping(ip)
+
+        renames = {}
+        for obj_type, local_id, remote in gateway['remote_mappings']:
+            remote_key = self._get_remote_key(remote)
             try:
-                obj_type = entry.get("type")[0]
-                pi_conf = entry.get("type")[1]
-                if obj_type == "sensor":
-                    sensor_mapping = self.process_sensor_config(pi_conf, ip, sensor_mapping)
-                elif obj_type in [
-                    "output",
-                    "input",
-                    "shutter"
-                                  ]:
-                    method = f"process_{obj_type}_config"
-                    getattr(self, method)(pi_conf, ip)
-
+                self.update_remote_config(obj_type=remote_key[0], ip=ip, remote_id=remote_key[1],
+                                          local_name=remote.get('local_name'), renames=renames)
             except Exception as ex:
-                logger.info(ex)
+                logger.error(f"Error while updating remote {obj_type} config: {ex}")
+        for obj_type, configs in renames.items():
+            try:
+                self.set_remote_configurations(obj_type=obj_type, ip=ip, configs=configs)
+            except Exception as ex:
+                logger.error(f"Error while updating remote {obj_type} config: {ex}")
 
-        self._gateways[ip]["sensor_mapping"] = sensor_mapping
+    def _update_sensor_mapping(self, ip):
+        # sensors that were registered before are kept
+        gateway = self._gateways[ip]
+        sensor_mapping = {}
+        for pi_conf in gateway['sensor_confs']:
+            registered = gateway['sensor_mapping'].get(pi_conf.get('remote_sensor_id'))
+            if registered is not None:
+                sensor_mapping[pi_conf.get('remote_sensor_id')] = registered
+            else:
+                sensor_mapping = self.process_sensor_config(pi_conf, ip, sensor_mapping)
+        gateway["sensor_mapping"] = sensor_mapping
 
     def process_sensor_config(self, pi_sensor_conf, ip, current_mapping):
         # Specific for each remote GW as this is remote 2 local. A loop over every remote GW will occur and this
@@ -288,32 +796,30 @@ class Syncer(OMPluginBase):
             remote_sensor_id = pi_sensor_conf.get('remote_sensor_id', -1)
             if remote_sensor_id < 0:
                 raise RuntimeError("Please give valid sensor ids")
-            for remote_sensor in remote_sensor_conf:
-                if remote_sensor.get('id') == remote_sensor_id:
-                    external_id = f"syncer/{ip}/{remote_sensor.get('external_id')}"
-                    sensor = self.connector.sensor.register(external_id=external_id,
-                                                            physical_quantity=remote_sensor.get(
-                                                                'physical_quantity'),
-                                                            unit=remote_sensor.get('unit'),
-                                                            name=f"{gw_name}/{remote_sensor.get('name')}")
-                    current_mapping[remote_sensor_id] = {"sensor_dto": sensor}
+            remote_sensor = remote_sensor_conf.get(remote_sensor_id)
+            if remote_sensor is not None:
+                external_id = f"syncer/{ip}/{remote_sensor.get('external_id')}"
+                sensor = self.connector.sensor.register(external_id=external_id,
+                                                        physical_quantity=remote_sensor.get(
+                                                            'physical_quantity'),
+                                                        unit=remote_sensor.get('unit'),
+                                                        name=f"{gw_name}/{remote_sensor.get('name')}")
+                current_mapping[remote_sensor_id] = {"sensor_dto": sensor}
         except Exception as ex:
             logger.exception(f'Could not load sensor mapping for GW with ip {ip}: {ex}')
         return current_mapping
 
-    def process_output_config(self, pi_output_conf, ip):
-        self.process_io_config(pi_output_conf, ip, 'output')
+    def process_output_config(self, pi_output_conf, ip, remote_mappings):
+        self.process_io_config(pi_output_conf, ip, 'output', remote_mappings)
 
-    def process_input_config(self, pi_input_conf, ip):
-        self.process_io_config(pi_input_conf, ip, 'input')
+    def process_input_config(self, pi_input_conf, ip, remote_mappings):
+        self.process_io_config(pi_input_conf, ip, 'input', remote_mappings)
 
-    def process_io_config(self, pi_io_conf, ip, obj_type):
-        # Global output_mapping variable because this is local 2 remote, thus if local output changes -> mapping to
-        # remote outputs will happen. One specific local output changes to different remote output changes
+    def process_io_config(self, pi_io_conf, ip, obj_type, remote_mappings):
+        # Local 2 remote, thus if a local output changes -> mapping to remote outputs will happen. The mappings of all
+        # GWs are compiled into the lookup tables once they are loaded.
         local_io_conf = self._local_confs.get(obj_type)
-        mapping = self._mappings.get(obj_type)
 
-        # Organise local output data and their mapping with one or more remote outputs by making use of a dict
         try:
             local_id = int(pi_io_conf.get(f'local_{obj_type}_id', -1))
             remote_id = int(pi_io_conf.get(f'remote_{obj_type}_id', -1))
@@ -322,46 +828,23 @@ class Syncer(OMPluginBase):
             if local_io_conf[local_id].get("type", "") == 127 and obj_type == "output":
                 raise RuntimeError(
                     f"Skipped because {local_id} is a shutter, please include it in the shutter config instead")
-            method = f"get_{obj_type}_status"
-            state = json.loads(getattr(self.webinterface, method)()).get("status")[local_id]
             config = local_io_conf[local_id]
-            if local_id not in mapping.keys():
-                mapping[local_id] = {
-                    'remotes': [],
-                    'config': config,
-                    'state': state
-                }
-
             local_name = config.get('name') if config.get("name") != "" else local_id
-
-            mapping[local_id]['remotes'].append({
+            remote_mappings.append((obj_type, local_id, {
+                'type': obj_type,
                 'remote': remote_id,
                 'gw': ip,
-                'name': f"{self._name}/{local_name}"
-            })
-
-            self._mappings[obj_type] = mapping
+                'name': f"{self._name}/{local_name}",
+                'local_name': local_name
+            }))
 
         except Exception as ex:
             raise RuntimeError(f'Could not load {obj_type} mapping for GW with ip {ip}: {ex}')
 
-        try:
-            self.update_remote_config(obj_type=obj_type, ip=ip, remote_id=remote_id, local_name=local_name)
-        except Exception as ex:
-            raise RuntimeError(f"Error while updating remote {obj_type} config: {ex}")
-
-        try:
-            self.update_remote_io_state(obj_type=obj_type, ip=ip, remote_id=remote_id, state=state)
-        except Exception as ex:
-            raise RuntimeError(f"Error while updating remote {obj_type} state: {ex}")
-
-    def process_shutter_config(self, pi_shutter_conf, ip):
-        # Global shutter mapping
+    def process_shutter_config(self, pi_shutter_conf, ip, remote_mappings):
         local_shutter_confs = self._local_confs.get("shutter")
         local_output_conf = self._local_confs.get("output")
-        mapping = self._mappings.get("shutter")
 
-        # Organise local shutter data and their mapping with one or more remote shutters by making use of a dict
         try:
             local_id = int(pi_shutter_conf.get('local_shutter_id', -1))
             remote_id = int(pi_shutter_conf.get('remote_shutter_id', -1))
@@ -375,78 +858,167 @@ class Syncer(OMPluginBase):
                     f"Skipped because {local_id} is not a shutter, please include it in the output config instead")
 
             config = local_shutter_confs[local_id]
-            local_state = json.loads(self.webinterface.get_shutter_status()).get("status")[local_id]
-            if local_id not in mapping.keys():
-                mapping[local_id] = {
-                    'remotes': [],
-                    'config': config,
-                    'state': local_state
-                }
-
             local_name = config.get("name") if config.get("name") not in ["", None] else local_id
-
-            mapping[local_id]['remotes'].append({
+            remote_mappings.append(("shutter", local_id, {
+                'type': "shutter",
                 'remote': remote_id,
                 'gw': ip,
                 'name': f"{self._name}/{local_name}",
+                'local_name': local_name,
                 'reverse': reverse,
                 'is_shutter_group': is_shutter_group
-            })
-            self._mappings["shutter"] = mapping
+            }))
         except Exception as ex:
             raise RuntimeError(f'Could not load shutter mapping for GW with ip {ip}: {ex}')
 
-        try:
-            self.update_remote_config(obj_type=f"shutter{'group' if is_shutter_group else ''}",
-                                      ip=ip, remote_id=remote_id, local_name=local_name)
-        except Exception as ex:
-            raise RuntimeError(f"Error while updating remote shutter config: {ex}")
-
-        try:
-            self.update_remote_shutter_state(ip=ip, remote_id=remote_id, state=local_state, reverse=reverse,
-                                             is_shutter_group=is_shutter_group)
-        except Exception as ex:
-            raise RuntimeError(f"Error while updating remote shutter state: {ex}")
-
-    def update_remote_config(self, obj_type, ip, remote_id, local_name=None, restore=False):
-        configs_to_set = []
+    def update_remote_config(self, obj_type, ip, remote_id, local_name=None, restore=False, renames=None):
+        """
+        Renames the remote object(s). With renames, the configs are collected per type to be set with
+        set_remote_configurations instead.
+        """
+        gateway = self._gateways.get(ip)
         if obj_type == "shuttergroup":
             obj_type = "shutter"
-            remote_conf = self._gateways.get(ip).get('remote_confs').get(obj_type)
-            for shutter in remote_conf:
-                if shutter.get("group_1") == remote_id or shutter.get("group_2") == remote_id:
-                    configs_to_set.append(shutter)
+            remote_ids = gateway.get('remote_groups').get(remote_id, ())
         else:
-            remote_conf = self._gateways.get(ip).get('remote_confs').get(obj_type)
-            configs_to_set = [remote_conf[remote_id]]
+            remote_ids = (remote_id,)
+        remote_conf = gateway.get('remote_confs').get(obj_type)
+
+        configs = []
+        for remote_id in remote_ids:
+            conf = remote_conf.get(remote_id)
+            if conf is None:
+                raise RuntimeError(f"Remote {obj_type} {ip}/{remote_id} does not exist")
+            old_name = conf.get('initial_name')
+            initial_name = old_name
+            if ' (also controlled by syncer plugin ' in old_name:
+                initial_name = old_name.split(' (also controlled by syncer plugin ')[0]
+
+            if not restore:
+                name_to_set = f"{initial_name} (also controlled by syncer plugin {self._name}/{local_name})"
 
-        logger.debug(f"Confs_to_set: {configs_to_set}")
+            else:
+                name_to_set = initial_name
 
-        for conf in configs_to_set:
-            remote_id = conf.get("id")
-            try:
-                old_name = conf.get('initial_name')
-                initial_name = old_name
-                if ' (also controlled by syncer plugin ' in old_name:
-                    initial_name = old_name.split(' (also controlled by syncer plugin ')[0]
+            config = {'id': remote_id, 'name': name_to_set}
+            if obj_type == "shutter":
+                config.update({"group_1": conf.get("group_1"), "group_2": conf.get("group_2")})
+            configs.append(config)
+            logger.debug(f"Set name of remote {obj_type} {ip}/{remote_id} from {old_name} to {name_to_set}")
 
-                if not restore:
-                    name_to_set = f"{initial_name} (also controlled by syncer plugin {self._name}/{local_name})"
+        if renames is not None:
+            renames.setdefault(obj_type, []).extend(configs)
+        else:
+            self.set_remote_configurations(obj_type=obj_type, ip=ip, configs=configs)
 
-                else:
-                    name_to_set = initial_name
-
-                remote_conf[remote_id]['name'] = name_to_set
-                config = {'id': remote_id, 'name': name_to_set}
-                if obj_type == "shutter":
-                    config.update({"group_1": conf.get("group_1"), "group_2": conf.get("group_2")})
-                self._call_remote(f"set_{obj_type}_configuration?config={json.dumps(config)}", gateway=self._gateways[ip])
-                logger.debug(f"Set name of remote {obj_type} {ip}/{remote_id} from {old_name} to {name_to_set}")
+    def set_remote_configurations(self, obj_type, ip, configs):
+        if not configs:
+            return
+        try:
+            self._call_remote(f"set_{obj_type}_configurations", params={"config": json.dumps(configs)},
+                              gateway=self._gateways[ip])
+            logger.info(f"Set the name of {len(configs)} remote {obj_type}(s) on GW {self._gateways[ip].get('name')}")
+        except Exception as ex:
+            raise RuntimeError(f"Could not set configuration of remote {obj_type}s {ip}/{[config.get('id') for config in configs]}: {ex}")
+
+    def push_initial_states(self, ip, states):
+        """
+        Queues the local states on the worker of the GW. The remote status is fetched once per type, so remote outputs
+        and inputs that already have the right state are skipped. A GW with peer_syncer gets the outputs and inputs in
+        one relay call, the GW API itself has no call to set several objects.
+        """
+        gateway = self._gateways[ip]
+        remote_states = {}
+        for obj_type in set(key[0] for key, _, _ in states if key[0] in ["output", "input"]):
+            try:
+                remote_status = self._call_remote(f"get_{obj_type}_status", gateway).get("status")
+                remote_states[obj_type] = dict((remote.get("id"), remote) for remote in remote_status)
             except Exception as ex:
-                raise RuntimeError(f'Could not set configuration of remote {obj_type} {ip}/{remote_id}: {ex}')
-        self._gateways[ip]['remote_confs'][obj_type] = remote_conf
+                logger.info(f"Could not get remote {obj_type} status of GW {gateway.get('name')}: {ex}")
+        skipped = 0
+        batch = []
+        for key, function, kwargs in states:
+            remote_state = remote_states.get(key[0], {}).get(key[1])
+            if remote_state is not None and self._is_same_io_state(kwargs.get('state'), remote_state):
+                skipped += 1
+                continue
+            if gateway.get('peer_syncer') and function == self.update_remote_io_state:
+                batch.append((key, function, kwargs))
+                continue
+            gateway['worker'].submit(key, function, **kwargs)
+        if len(batch) == 1:
+            gateway['worker'].submit(batch[0][0], batch[0][1], **batch[0][2])
+        elif batch:
+            gateway['worker'].submit('initial_states', self.update_remote_io_states, ip=ip, states=batch)
+        logger.info(f"Queued {len(states) - skipped} state update(s) for GW {gateway.get('name')}, {skipped} already up to date")
+
+    def update_remote_io_states(self, ip, states):
+        """
+        Sends the states of several remote outputs and inputs to a GW with peer_syncer, as a relay without children.
+        When the call fails for another reason than the GW being unavailable, the states are sent one by one.
+        """
+        gateway = self._gateways[ip]
+        updates = [[kwargs['obj_type'], kwargs['remote_id'], bool(kwargs['state'].get('status')),
+                    kwargs['state'].get('dimmer') if kwargs['state'].get('dimmer') not in ['', None] else None]
+                   for _, _, kwargs in states]
+        event_id = uuid.uuid4().hex
+        self._relay_events.add(event_id, True, origin=self._name)
+        try:
+            self._call_remote('plugins/Syncer/receive_relay', gateway,
+                              params={'source': self._name, 'event_id': event_id,
+                                      'tree': json.dumps({'updates': updates, 'children': {}}), 'covered': json.dumps([])})
+        except RemoteUnavailableError:
+            raise
+        except Exception as ex:
+            logger.info(f"Could not send {len(states)} states to GW {gateway.get('name')} at once, sending them one by one: {ex}")
+            # on this worker, so a newer state that was queued meanwhile is still sent after these
+            for _, function, kwargs in states:
+                try:
+                    function(**kwargs)
+                except RemoteUnavailableError:
+                    raise
+                except Exception as ex:
+                    logger.error(f"Error updating GW {gateway.get('name')}: {ex}")
+            return
+        for _, _, kwargs in states:
+            self._echo_cache.add((ip, kwargs['obj_type'], kwargs['remote_id']), kwargs['state'], origin=self._name)
+        logger.info(f"Updated {len(states)} remote outputs and inputs on GW {gateway.get('name')}")
+
+    def _probe_gateway(self, ip):
+        gateway = self._gateways[ip]
+        self._call_remote("get_status", gateway, probe=True)
+        logger.info(f"GW {gateway.get('name')} is available again")
+        if gateway.get('remote_confs') is None:
+            try:
+                self.setup_remote_objects(ip)
+            except Exception as ex:
+                logger.error(f"Could not set up the objects of GW {gateway.get('name')}: {ex}")
+        # the remote objects may have changed while the GW was down, so the current local states are sent again
+        local_states = self._tables.states
+        states = []
+        for obj_type, local_id, remote in gateway['remote_mappings']:
+            state = local_states.get(obj_type, {}).get(local_id)
+            if obj_type not in ["output", "input"] or state is None:
+                continue
+            self._echo_cache.discard((ip, obj_type, remote.get('remote')))
+            states.append(self._get_state_update(ip, obj_type, local_id, remote, state))
+        self.push_initial_states(ip, states)
+
+    @staticmethod
+    def _is_same_io_state(state, remote_state):
+        if bool(state.get('status')) != bool(remote_state.get('status')):
+            return False
+        dimmer = state.get('dimmer')
+        remote_dimmer = remote_state.get('dimmer')
+        return dimmer in ['', None] or remote_dimmer in ['', None] or dimmer == remote_dimmer
+
+    def update_remote_io_state(self, obj_type, ip, remote_id, state, covered=()):
+        gateway = self._gateways[ip]
+        written = self._echo_cache.get((ip, obj_type, remote_id))
+        if written is not None and self._is_same_io_state(state, written[0]):
+            logger.debug(f"Remote {obj_type} {remote_id} on GW {gateway.get('name')} already has this state")
+            return
 
-    def update_remote_io_state(self, obj_type, ip, remote_id, state):
         params = {
             "id": remote_id,
             "is_on": state.get('status')
@@ -458,12 +1030,20 @@ class Syncer(OMPluginBase):
             })
 
         try:
-            self._call_remote(api_call=f"set_{obj_type}", params=params, gateway=self._gateways[ip])
+            if gateway.get('peer_syncer'):
+                # the other Syncer tags the change with our name, so it isn't sent back, nor to the GWs we update
+                params.update({"source": self._name, "obj_type": obj_type, "covered": json.dumps(list(covered))})
+                self._call_remote(api_call="plugins/Syncer/receive_remote_write", params=params, gateway=gateway)
+            else:
+                self._call_remote(api_call=f"set_{obj_type}", params=params, gateway=gateway)
+            self._echo_cache.add((ip, obj_type, remote_id), state, origin=self._name)
             logger.info(
-                f"Updated remote {obj_type} {remote_id} on GW {self._gateways[ip].get('name')} to {'on' if state.get('status') in [1, True] else 'off'} {'' if state.get('dimmer') in ['', None] else '(' + str(state.get('dimmer')) + '%)'}")
+                f"Updated remote {obj_type} {remote_id} on GW {gateway.get('name')} to {'on' if state.get('status') in [1, True] else 'off'} {'' if state.get('dimmer') in ['', None] else '(' + str(state.get('dimmer')) + '%)'}")
+        except RemoteUnavailableError:
+            raise
         except Exception as ex:
             raise RuntimeError(
-                f"Could not set state of remote {obj_type} {self._gateways[ip].get('name')}/{remote_id}: {ex}")
+                f"Could not set state of remote {obj_type} {gateway.get('name')}/{remote_id}: {ex}")
 
     def update_remote_shutter_state(self, ip, remote_id, state, reverse, is_shutter_group):
         try:
@@ -495,6 +1075,8 @@ class Syncer(OMPluginBase):
 
                 logger.info(
                     f"Updated remote shutter{group[:-1]} {remote_id} on GW {self._gateways[ip].get('name')} to {print_state}")
+        except RemoteUnavailableError:
+            raise
         except Exception as ex:
             raise RuntimeError(
                 f"Could not set state of remote shutter{'group' if is_shutter_group else ''} {self._gateways[ip].get('name')}/{remote_id}: {ex}")
@@ -505,51 +1087,322 @@ class Syncer(OMPluginBase):
             if not self._enabled:
                 time.sleep(10)
                 continue
-            try:
-                # Sync sensor values:
-                for gateway in self._gateways.values():
-                    sensor_mapping = gateway.get('sensor_mapping')
-                    if sensor_mapping == {}:
-                        continue
+            # Sync sensor values:
+            for gateway in list(self._gateways.values()):
+                sensor_mapping = gateway.get('sensor_mapping')
+                if sensor_mapping == {} or gateway['health'].is_down():
+                    continue
+                # a GW that pushes its sensor changes is only checked now and then
+                now = time.time()
+                if now - gateway.get('last_push', 0) < self._sensor_push_fallback_interval and \
+                        now - gateway.get('last_poll', 0) < self._sensor_push_fallback_interval:
+                    continue
+                gateway['last_poll'] = now
+                try:
                     sensor_status = self._call_remote('get_sensor_status', gateway).get('status')
 
                     for sensor in sensor_status:
-                        local_sensor = sensor_mapping.get(sensor.get('id'), None)
-                        if local_sensor is None:
-                            logger.debug(f"Did not update sensor value because there is remote sensor coupled to this sensor {sensor}")
-                            continue
-                        if sensor.get('value', None) == local_sensor.get('value'):
-                            logger.debug(f"Did not update sensor value because there is no temperature change")
-                            continue
-                        self.connector.sensor.report_status(sensor=local_sensor.get('sensor_dto'),
-                                                           value=sensor.get('value'))
-                        sensor_mapping[sensor['id']]['value'] = sensor.get('value')
-                        logger.info(
-                            f"Updated {local_sensor.get('sensor_dto').name} with value {sensor.get('value')} from remote sensor ({gateway.get('ip')}) with id {sensor.get('id')}")
-            except Exception as ex:
-                logger.exception('Error while syncing sensors: {0}'.format(ex))
+                        self._update_local_sensor(gateway, sensor.get('id'), sensor.get('value', None))
+                except RemoteUnavailableError as ex:
+                    logger.debug(f"Could not sync the sensors of GW {gateway.get('name')}: {ex}")
+                except Exception as ex:
+                    logger.exception('Error while syncing sensors: {0}'.format(ex))
             time.sleep(self._polling_interval)
 
+    @background_task
+    def run_reconcile(self):
+        while True:
+            time.sleep(self._reconcile_interval if self._reconcile_interval > 0 else 60)
+            if not self._enabled or self._reconcile_interval <= 0:
+                continue
+            for ip, gateway in list(self._gateways.items()):
+                if gateway.get('enabled') and gateway.get('remote_confs') is not None and not gateway['health'].is_down():
+                    gateway['worker'].submit('reconcile', self._reconcile, ip=ip)
+
+    def _reconcile(self, ip):
+        """
+        Corrects the remote outputs and inputs that no longer have the local state, e.g. after a lost event. A GW with
+        the Syncer plugin compares a digest per type first, so the states are only fetched for the types that differ.
+        """
+        gateway = self._gateways.get(ip)
+        if gateway is None:
+            return
+        local_states = self._tables.states
+        # type -> remote id -> (local id, remote, state)
+        expected = {}
+        for obj_type, local_id, remote in gateway['remote_mappings']:
+            state = local_states.get(obj_type, {}).get(local_id)
+            if obj_type in ["output", "input"] and state is not None:
+                expected.setdefault(obj_type, {})[remote.get('remote')] = (local_id, remote, state)
+        obj_types = list(expected)
+        if gateway.get('peer_syncer') and obj_types:
+            objects = dict((obj_type, [[remote_id, state.get('dimmer') not in ['', None]]
+                                       for remote_id, (_, _, state) in states.items()])
+                           for obj_type, states in expected.items())
+            try:
+                digests = self._call_remote('plugins/Syncer/get_state_digest', gateway,
+                                            params={'objects': json.dumps(objects)}).get('digests', {})
+                obj_types = [obj_type for obj_type in obj_types
+                             if digests.get(obj_type) != self._get_state_digest([(remote_id, state, state.get('dimmer') not in ['', None])
+                                                                                  for remote_id, (_, _, state) in expected[obj_type].items()])]
+            except RemoteUnavailableError:
+                raise
+            except Exception as ex:
+                logger.debug(f"Could not get the state digest of GW {gateway.get('name')}, comparing all states: {ex}")
+        if not obj_types:
+            logger.debug(f"Remote outputs and inputs of GW {gateway.get('name')} are in sync")
+            return
+        states = []
+        for obj_type in obj_types:
+            for remote_id, (local_id, remote, state) in expected[obj_type].items():
+                # what was written before doesn't count, the remote state is compared instead
+                self._echo_cache.discard((ip, obj_type, remote_id))
+                states.append(self._get_state_update(ip, obj_type, local_id, remote, state))
+        self.push_initial_states(ip, states)
+
+    @staticmethod
+    def _get_state_digest(entries):
+        """ Digest over (id, state, with dimmer) entries, the same on both GWs if the states match """
+        canonical = [[obj_id, bool(state.get('status')), state.get('dimmer') if with_dimmer else None]
+                     for obj_id, state, with_dimmer in sorted(entries, key=lambda entry: entry[0])]
+        return hashlib.sha1(json.dumps(canonical).encode('utf-8')).hexdigest()[:16]
+
+    @om_expose
+    def get_state_digest(self, objects):
+        """
+        Returns a digest per type over the states of the given local outputs and inputs, for the Syncer plugin on another
+        GW to check whether they still have the state it expects.
+        > objects = '{"output": [[<id>, <with dimmer>], ...], "input": [[<id>, false], ...]}'
+        """
+        digests = {}
+        for obj_type, ids in json.loads(objects).items():
+            if obj_type not in ["output", "input"]:
+                continue
+            method = f"get_{obj_type}_status"
+            status = dict((state.get('id'), state) for state in json.loads(getattr(self.webinterface, method)()).get('status'))
+            digests[obj_type] = self._get_state_digest([(obj_id, status.get(obj_id, {}), with_dimmer) for obj_id, with_dimmer in ids])
+        return json.dumps({'success': True, 'digests': digests})
+
+    def _update_local_sensor(self, gateway, remote_sensor_id, value):
+        sensor_mapping = gateway.get('sensor_mapping', {})
+        local_sensor = sensor_mapping.get(remote_sensor_id, None)
+        if local_sensor is None:
+            logger.debug(f"Did not update sensor value because there is no local sensor coupled to remote sensor {remote_sensor_id}")
+            return
+        if value == local_sensor.get('value'):
+            logger.debug(f"Did not update sensor value because there is no temperature change")
+            return
+        self.connector.sensor.report_status(sensor=local_sensor.get('sensor_dto'),
+                                           value=value)
+        local_sensor['value'] = value
+        logger.info(
+            f"Updated {local_sensor.get('sensor_dto').name} with value {value} from remote sensor ({gateway.get('ip')}) with id {remote_sensor_id}")
+
+    @background_task
+    def run_sensor_push(self):
+        while True:
+            time.sleep(self._sensor_push_interval)
+            if not self._enabled:
+                continue
+            for ip, gateway in list(self._gateways.items()):
+                if gateway.get('push_sensors') and gateway['pending_sensor_values']:
+                    # coalesced by the worker, a batch that is still queued will take the new values along
+                    gateway['worker'].submit('sensor_push', self._push_sensor_values, ip=ip)
+
+    def _push_sensor_values(self, ip):
+        gateway = self._gateways[ip]
+        with self._sensor_push_lock:
+            values = gateway['pending_sensor_values']
+            gateway['pending_sensor_values'] = {}
+        if not values:
+            return
+        try:
+            self._call_remote('plugins/Syncer/receive_sensor_push', gateway,
+                              params={'source': self._name, 'values': json.dumps(values)})
+        except Exception:
+            with self._sensor_push_lock:
+                # put the values back, unless there are newer ones
+                for sensor_id, value in values.items():
+                    gateway['pending_sensor_values'].setdefault(sensor_id, value)
+            raise
+        with self._sensor_push_lock:
+            gateway['pushed_sensor_values'].update(values)
+        logger.debug(f"Pushed {len(values)} sensor value(s) to GW {gateway.get('name')}")
+
+    def handle_sensor_status(self, event):
+        if not self._enabled:
+            return
+        sensor_id = event.data.get('id')
+        value = event.data.get('value')
+        if sensor_id is None or value is None:
+            return
+        with self._sensor_push_lock:
+            for gateway in list(self._gateways.values()):
+                if not gateway.get('push_sensors'):
+                    continue
+                pushed_value = gateway['pushed_sensor_values'].get(sensor_id)
+                if pushed_value is None or abs(value - pushed_value) >= self._sensor_push_deadband:
+                    gateway['pending_sensor_values'][sensor_id] = value
+                else:
+                    # back within the deadband of the value the other GW has
+                    gateway['pending_sensor_values'].pop(sensor_id, None)
+
+    @om_expose
+    def receive_sensor_push(self, source, values):
+        """
+        Receives the changed sensor values that the Syncer plugin on another GW pushes.
+        > values = '{"<remote sensor id>": <value>, ...}'
+        """
+        gateway = next((gateway for gateway in list(self._gateways.values()) if source in [gateway.get('name'), gateway.get('ip')]), None)
+        if gateway is None:
+            logger.warning(f"Received sensor values from unknown GW {source}")
+            return json.dumps({'success': False, 'msg': f"Unknown GW {source}"})
+        gateway['last_push'] = time.time()
+        for sensor_id, value in json.loads(values).items():
+            self._update_local_sensor(gateway, int(sensor_id), value)
+        return json.dumps({'success': True})
+
+    @om_expose
+    def receive_remote_write(self, source, obj_type, id, is_on, dimmer=None, covered=None):
+        """
+        Sets a local output or input on behalf of the Syncer plugin on another GW. The resulting event isn't sent back,
+        nor to the covered GWs, which get the change from the source as well.
+        > covered = '["<ip>", ...]'
+        """
+        state = {'status': str(is_on).lower() in ['true', '1'],
+                 'dimmer': int(dimmer) if dimmer not in ['', None] else None}
+        covered = json.loads(covered) if covered not in ['', None] else []
+        return self._apply_remote_write(source, obj_type, int(id), state, covered=covered)
+
+    def _apply_remote_write(self, source, obj_type, local_id, state, covered=()):
+        self._echo_cache.add(('local', obj_type, local_id), state, origin=source, covered=covered)
+        if obj_type == "output":
+            if state['dimmer'] is not None:
+                return self.webinterface.set_output(id=local_id, is_on=state['status'], dimmer=state['dimmer'])
+            return self.webinterface.set_output(id=local_id, is_on=state['status'])
+        if obj_type == "input":
+            return self.webinterface.set_input(id=local_id, is_on=state['status'])
+        return json.dumps({'success': False, 'msg': f"Unknown type {obj_type}"})
+
+    @om_expose
+    def receive_relay(self, source, event_id, tree, covered=None):
+        """
+        Applies a change relayed by the Syncer plugin on another GW to the local outputs and inputs, and forwards it to the
+        next GWs of the tree. Returns the parts of the tree it can't forward, the sender sends those directly. The covered
+        GWs get the change from the source or the tree, the local change is only sent to the other mapped GWs.
+        > tree = '{"updates": [[<type>, <id>, <is_on>, <dimmer>], ...], "children": {"<ip>": <tree>, ...}}'
+        > covered = '["<ip>", ...]'
+        """
+        if self._relay_events.get(event_id) is not None:
+            return json.dumps({'success': True, 'unreachable': {}})
+        self._relay_events.add(event_id, True, origin=source)
+        tree = json.loads(tree)
+        covered = json.loads(covered) if covered not in ['', None] else []
+        for obj_type, local_id, is_on, dimmer in tree.get('updates', []):
+            self._apply_remote_write(source, obj_type, int(local_id), {'status': bool(is_on), 'dimmer': dimmer},
+                                     covered=covered)
+        unreachable = {}
+        for ip, subtree in tree.get('children', {}).items():
+            gateway = self._gateways.get(ip)
+            if gateway is None or not gateway.get('peer_syncer') or gateway['health'].is_down():
+                unreachable[ip] = subtree
+                continue
+            gateway['worker'].submit(('relay', event_id), self._send_relay, source=source, ip=ip, event_id=event_id,
+                                     subtree=subtree, covered=covered)
+        return json.dumps({'success': True, 'unreachable': unreachable})
+
+    def _relay_change(self, obj_type, local_id, state, remote_ios, covered):
+        """
+        Sends the change to the first relay_fanout GWs with peer_syncer, which forward it along a spanning tree over the
+        others. Returns the remotes that still have to be updated directly.
+        """
+        updates = OrderedDict()
+        direct = []
+        for remote_io in remote_ios:
+            gateway = self._gateways.get(remote_io.get('gw'))
+            if gateway is not None and gateway.get('peer_syncer') and not gateway['health'].is_down():
+                updates.setdefault(remote_io.get('gw'), []).append([obj_type, remote_io.get('remote'),
+                                                                    bool(state.get('status')),
+                                                                    state.get('dimmer') if state.get('dimmer') not in ['', None] else None])
+            else:
+                direct.append(remote_io)
+        if len(updates) <= self._relay_fanout:
+            # every GW would be sent to directly anyway
+            return remote_ios
+        event_id = uuid.uuid4().hex
+        self._relay_events.add(event_id, True, origin=self._name)
+        for ip, subtree in self._build_relay_tree(sorted(updates.items()), self._relay_fanout).items():
+            # a newer change of the same local object replaces a relay that is still queued
+            self._gateways[ip]['worker'].submit(('relay', obj_type, local_id), self._send_relay, source=self._name, ip=ip,
+                                                event_id=event_id, subtree=subtree, covered=covered)
+        return direct
+
+    @staticmethod
+    def _build_relay_tree(updates, fanout):
+        """ Spanning tree over the (ip, updates) of the GWs: the n-th GW forwards to GW fanout * n + 1 up to fanout * (n + 1) """
+        nodes = [{'updates': gateway_updates, 'children': {}} for _, gateway_updates in updates]
+        tree = {}
+        for index, (ip, _) in enumerate(updates):
+            parent = tree if index < fanout else nodes[index // fanout - 1]['children']
+            parent[ip] = nodes[index]
+        return tree
+
+    @staticmethod
+    def _flatten_relay_tree(tree):
+        for ip, subtree in tree.items():
+            yield ip, subtree.get('updates', [])
+            for descendant in Syncer._flatten_relay_tree(subtree.get('children', {})):
+                yield descendant
+
+    def _send_relay(self, source, ip, event_id, subtree, covered=()):
+        try:
+            response = self._call_remote('plugins/Syncer/receive_relay', self._gateways[ip],
+                                         params={'source': source, 'event_id': event_id, 'tree': json.dumps(subtree),
+                                                 'covered': json.dumps(list(covered))})
+            unreachable = response.get('unreachable', {})
+        except Exception as ex:
+            logger.info(f"Could not relay change {event_id} to GW {self._gateways[ip].get('name')}, sending it directly: {ex}")
+            unreachable = {ip: subtree}
+        self._send_relay_directly(unreachable, covered)
+
+    def _send_relay_directly(self, tree, covered=()):
+        for ip, updates in self._flatten_relay_tree(tree):
+            gateway = self._gateways.get(ip)
+            if gateway is None:
+                logger.warning(f"Could not send a relayed change to unknown GW {ip}, the reconciliation will correct it")
+                continue
+            for obj_type, remote_id, is_on, dimmer in updates:
+                gateway['worker'].submit((obj_type, remote_id), self.update_remote_io_state, obj_type=obj_type, ip=ip,
+                                         remote_id=remote_id, state={'status': is_on, 'dimmer': dimmer if dimmer is not None else ''},
+                                         covered=covered)
+
     def handle_shutter_status(self, minimal_event, _):
         if not self._enabled:
             return
-        shutter_mapping = self._mappings.get("shutter")
-        for key, value in shutter_mapping.items():
-            if value.get('state') != minimal_event[key]:
-                state = minimal_event[key]
-                shutter_mapping[key]['state'] = state
-                logger.info(f"Shutter change detected: {key} {state}")
-                logger.info(f"Checking if remote shutters should be updated...")
-                try:
-                    for remote_shutter in value.get('remotes'):
-                        ip = remote_shutter.get('gw')
-                        remote_id = remote_shutter.get('remote')
-                        reverse = remote_shutter.get('reverse')
-                        is_shutter_group = remote_shutter.get('is_shutter_group')
-                        self.update_remote_shutter_state(ip=ip, remote_id=remote_id, state=state, reverse=reverse,
-                                                         is_shutter_group=is_shutter_group)
-                except Exception as ex:
-                    logger.exception(f"Error processing shutter event {state} of shutter {key}: {ex}")
+        tables = self._tables
+        local_states = tables.states["shutter"]
+        for key, remote_shutters in tables.shutters:
+            state = minimal_event[key]
+            if local_states.get(key) == state:
+                continue
+            local_states[key] = state
+            logger.info(f"Shutter change detected: {key} {state}")
+            logger.info(f"Checking if remote shutters should be updated...")
+            try:
+                for remote_shutter in remote_shutters:
+                    ip = remote_shutter.get('gw')
+                    gateway = self._gateways.get(ip)
+                    if gateway is None:
+                        continue
+                    remote_id = remote_shutter.get('remote')
+                    reverse = remote_shutter.get('reverse')
+                    is_shutter_group = remote_shutter.get('is_shutter_group')
+                    gateway['worker'].submit((f"shutter{'group' if is_shutter_group else ''}", remote_id),
+                                             self.update_remote_shutter_state,
+                                             ip=ip, remote_id=remote_id, state=state, reverse=reverse,
+                                             is_shutter_group=is_shutter_group)
+            except Exception as ex:
+                logger.exception(f"Error processing shutter event {state} of shutter {key}: {ex}")
 
     def handle_output_status(self, event):
         new_event = {'id': event.get('id'),
@@ -563,72 +1416,144 @@ class Syncer(OMPluginBase):
         self.handle_io_status(obj_type="input", event=new_event)
 
     def handle_io_status(self, obj_type, event):
-        if not self._enabled or event.get('id') not in self._mappings.get(obj_type):
+        tables = self._tables
+        remote_ios = tables.remotes.get(obj_type).get(event.get('id'))
+        if not self._enabled or remote_ios is None:
             return
-        local_id = event.get('id')
-        event.pop("id")
-
-        self._mappings[obj_type][local_id]["state"] = event
-        remote_ios = self._mappings.get(obj_type).get(local_id).get('remotes')
+        local_id = event.pop("id")
+
+        tables.states[obj_type][local_id] = event
+        # a write by another Syncer causes one event: it is forgotten once its event or a later change arrived
+        written = self._echo_cache.pop(('local', obj_type, local_id))
+        covered = ()
+        if written is not None and self._is_same_io_state(event, written[0]):
+            # only the GW the change came from, and the GWs it was relayed to along, have it already
+            origin_ios = [remote_io for remote_io in remote_ios
+                          if self._is_origin(remote_io.get('gw'), written[1]) or remote_io.get('gw') in written[2]]
+            remote_ios = [remote_io for remote_io in remote_ios if remote_io not in origin_ios]
+            logger.debug(f"{obj_type.capitalize()} change {local_id} was made by the Syncer of {written[1]}, not sent back")
+            # the remotes may have changed along, what was written to them before is no longer known
+            for remote_io in origin_ios:
+                self._echo_cache.discard((remote_io.get('gw'), obj_type, remote_io.get('remote')))
+            if not remote_ios:
+                return
+            covered = written[2]
         logger.info(
             f"{obj_type.capitalize()} change detected: {local_id} {'on' if event.get('status') in [1, True] else 'off'} {'' if event.get('dimmer') in ['', None] else '(' + str(event.get('dimmer')) + '%)'}")
-        logger.info(f"Updating remote {obj_type}s: {remote_ios}")
+        logger.info(f"Updating remote {obj_type}s: {[dict(remote_io) for remote_io in remote_ios]}")
 
+        # the GWs that get the change from us or from where it came from, the ones we send it to don't send it to those
+        covered = sorted(set(covered) | set(remote_io.get('gw') for remote_io in remote_ios))
         try:
+            if self._relay_fanout > 0:
+                remote_ios = self._relay_change(obj_type, local_id, event, remote_ios, covered)
+            # the updates are sent by the worker of each GW, in parallel
             for remote_io in remote_ios:
                 ip = remote_io.get('gw')
+                gateway = self._gateways.get(ip)
+                if gateway is None:
+                    continue
                 remote_id = remote_io.get('remote')
-                self.update_remote_io_state(obj_type=obj_type, ip=ip, remote_id=remote_id, state=event)
+                gateway['worker'].submit((obj_type, remote_id), self.update_remote_io_state,
+                                         obj_type=obj_type, ip=ip, remote_id=remote_id, state=event, covered=covered)
         except Exception as ex:
             logger.exception(f"Error processing output event {event}: {ex}")
 
-    def _call_remote(self, api_call, gateway, params=None, method="GET"):
-        # TODO: If there's an invalid_token error, call self._login() and try this call again
-        retries = 0
-        while retries < 3:
+    def _is_origin(self, ip, origin):
+        """ Whether the GW is the one with the given name, as another Syncer identifies itself by its local name or IP """
+        gateway = self._gateways.get(ip)
+        return gateway is not None and origin in [gateway.get('name'), gateway.get('ip')]
+
+    def _call_remote(self, api_call, gateway, params=None, method="GET", probe=False):
+        health = gateway['health']
+        if health.is_down() and not probe:
+            # rejected right away, the worker of the GW probes it until it is back
+            health.record_rejected()
+            raise RemoteUnavailableError(f"GW {gateway.get('name')} is down")
+        max_attempts = 1 if probe else Syncer.max_attempts
+        attempt = 0
+        while True:
+            attempt += 1
+            start = time.time()
             try:
                 if gateway.get("headers", {}).get("Authorization") is None:
                     self._login(gateway)
-                response = requests.request(method=method,
-                                            url=f"{gateway.get('endpoint')}/{api_call}",
-                                            params=params,
-                                            verify=False,
-                                            headers=gateway.get('headers'))
+                response = gateway['session'].request(method=method,
+                                                      url=f"{gateway.get('endpoint')}/{api_call}",
+                                                      params=params,
+                                                      headers=gateway.get('headers'),
+                                                      # per call, a session setting is overruled by REQUESTS_CA_BUNDLE
+                                                      verify=False,
+                                                      timeout=(Syncer.connect_timeout, Syncer.read_timeout))
                 response_data = json.loads(response.text)
-                if response_data.get('success', False) is False:
-                    if response_data.get('msg') == 'invalid_token':
-                        logger.info('Token expired')
-                        gateway["headers"]["Authorization"] = None
-                        retries += 1
-                        continue
-                    else:
-                        raise RuntimeError(
-                            'Could not execute API call {0}: {1}'.format(api_call, response_data.get('msg',
-                                                                                                     'Unknown error')))
-                return response_data
-            except Exception as ex:
-                logger.exception('Unexpected error during API call {0}: {1}'.format(api_call, ex))
-                return None
+            except (requests.RequestException, ValueError) as ex:
+                # connection problems, timeouts and garbled responses are retried
+                if attempt >= max_attempts:
+                    if health.record_failure(ex, attempt):
+                        logger.warning(f"GW {gateway.get('name')} is down, calls are rejected until a probe succeeds: {ex}")
+                        gateway['worker'].wake()
+                    raise RemoteUnavailableError(f"API call {api_call} to {gateway.get('ip')} failed after {attempt} attempts: {ex}")
+                logger.debug(f"API call {api_call} to {gateway.get('ip')} failed, retrying: {ex}")
+                time.sleep(0.5 * attempt)
+                continue
+            health.record_success(time.time() - start, attempt)
+            if response_data.get('success', False) is False:
+                if response_data.get('msg') == 'invalid_token' and attempt < max_attempts:
+                    logger.info(f"Token for {gateway.get('ip')} expired")
+                    gateway["headers"].pop("Authorization", None)
+                    continue
+                raise RuntimeError('Could not execute API call {0}: {1}'.format(api_call, response_data.get('msg', 'Unknown error')))
+            return response_data
 
     def _login(self, gateway):
+        response = gateway['session'].get(f"{gateway.get('endpoint')}/login",
+                                          params={
+                                              'username': gateway.get("username"),
+                                              'password': gateway.get("password"),
+                                              'accept_terms': '1',
+                                              'timeout': Syncer.token_timeout
+                                          },
+                                          headers=gateway.get("headers"),
+                                          verify=False,
+                                          timeout=(Syncer.connect_timeout, Syncer.read_timeout))
+        response_data = json.loads(response.text)
+        if response_data.get('success', False) is False:
+            raise RuntimeError(f"Could not login to {gateway.get('ip')}: {response_data.get('msg', 'Unknown error')}")
+        token = response_data.get('token')
+        gateway["headers"]['Authorization'] = 'Bearer {0}'.format(token)
+        self._save_token(gateway, token)
+
+    def _load_tokens(self):
         try:
-            response = requests.get(f"{gateway.get('endpoint')}/login",
-                                    params={
-                                        'username': gateway.get("username"),
-                                        'password': gateway.get("password"),
-                                        'accept_terms': '1',
-                                        'timeout': 60 * 60 * 24 * 30
-                                    },
-                                    verify=False,
-                                    headers=gateway.get("headers"))
-            response_data = json.loads(response.text)
-            if response_data.get('success', False) is False:
-                logger.error(f"Could not login to {gateway.get('ip')}: {response_data.get('msg', 'Unknown error')}")
-            else:
-                token = response_data.get('token')
-                gateway["headers"]['Authorization'] = 'Bearer {0}'.format(token)
+            if os.path.exists(self._token_file):
+                with open(self._token_file, 'r') as token_file:
+                    return json.load(token_file)
         except Exception as ex:
-            logger.exception('Unexpected error during login: {0}'.format(ex))
+            logger.error(f"Could not load tokens: {ex}")
+        return {}
+
+    def _save_token(self, gateway, token):
+        with self._tokens_lock:
+            self._tokens[f"{gateway.get('ip')}/{gateway.get('username')}"] = token
+            try:
+                # write to a temporary file first, so a crash never leaves a corrupt token file behind
+                temporary_file = f"{self._token_file}.tmp"
+                with open(temporary_file, 'w') as token_file:
+                    json.dump(self._tokens, token_file)
+                os.chmod(temporary_file, 0o600)
+                os.replace(temporary_file, self._token_file)
+            except Exception as ex:
+                logger.error(f"Could not save tokens: {ex}")
+
+    @om_expose
+    def get_gateway_health(self):
+        """
+        Returns the health (up, degraded or down), call counters and latency of every remote GW.
+        """
+        health = dict((gateway.get('name'), dict(gateway['health'].to_dict(), ip=ip,
+                                                 pending_updates=gateway['worker'].get_pending_count()))
+                      for ip, gateway in list(self._gateways.items()))
+        return json.dumps({'success': True, 'gateways': health})
 
     @om_expose
     def get_config_description(self):
@@ -641,8 +1566,6 @@ class Syncer(OMPluginBase):
     @om_expose
     def set_config(self, config):
         logger.info("Saving configuration")
-        thread = Thread(target=self._delete_old_config)
-        thread.start()
         config = json.loads(config)
         for key in config:
             if isinstance(config[key], six.string_types):
@@ -659,19 +1582,31 @@ class Syncer(OMPluginBase):
     def on_remove(self):
         self._delete_old_config()
 
-    def _delete_old_config(self):
-        self._old_conf_deleted = False
-        for obj_type, values in self._mappings.items():
-            for local_id, remotes in values.items():
-                for remote in remotes.get("remotes"):
-                    self.update_remote_config(obj_type=f"{obj_type}{'group' if bool(remote.get('is_shutter_group', False)) else ''}",
-                                              ip=remote.get("gw"), remote_id=remote.get("remote"), restore=True)
-        for ip, gw in self._gateways.items():
+    def _delete_old_config(self, gateways=None):
+        # gives the remote objects of the given GWs (default all) their own name back
+        gateways = self._gateways if gateways is None else gateways
+        renames = {}
+        for ip, gateway in gateways.items():
+            if gateway.get('remote_confs') is None:
+                # never renamed, the GW was down
+                continue
+            for obj_type, local_id, remote in gateway.get('remote_mappings', ()):
+                try:
+                    remote_key = self._get_remote_key(remote)
+                    self.update_remote_config(obj_type=remote_key[0], ip=ip, remote_id=remote_key[1], restore=True,
+                                              renames=renames.setdefault(ip, {}))
+                except Exception as ex:
+                    logger.error(f"Error while restoring remote {obj_type} config: {ex}")
+        for ip, gateway_renames in renames.items():
+            for obj_type, configs in gateway_renames.items():
+                try:
+                    self.set_remote_configurations(obj_type=obj_type, ip=ip, configs=configs)
+                except Exception as ex:
+                    logger.error(f"Error while restoring remote {obj_type} config: {ex}")
+        for ip, gw in gateways.items():
             for _, sensor_dto in gw.get('sensor_mapping', {}).items():
                 """
                 TODO: remove sensor_dto, this todo is blocked because removal of connectors is not yet implemented in BE.
                 When removing the plugin, connectors will be deleted in the background, so not necessary in that case.
                 """
                 continue
-
-        self._old_conf_deleted = True
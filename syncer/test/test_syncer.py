@@ -0,0 +1,139 @@
+"""
+Tests of the Syncer plugin, without gateways: the remote GWs are replaced by workers that record the queued updates.
+Run with: python3 -m unittest discover -s syncer/test
+"""
+
+import os
+import sys
+import json
+import unittest
+import importlib.util
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from harness import install_plugin_base
+
+install_plugin_base()
+_spec = importlib.util.spec_from_file_location('syncer_main', os.path.join(ROOT, 'syncer', 'main.py'))
+syncer = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(syncer)
+
+
+class RecordingWorker(object):
+    def __init__(self):
+        self.updates = []
+
+    def submit(self, key, function, **kwargs):
+        self.updates.append(kwargs)
+
+
+class FakeWebinterface(object):
+    def __init__(self):
+        self.outputs = {}
+
+    def set_output(self, id, is_on, dimmer=None):
+        self.outputs[id] = (is_on, dimmer)
+        return json.dumps({'success': True})
+
+
+class EchoTest(unittest.TestCase):
+    """
+    GW B maps its output 1 to output 1 on GW A and output 2 on GW C, all of them run a Syncer
+    """
+
+    def setUp(self):
+        self.plugin = syncer.Syncer.__new__(syncer.Syncer)
+        self.plugin.webinterface = FakeWebinterface()
+        self.plugin._name = 'B'
+        self.plugin._enabled = True
+        self.plugin._relay_fanout = 0
+        self.plugin._echo_cache = syncer.EchoCache(syncer.Syncer.echo_ttl)
+        self.plugin._relay_events = syncer.EchoCache(syncer.Syncer.relay_event_ttl)
+        self.plugin._gateways = {}
+        for ip, name in [('10.0.0.1', 'A'), ('10.0.0.3', 'C')]:
+            self.plugin._gateways[ip] = {'ip': ip, 'name': name, 'peer_syncer': True, 'worker': RecordingWorker()}
+        self.plugin._tables = syncer.MappingTables(
+            remote_mappings=[('output', 1, {'type': 'output', 'remote': 1, 'gw': '10.0.0.1'}),
+                             ('output', 1, {'type': 'output', 'remote': 2, 'gw': '10.0.0.3'})],
+            local_states={'output': [{'id': 0, 'status': 0, 'dimmer': 0}, {'id': 1, 'status': 0, 'dimmer': 0}]})
+
+    def _updates(self, ip):
+        return [(update['remote_id'], update['state']['status']) for update in self.plugin._gateways[ip]['worker'].updates]
+
+    def test_write_of_peer_reaches_other_gateways(self):
+        self.plugin.receive_remote_write(source='A', obj_type='output', id=1, is_on='True')
+        self.assertEqual(self.plugin.webinterface.outputs[1], (True, None))
+        self.plugin.handle_output_status({'id': 1, 'status': {'on': True, 'value': 0}})
+        # not sent back to A, but C gets it
+        self.assertEqual(self._updates('10.0.0.1'), [])
+        self.assertEqual(self._updates('10.0.0.3'), [(2, True)])
+
+    def test_one_echo_per_write(self):
+        self.plugin.receive_remote_write(source='A', obj_type='output', id=1, is_on='True')
+        self.plugin.handle_output_status({'id': 1, 'status': {'on': True, 'value': 0}})
+        # switched off and on again locally: both changes go to A and C
+        self.plugin.handle_output_status({'id': 1, 'status': {'on': False, 'value': 0}})
+        self.plugin.handle_output_status({'id': 1, 'status': {'on': True, 'value': 0}})
+        self.assertEqual(self._updates('10.0.0.1'), [(1, False), (1, True)])
+        self.assertEqual(self._updates('10.0.0.3'), [(2, True), (2, False), (2, True)])
+
+    def test_local_change_reaches_all_gateways(self):
+        self.plugin.handle_output_status({'id': 1, 'status': {'on': True, 'value': 0}})
+        self.assertEqual(self._updates('10.0.0.1'), [(1, True)])
+        self.assertEqual(self._updates('10.0.0.3'), [(2, True)])
+
+
+
+class RelayEchoTest(EchoTest):
+    """
+    GW B also maps its output 1 to output 3 on GW D, which isn't mapped by A
+    """
+
+    def setUp(self):
+        super(RelayEchoTest, self).setUp()
+        self.plugin._gateways['10.0.0.4'] = {'ip': '10.0.0.4', 'name': 'D', 'peer_syncer': True, 'worker': RecordingWorker()}
+        self.plugin._tables = syncer.MappingTables(
+            remote_mappings=[('output', 1, {'type': 'output', 'remote': 1, 'gw': '10.0.0.1'}),
+                             ('output', 1, {'type': 'output', 'remote': 2, 'gw': '10.0.0.3'}),
+                             ('output', 1, {'type': 'output', 'remote': 3, 'gw': '10.0.0.4'})],
+            local_states={'output': [{'id': 0, 'status': 0, 'dimmer': 0}, {'id': 1, 'status': 0, 'dimmer': 0}]})
+
+    def test_relayed_change_reaches_gateways_outside_the_tree(self):
+        # A relays to B and C, so only D still has to get the change from B
+        tree = {'updates': [['output', 1, True, None]], 'children': {}}
+        self.plugin.receive_relay(source='A', event_id='event', tree=json.dumps(tree),
+                                  covered=json.dumps(['10.0.0.2', '10.0.0.3']))
+        self.plugin.handle_output_status({'id': 1, 'status': {'on': True, 'value': 0}})
+        self.assertEqual(self._updates('10.0.0.1'), [])
+        self.assertEqual(self._updates('10.0.0.3'), [])
+        self.assertEqual(self._updates('10.0.0.4'), [(3, True)])
+
+    def test_write_of_peer_reaches_other_gateways(self):
+        self.plugin.receive_remote_write(source='A', obj_type='output', id=1, is_on='True')
+        self.plugin.handle_output_status({'id': 1, 'status': {'on': True, 'value': 0}})
+        self.assertEqual(self._updates('10.0.0.1'), [])
+        self.assertEqual(self._updates('10.0.0.3'), [(2, True)])
+        self.assertEqual(self._updates('10.0.0.4'), [(3, True)])
+
+    def test_write_of_peer_skips_gateways_it_updates_itself(self):
+        # A writes to B and C itself
+        self.plugin.receive_remote_write(source='A', obj_type='output', id=1, is_on='True',
+                                         covered=json.dumps(['10.0.0.2', '10.0.0.3']))
+        self.plugin.handle_output_status({'id': 1, 'status': {'on': True, 'value': 0}})
+        self.assertEqual(self._updates('10.0.0.1'), [])
+        self.assertEqual(self._updates('10.0.0.3'), [])
+        self.assertEqual(self._updates('10.0.0.4'), [(3, True)])
+        # D doesn't have to send it to any of them
+        self.assertEqual(self.plugin._gateways['10.0.0.4']['worker'].updates[0]['covered'], ['10.0.0.2', '10.0.0.3', '10.0.0.4'])
+
+    def test_one_echo_per_write(self):
+        pass
+
+    def test_local_change_reaches_all_gateways(self):
+        self.plugin.handle_output_status({'id': 1, 'status': {'on': True, 'value': 0}})
+        self.assertEqual(self._updates('10.0.0.4'), [(3, True)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,13 +2,18 @@
 A ventilation plugin, using statistical humidity data or the dew point to control the ventilation
 """
 
+import os
 import six
 import time
 import math
+import mmap
+import struct
 import traceback
 import json
 from math import sqrt
+from array import array
 from collections import deque
+from threading import Lock
 from plugins.base import om_expose, background_task, OMPluginBase, PluginConfigChecker, om_metric_data
 from serial_utils import CommunicationTimedOutException
 import logging
@@ -16,15 +21,198 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+class SampleWindow(object):
+    """
+    Ring buffer with the last samples of a sensor. The sum and the sum of squares are kept up to date, so adding a
+    sample and getting the mean and standard deviation take constant time. The sums are taken relative to a reference
+    sample, which keeps the variance accurate. Once per window they are recalculated relative to the most recent
+    sample, which drops the rounding errors.
+    """
+
+    def __init__(self, size):
+        self.size = max(1, int(size))
+        self._buffer = array('d', [0.0]) * self.size
+        self._start = 0
+        self._count = 0
+        self._shift = None
+        self._sum = 0.0
+        self._sum_of_squares = 0.0
+        self._updates = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, value):
+        value = float(value)
+        if self._shift is None:
+            self._shift = value
+        if self._count == self.size:
+            old_value = self._buffer[self._start] - self._shift
+            self._sum -= old_value
+            self._sum_of_squares -= old_value * old_value
+            self._buffer[self._start] = value
+            self._start = (self._start + 1) % self.size
+        else:
+            self._buffer[(self._start + self._count) % self.size] = value
+            self._count += 1
+        value -= self._shift
+        self._sum += value
+        self._sum_of_squares += value * value
+        self._updates += 1
+        if self._updates >= self.size:
+            self._recalculate()
+
+    def values(self):
+        """
+        Returns the samples, oldest first
+        """
+        return [self._buffer[(self._start + index) % self.size] for index in range(self._count)]
+
+    def last(self):
+        if self._count == 0:
+            return None
+        return self._buffer[(self._start + self._count - 1) % self.size]
+
+    def resize(self, size):
+        """
+        Changes the size of the window, the most recent samples are kept
+        """
+        values = self.values()
+        self.__init__(size)
+        for value in values[-self.size:]:
+            self.add(value)
+
+    def mean(self):
+        if self._count == 0:
+            return 0
+        return self._shift + self._sum / self._count
+
+    def stddev(self):
+        if self._count == 0:
+            return 0
+        mean = self._sum / self._count
+        return sqrt(max(0.0, self._sum_of_squares / self._count - mean * mean))
+
+    def _recalculate(self):
+        values = self.values()
+        self._shift = values[-1]
+        self._sum = 0.0
+        self._sum_of_squares = 0.0
+        for value in values:
+            value -= self._shift
+            self._sum += value
+            self._sum_of_squares += value * value
+        self._updates = 0
+
+
+class SampleStore(object):
+    """
+    Memory-mapped file with the recent samples of all sensors, so the sample windows survive a restart. It is a ring of
+    fixed size (timestamp, sensor id, value) records behind a header with the capacity and the next record to write.
+    Every sample is written in place, so only the changed pages have to reach the disk.
+    """
+
+    MAGIC = b'VSMP'
+    HEADER = struct.Struct('<4sII')
+    RECORD = struct.Struct('<dId')
+
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+        self._map = None
+        self._capacity = 0
+        self._position = 0
+        self._lock = Lock()
+
+    def open(self, capacity):
+        """
+        Opens the file for the given amount of records and returns the stored (timestamp, sensor id, value) records,
+        oldest first. A file of another capacity is rewritten with its most recent records.
+        """
+        capacity = max(1, int(capacity))
+        with self._lock:
+            records = self._read_records()
+            self._close()
+            records = records[-capacity:]
+            size = SampleStore.HEADER.size + capacity * SampleStore.RECORD.size
+            if len(records) > 0 and self._capacity == capacity and os.path.getsize(self._path) == size:
+                self._file = open(self._path, 'r+b')
+                self._map = mmap.mmap(self._file.fileno(), size)
+            else:
+                self._file = open(self._path, 'w+b')
+                self._file.truncate(size)
+                self._map = mmap.mmap(self._file.fileno(), size)
+                self._capacity = capacity
+                self._position = 0
+                for record in records:
+                    self._write(*record)
+            return records
+
+    def append(self, timestamp, sensor_id, value):
+        with self._lock:
+            if self._map is not None:
+                self._write(timestamp, sensor_id, value)
+
+    def flush(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.flush()
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _write(self, timestamp, sensor_id, value):
+        SampleStore.RECORD.pack_into(self._map, SampleStore.HEADER.size + self._position * SampleStore.RECORD.size,
+                                     timestamp, sensor_id, value)
+        self._position = (self._position + 1) % self._capacity
+        SampleStore.HEADER.pack_into(self._map, 0, SampleStore.MAGIC, self._capacity, self._position)
+
+    def _read_records(self):
+        if self._map is None:
+            if not os.path.exists(self._path):
+                return []
+            with open(self._path, 'rb') as sample_file:
+                data = sample_file.read()
+        else:
+            data = self._map[:]
+        if len(data) < SampleStore.HEADER.size:
+            return []
+        magic, capacity, position = SampleStore.HEADER.unpack_from(data, 0)
+        if magic != SampleStore.MAGIC or capacity == 0 or position >= capacity or \
+                len(data) != SampleStore.HEADER.size + capacity * SampleStore.RECORD.size:
+            logger.warning('Ignoring invalid sample file {0}'.format(self._path))
+            return []
+        self._capacity = capacity
+        self._position = position
+        records = []
+        # oldest record first, records that were never written have no timestamp
+        for index in list(range(position, capacity)) + list(range(position)):
+            record = SampleStore.RECORD.unpack_from(data, SampleStore.HEADER.size + index * SampleStore.RECORD.size)
+            if record[0] > 0:
+                records.append(record)
+        return records
+
+    def _close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
 class Ventilation(OMPluginBase):
     """
     A ventilation plugin, using statistical humidity or the dew point data to control the ventilation
     """
 
     name = 'Ventilation'
-    version = '2.0.19'
+    version = '2.0.22'
     interfaces = [('config', '1.0'),
                   ('metrics', '1.0')]
+    # the plugin directory is replaced on an update, the samples are kept with the plugin configurations
+    data_dir = '/opt/openmotics/etc'
 
     config_description = [{'name': 'low',
                            'type': 'section',
@@ -115,6 +303,9 @@ class Ventilation(OMPluginBase):
         self._settings = {}
         self._last_ventilation = None
         self._metrics_queue = deque()
+        # the samples are kept over restarts and updates
+        data_dir = Ventilation.data_dir if os.path.isdir(Ventilation.data_dir) else os.path.dirname(os.path.realpath(__file__))
+        self._sample_store = SampleStore(os.path.join(data_dir, 'pi_ventilation_samples.bin'))
 
         self._read_config()
 
@@ -128,6 +319,32 @@ class Ventilation(OMPluginBase):
         self._mode, self._settings = self._config.get('mode', ['disabled', {}])
         self._enabled = len(self._used_sensors) > 0 and self._mode in ['dew_point', 'statistical']
         logger.info('Ventilation is {0}'.format('enabled' if self._enabled else 'disabled'))
+        if self._enabled and self._mode == 'statistical':
+            self._load_samples()
+
+    def _load_samples(self):
+        """
+        Fills the sample windows of the sensors with the stored samples that are still recent enough, so the statistics
+        can be used right away after a restart
+        """
+        size = self._settings.get('samples', 1440)
+        try:
+            records = self._sample_store.open(size * len(self._used_sensors))
+        except Exception as ex:
+            logger.exception('Could not load the stored samples: {0}'.format(ex))
+            return
+        # there is a sample every minute, older samples would have left the window already
+        oldest = time.time() - size * 60
+        loaded = {}
+        for timestamp, sensor_id, value in records:
+            if timestamp < oldest or sensor_id not in self._used_sensors or sensor_id in self._samples:
+                continue
+            if sensor_id not in loaded:
+                loaded[sensor_id] = SampleWindow(size)
+            loaded[sensor_id].add(value)
+        self._samples.update(loaded)
+        logger.info('Loaded {0} stored samples of {1} sensors'.format(sum(len(samples) for samples in loaded.values()),
+                                                                      len(loaded)))
 
     def _load_sensors(self):
         try:
@@ -140,9 +357,11 @@ class Ventilation(OMPluginBase):
                     sensor_id = sensor['id']
                     if sensor_id in self._used_sensors or sensor_id == self._settings.get('outside_sensor_id'):
                         sensor_ids.append(sensor_id)
-                        self._samples[sensor_id] = []
+                        # the sensors are loaded every minute, their samples are kept
+                        if sensor_id not in self._samples:
+                            self._samples[sensor_id] = SampleWindow(self._settings.get('samples', 1440))
                         self._sensors[sensor_id] = sensor['name'] if sensor['name'] != '' else sensor_id
-                for sensor_id in self._sensors.keys():
+                for sensor_id in list(self._sensors.keys()):
                     if sensor_id not in sensor_ids:
                         self._sensors.pop(sensor_id, None)
                         self._samples.pop(sensor_id, None)
@@ -296,22 +515,30 @@ class Ventilation(OMPluginBase):
             # Fetch data
             humidities = json.loads(self.webinterface.get_sensor_humidity_status())
             if humidities['success'] is True:
+                size = self._settings.get('samples', 1440)
+                now = time.time()
                 for sensor_id in range(len(humidities['status'])):
                     if sensor_id not in self._samples:
                         continue
                     value = humidities['status'][sensor_id]
-                    if value == 255:
+                    if value is None or value == 255:
                         continue
-                    self._samples[sensor_id].append(value)
-                    if len(self._samples[sensor_id]) > self._settings.get('samples', 1440):
-                        self._samples[sensor_id].pop(0)
+                    samples = self._samples[sensor_id]
+                    if samples.size != size:
+                        samples.resize(size)
+                    samples.add(value)
+                    self._sample_store.append(now, sensor_id, samples.last())
+                try:
+                    self._sample_store.flush()
+                except Exception as ex:
+                    logger.error('Could not store the samples: {0}'.format(ex))
             # Calculate required ventilation based on sensor information
             ventilation = 1
             trigger_sensors = {1: [],
                                2: [],
                                3: []}
-            for sensor_id in self._samples:
-                if sensor_id not in self._sensors:
+            for sensor_id, samples in self._samples.items():
+                if sensor_id not in self._sensors or len(samples) == 0:
                     continue
                 if sensor_id not in self._runtime_data:
                     self._runtime_data[sensor_id] = {'trigger': 0,
@@ -320,9 +547,9 @@ class Ventilation(OMPluginBase):
                                                      'difference': '',
                                                      'name': self._sensors[sensor_id],
                                                      'stats': [0, 0, 0]}
-                current = self._samples[sensor_id][-1]
-                mean = Ventilation._mean(self._samples[sensor_id])
-                stddev = Ventilation._stddev(self._samples[sensor_id])
+                current = samples.last()
+                mean = samples.mean()
+                stddev = samples.stddev()
                 level_2 = mean + 2 * stddev
                 level_3 = mean + 3 * stddev
                 self._runtime_data[sensor_id]['stats'] = [current, level_2, level_3]
@@ -355,7 +582,7 @@ class Ventilation(OMPluginBase):
                                               'high': float(level_3),
                                               'mean': float(mean),
                                               'stddev': float(stddev),
-                                              'samples': len(self._samples[sensor_id]),
+                                              'samples': len(samples),
                                               'level': int(current_ventilation)})
             if ventilation != self._last_ventilation:
                 if self._last_ventilation is None:
@@ -433,24 +660,6 @@ class Ventilation(OMPluginBase):
             return ((a * _temperature) / (b + _temperature)) + math.log(_humidity / 100.0)
         return (b * gamma(temperature, humidity)) / (a - gamma(temperature, humidity))
 
-    @staticmethod
-    def _mean(entries):
-        """
-        Calculates mean
-        """
-        if len(entries) > 0:
-            return sum(entries) * 1.0 / len(entries)
-        return 0
-
-    @staticmethod
-    def _stddev(entries):
-        """
-        Calculates standard deviation
-        """
-        mean = Ventilation._mean(entries)
-        variance = map(lambda e: (e - mean) ** 2, entries)
-        return sqrt(Ventilation._mean(variance))
-
     @om_expose
     def get_debug(self):
         return json.dumps({'runtime_data': self._runtime_data,